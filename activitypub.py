@@ -1,12 +1,15 @@
 """Handles requests for ActivityPub endpoints: actors, inbox, etc.
 """
 import datetime
+from hashlib import sha256
 import logging
 import re
+import threading
 
+import cachetools
 from flask import request
 from google.cloud import ndb
-from google.cloud.ndb import OR
+from google.cloud.ndb.query import Cursor
 from granary import as2
 from oauth_dropins.webutil import flask_util, util
 from oauth_dropins.webutil.flask_util import error
@@ -15,12 +18,27 @@ from oauth_dropins.webutil.util import json_dumps, json_loads
 from app import app, cache
 import common
 from common import redirect_unwrap, redirect_wrap
-from models import Activity, Follower, User
+from models import Activity, Follower, InboxItem, SeenActivity, User
 
 logger = logging.getLogger(__name__)
 
 CACHE_TIME = datetime.timedelta(seconds=15)
 
+# pages after the first are keyed by cursor and change rarely, so crawlers can
+# cache them longer
+COLLECTION_PAGE_SIZE = 100
+COLLECTION_PAGE_CACHE_TIME = datetime.timedelta(minutes=10)
+
+# max number of Followers to deactivate at once when handling a Delete
+DELETE_BATCH_SIZE = 100
+
+# inbound activities we've already received, for de-duplicating redeliveries.
+# maps seen key to True. guarded by _seen_lock. backed by SeenActivity.
+SEEN_TTL = datetime.timedelta(hours=6)
+SEEN_CACHE_SIZE = 20000
+_seen = cachetools.TTLCache(maxsize=SEEN_CACHE_SIZE, ttl=SEEN_TTL.total_seconds())
+_seen_lock = threading.Lock()
+
 SUPPORTED_TYPES = (
     'Accept',
     'Announce',
@@ -38,6 +56,7 @@ SUPPORTED_TYPES = (
 
 
 @app.get(f'/<regex("{common.DOMAIN_RE}"):domain>')
+@common.conditional(CACHE_TIME)
 @flask_util.cached(cache, CACHE_TIME)
 def actor(domain):
     """Fetches a domain's h-card and converts to AS2 actor."""
@@ -64,10 +83,6 @@ def inbox(domain=None):
 
     logger.info(f'Got: {json_dumps(activity, indent=2)}')
 
-    obj = activity.get('object') or {}
-    if isinstance(obj, str):
-        obj = {'id': obj}
-
     type = activity.get('type')
     if type == 'Accept':  # eg in response to a Follow
         return ''  # noop
@@ -75,7 +90,117 @@ def inbox(domain=None):
         error('Sorry, %s activities are not supported yet.' % type,
                      status=501)
 
-    # TODO: verify signature if there is one
+    actor = util.get_first(activity, 'actor')
+    actor_id = actor.get('id') if isinstance(actor, dict) else actor
+
+    if type == 'Delete':
+        # we only act on Deletes of actors we know, sent to the shared inbox.
+        # the rest are noops, eg Deletes of posts and of actors we've never
+        # seen, so don't spend a key fetch authenticating them.
+        obj = util.get_first(activity, 'object')
+        obj_id = obj.get('id') if isinstance(obj, dict) else obj
+        if domain or not isinstance(obj_id, str) or not is_known_actor(obj_id):
+            logger.info(f'Ignoring Delete of {obj_id}')
+            return 'OK'
+
+        # deleted actors' keys are usually gone (410), so we can only use a key
+        # we already have. actors can only delete themselves.
+        signer = common.verify_signature(fetch=False)
+        if not signer:
+            error('HTTP Signature required', status=401)
+        elif signer != actor_id or signer != obj_id:
+            error(f"{signer}'s key can't delete {obj_id}", status=401)
+    else:
+        # the key that signed the request has to belong to the actor. unsigned
+        # requests are only allowed if INBOX_REQUIRE_SIGNATURES is off.
+        signer = common.verify_signature()
+        if signer and signer != actor_id:
+            error(f"{signer}'s key can't sign for actor {actor_id}", status=401)
+        elif not signer and app.config['INBOX_REQUIRE_SIGNATURES']:
+            error('HTTP Signature required', status=401)
+
+    seen = seen_key(activity)
+    if is_seen(seen):
+        logger.info(f'Already received {seen}, skipping')
+        return 'OK'
+
+    if app.config['INBOX_QUEUE'] == 'inline':
+        resp = process_inbox(activity, domain)
+        mark_seen(seen)
+        return resp
+
+    key = InboxItem(data=json_dumps(activity), domain=domain,
+                    host_url=request.host_url, next_attempt=common.utcnow()).put()
+    logger.info(f'Queued {key}')
+    mark_seen(seen)
+    return 'Accepted', 202
+
+
+def seen_key(activity):
+    """Returns the de-duplication key for an inbound activity.
+
+    The activity's id if it has one, otherwise a digest of its contents.
+
+    Args:
+      activity: dict, AS2 activity
+
+    Returns: str
+    """
+    id = activity.get('id')
+    if not isinstance(id, str) or len(id) > 500:
+        # datastore key names are limited to 1500 bytes
+        id = 'sha256:' + sha256(json_dumps(activity, sort_keys=True).encode()).hexdigest()
+    return id
+
+
+def is_seen(key):
+    """Returns True if we've received an activity in the last SEEN_TTL.
+
+    Args:
+      key: str, from :func:`seen_key`
+    """
+    with _seen_lock:
+        if key in _seen:
+            return True
+
+    seen = SeenActivity.get_by_id(key)
+    if seen and seen.expire > common.utcnow():
+        with _seen_lock:
+            _seen[key] = True
+        return True
+
+    return False
+
+
+def mark_seen(key):
+    """Records that we've received an activity.
+
+    Args:
+      key: str, from :func:`seen_key`
+    """
+    with _seen_lock:
+        _seen[key] = True
+    now = common.utcnow()
+    SeenActivity(id=key, created=now, expire=now + SEEN_TTL).put()
+
+
+def process_inbox(activity, domain=None):
+    """Processes an inbound ActivityPub activity that's already been validated.
+
+    Called inline by :func:`inbox` or later by :func:`tasks.process_inbox`,
+    depending on the ``INBOX_QUEUE`` config value.
+
+    Args:
+      activity: dict, AS2 activity
+      domain: str, user domain of the inbox it was delivered to, or None for
+        the shared inbox
+
+    Returns: Flask response
+    """
+    obj = activity.get('object') or {}
+    if isinstance(obj, str):
+        obj = {'id': obj}
+    type = activity.get('type')
 
     user = User.get_or_create(domain) if domain else None
 
@@ -97,12 +222,8 @@ def inbox(domain=None):
             # assume this is an actor
             # https://github.com/snarfed/bridgy-fed/issues/63
         logger.info(f'Deactivating Followers with src or dest = {id}')
-        followers = Follower.query(OR(Follower.src == id,
-                                      Follower.dest == id)
-                                   ).fetch()
-        for f in followers:
-            f.status = 'inactive'
-        ndb.put_multi(followers)
+        count = deactivate_followers(id)
+        logger.info(f'Deactivated {count} Followers')
         return 'OK'
 
     # fetch actor if necessary so we have name, profile photo, etc
@@ -146,6 +267,51 @@ def inbox(domain=None):
     return ''
 
 
+def is_known_actor(id):
+    """Returns True if an actor has any active :class:`Follower`s, either way.
+
+    Uses keys-only queries, so it's cheap for actors we've never seen.
+
+    Args:
+      id: str, AP actor id
+    """
+    return any(Follower.query(prop == id, Follower.status == 'active'
+                              ).get(keys_only=True)
+               for prop in (Follower.src, Follower.dest))
+
+
+def deactivate_followers(id):
+    """Deactivates all active :class:`Follower` entities with a given src or dest.
+
+    Most Deletes are for actors we've never seen, so this uses keys-only
+    queries first. Those cost one index scan per side and load no entities.
+    Matches are then loaded and stored in batches of DELETE_BATCH_SIZE.
+
+    Args:
+      id: str, AP actor id
+
+    Returns: int, number of Followers deactivated
+    """
+    count = 0
+    for prop in Follower.src, Follower.dest:
+        query = Follower.query(prop == id, Follower.status == 'active')
+        cursor = None
+        more = True
+        while more:
+            keys, cursor, more = query.fetch_page(
+                DELETE_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+            followers = [f for f in ndb.get_multi(keys)
+                         if f and f.status == 'active']
+            for f in followers:
+                f.status = 'inactive'
+            ndb.put_multi(followers)
+            for f in followers:
+                f.update_counts(was_active=True)
+            count += len(followers)
+
+    return count
+
+
 def accept_follow(follow, follow_unwrapped, user):
     """Replies to an AP Follow request with an Accept request.
 
@@ -185,12 +351,21 @@ def accept_follow(follow, follow_unwrapped, user):
             'object': followee,
         }
     }
-    resp = common.signed_post(inbox, data=accept, user=user)
+    try:
+        resp = common.signed_post(inbox, data=accept, user=user)
+    except BaseException as e:
+        if not common.is_retryable(e):
+            raise
+        common.enqueue_delivery(inbox, accept, user or common.default_signature_user(),
+                                error=e)
+        resp = None
 
     # send webmention
     common.send_webmentions(as2.to_as1(follow), proxy=True, protocol='activitypub',
                             source_as2=json_dumps(follow_unwrapped))
 
+    if resp is None:
+        return 'Accept queued for retry', 202
     return resp.text, resp.status_code
 
 
@@ -214,68 +389,104 @@ def undo_follow(undo_unwrapped):
     follower_obj = Follower.get_by_id(Follower._id(dest=user_domain, src=follower))
     if follower_obj:
         logger.info(f'Marking {follower_obj.key} as inactive')
+        was_active = follower_obj.status == 'active'
         follower_obj.status = 'inactive'
         follower_obj.put()
+        follower_obj.update_counts(was_active=was_active)
     else:
         logger.warning(f'No Follower found for {user_domain} {follower}')
 
     # TODO send webmention with 410 of u-follow
 
 
-# TODO: unify with following_collection
 @app.get(f'/<regex("{common.DOMAIN_RE}"):domain>/followers')
+@common.conditional(CACHE_TIME)
 @flask_util.cached(cache, CACHE_TIME)
 def followers_collection(domain):
     """ActivityPub Followers collection.
 
     https://www.w3.org/TR/activitypub/#followers
-    https://www.w3.org/TR/activitypub/#collections
-    https://www.w3.org/TR/activitystreams-core/#paging
     """
-    if not User.get_by_id(domain):
-        return f'User {domain} not found', 404
-
-    logger.info(f"Counting {domain}'s followers")
-    count = Follower.query(
-        Follower.status == 'active',
-        Follower.dest == domain,
-    ).count()
-
-    ret = {
-        '@context': 'https://www.w3.org/ns/activitystreams',
-        'summary': f"{domain}'s followers",
-        'type': 'Collection',
-        'totalItems': count,
-        'items': [],  # TODO
-    }
-    logger.info(f'Returning {json_dumps(ret, indent=2)}')
-    return ret
+    return collection(domain, 'followers')
 
 
 @app.get(f'/<regex("{common.DOMAIN_RE}"):domain>/following')
+@common.conditional(CACHE_TIME)
 @flask_util.cached(cache, CACHE_TIME)
 def following_collection(domain):
     """ActivityPub Following collection.
 
     https://www.w3.org/TR/activitypub/#following
+    """
+    return collection(domain, 'following')
+
+
+def collection(domain, name):
+    """Serves a paged AS2 OrderedCollection of active followers or following.
+
+    Without a cursor query param, returns the OrderedCollection with its first
+    page embedded. With one, returns that OrderedCollectionPage. Pages are
+    projection queries on the other side of the :class:`Follower`, so we never
+    load ``last_follow``.
+
     https://www.w3.org/TR/activitypub/#collections
     https://www.w3.org/TR/activitystreams-core/#paging
+
+    Args:
+      domain: str, user's domain
+      name: str, 'followers' or 'following'
     """
     if not User.get_by_id(domain):
         return f'User {domain} not found', 404
 
-    logger.info(f"Counting {domain}'s following")
-    count = Follower.query(
-        Follower.status == 'active',
-        Follower.src == domain,
-    ).count()
-
-    ret = {
-        '@context': 'https://www.w3.org/ns/activitystreams',
-        'summary': f"{domain}'s following",
-        'type': 'Collection',
-        'totalItems': count,
-        'items': [],  # TODO
+    mine, theirs = ('dest', 'src') if name == 'followers' else ('src', 'dest')
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor = Cursor(urlsafe=cursor)
+        except (TypeError, ValueError):
+            error(f'Invalid cursor {cursor}')
+
+    query = Follower.query(Follower.status == 'active',
+                           getattr(Follower, mine) == domain,
+                           projection=[theirs])
+    followers, next_cursor, more = query.fetch_page(
+        COLLECTION_PAGE_SIZE, start_cursor=cursor)
+
+    id = request.base_url
+    page = {
+        'type': 'OrderedCollectionPage',
+        'partOf': id,
+        'orderedItems': [getattr(f, theirs) for f in followers],
     }
+    if cursor:
+        page['id'] = request.url
+    if more and next_cursor:
+        page['next'] = f'{id}?cursor={next_cursor.urlsafe().decode()}'
+
+    if cursor:
+        ret = {
+            '@context': 'https://www.w3.org/ns/activitystreams',
+            **page,
+        }
+        cache_time = COLLECTION_PAGE_CACHE_TIME
+    else:
+        count = (Follower.count_followers(domain) if name == 'followers'
+                 else Follower.count_following(domain))
+        ret = {
+            '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': id,
+            'summary': f"{domain}'s {name}",
+            'type': 'OrderedCollection',
+            'totalItems': count,
+            'first': page,
+        }
+        cache_time = CACHE_TIME
+
     logger.info(f'Returning {json_dumps(ret, indent=2)}')
-    return ret
+    return ret, {
+        'Content-Type': common.CONTENT_TYPE_AS2,
+        'Cache-Control': f'public, max-age={int(cache_time.total_seconds())}',
+        'Access-Control-Allow-Origin': '*',
+    }
@@ -0,0 +1,205 @@
+"""Two level Flask-Caching backend: in-process L1 in front of a shared L2.
+
+Configure with ``CACHE_TYPE = 'caching.TwoLevelCache'``. L2 is memcached if
+``CACHE_MEMCACHED_SERVERS`` is set, otherwise an in-process stand-in.
+"""
+import collections
+from datetime import timedelta
+from hashlib import sha256
+import logging
+import math
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask_caching.backends.base import BaseCache
+from flask_caching.backends.memcache import MemcachedCache
+from flask_caching.backends.simplecache import SimpleCache
+from pymemcache import serde
+from pymemcache.client.hash import HashClient
+
+logger = logging.getLogger(__name__)
+
+# max time to keep entries in L1. L1 isn't shared, so this bounds how stale one
+# instance can be after another one sets or deletes a key.
+L1_MAX_TIMEOUT = 60
+L1_SIZE = 500
+
+# max time to wait for another thread that's already generating a value
+SINGLE_FLIGHT_TIMEOUT = 10
+
+MEMCACHED_TIMEOUT = 1  # s
+
+# per-endpoint hit and miss counts, for all TwoLevelCaches in this process.
+# maps endpoint to collections.Counter. guarded by _stats_lock.
+stats = collections.defaultdict(collections.Counter)
+_stats_lock = threading.Lock()
+
+
+def hit_ratios():
+    """Returns per-endpoint cache stats, sorted by endpoint.
+
+    Returns: list of (str endpoint, :class:`collections.Counter`, float hit
+      ratio) tuples. The ratio is None if there haven't been any lookups.
+    """
+    with _stats_lock:
+        items = sorted((endpoint, collections.Counter(counts))
+                       for endpoint, counts in stats.items())
+
+    ratios = []
+    for endpoint, counts in items:
+        total = sum(counts.values())
+        hits = total - counts['miss']
+        ratios.append((endpoint, counts, hits / total if total else None))
+    return ratios
+
+
+class TwoLevelCache(BaseCache):
+    """Checks an in-process L1 cache, then a shared L2 cache.
+
+    Also prevents stampedes: if a lookup misses while another thread in this
+    process is already generating the same key during a request, it waits for
+    that thread to finish and uses its value instead of generating it again.
+
+    Args:
+      l2: :class:`BaseCache`, shared cache
+      default_timeout: int, seconds
+    """
+    def __init__(self, l2, default_timeout=300):
+        super().__init__(default_timeout=default_timeout)
+        self.l1 = SimpleCache(threshold=L1_SIZE, default_timeout=L1_MAX_TIMEOUT)
+        self.l2 = l2
+        # maps key to threading.Event that's set when it's been generated.
+        # guarded by _in_flight_lock.
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        servers = config.get('CACHE_MEMCACHED_SERVERS')
+        if servers:
+            client = HashClient(servers, serde=serde.pickle_serde,
+                                connect_timeout=MEMCACHED_TIMEOUT,
+                                timeout=MEMCACHED_TIMEOUT,
+                                # treat errors as misses
+                                ignore_exc=True)
+            l2 = MemcachedCache(client, key_prefix=config.get('CACHE_KEY_PREFIX'),
+                                **kwargs)
+        else:
+            logger.warning('No CACHE_MEMCACHED_SERVERS, using in-process L2')
+            l2 = SimpleCache(threshold=config.get('CACHE_THRESHOLD', 500), **kwargs)
+
+        cache = cls(l2, **kwargs)
+        app.teardown_request(cache._finish_request)
+        return cache
+
+    @staticmethod
+    def _count(stat):
+        endpoint = (request.endpoint if has_request_context() else None) or 'other'
+        with _stats_lock:
+            stats[endpoint][stat] += 1
+
+    def _l2_timeout(self, timeout):
+        """Returns a timeout as whole seconds. memcached rejects floats."""
+        if timeout is None:
+            timeout = self.default_timeout
+        if isinstance(timeout, timedelta):
+            timeout = timeout.total_seconds()
+        return math.ceil(timeout)
+
+    @staticmethod
+    def _l2_key(key):
+        """Returns a memcached safe key for L2.
+
+        memcached keys can't have whitespace or control characters and are
+        limited to 250 bytes, and our keys are often URLs, so we hash them.
+        """
+        return sha256(key.encode()).hexdigest()
+
+    def _expires(self, timeout):
+        """Returns the expiration time for a timeout, or None if it's forever."""
+        return time.time() + timeout if timeout else None
+
+    @staticmethod
+    def _l1_timeout(expires):
+        if not expires:
+            return L1_MAX_TIMEOUT
+        return max(min(int(expires - time.time()), L1_MAX_TIMEOUT), 1)
+
+    def _lookup(self, key):
+        """Returns (value, str stat), where value is None on a miss."""
+        value = self.l1.get(key)
+        if value is not None:
+            return value, 'l1 hit'
+
+        # L2 values are (expiration time, value) so that L1 doesn't keep them
+        # past when they expire in L2
+        entry = self.l2.get(self._l2_key(key))
+        if entry is not None:
+            expires, value = entry
+            self.l1.set(key, value, timeout=self._l1_timeout(expires))
+            return value, 'l2 hit'
+
+        return None, 'miss'
+
+    def get(self, key):
+        value, stat = self._lookup(key)
+        if value is None and has_request_context():
+            leading = g.setdefault('cache_in_flight', [])
+            with self._in_flight_lock:
+                event = self._in_flight.get(key)
+                if not event:
+                    # we'll generate it. _finish_request releases it if we
+                    # don't end up setting it.
+                    self._in_flight[key] = threading.Event()
+                    leading.append((self, key))
+                elif (self, key) in leading:
+                    event = None
+
+            if event:
+                event.wait(SINGLE_FLIGHT_TIMEOUT)
+                value, stat = self._lookup(key)
+                if value is not None:
+                    stat = 'single flight hit'
+
+        self._count(stat)
+        return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self._l2_timeout(timeout)
+        expires = self._expires(timeout)
+        self.l1.set(key, value, timeout=self._l1_timeout(expires))
+        self.l2.set(self._l2_key(key), (expires, value), timeout=timeout)
+        self._release(key)
+        return True
+
+    def add(self, key, value, timeout=None):
+        timeout = self._l2_timeout(timeout)
+        expires = self._expires(timeout)
+        added = self.l2.add(self._l2_key(key), (expires, value), timeout=timeout)
+        if added:
+            self.l1.set(key, value, timeout=self._l1_timeout(expires))
+        return added
+
+    def delete(self, key):
+        self.l1.delete(key)
+        return self.l2.delete(self._l2_key(key))
+
+    def has(self, key):
+        return self.l1.has(key) or self.l2.has(self._l2_key(key))
+
+    def clear(self):
+        self.l1.clear()
+        return self.l2.clear()
+
+    def _release(self, key):
+        with self._in_flight_lock:
+            event = self._in_flight.pop(key, None)
+        if event:
+            event.set()
+
+    @staticmethod
+    def _finish_request(exception=None):
+        """Releases any keys this request was generating but didn't set."""
+        for cache, key in g.pop('cache_in_flight', []):
+            cache._release(key)
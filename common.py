@@ -1,16 +1,33 @@
 # coding=utf-8
 """Misc common utilities.
 """
-from base64 import b64encode
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import copy
 import datetime
+from email.utils import parsedate_to_datetime
+import functools
 from hashlib import sha256
 import itertools
 import logging
 import os
+import random
 import re
+import threading
 import urllib.parse
 
-from flask import request
+import cachetools
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+from flask import (
+    copy_current_request_context,
+    has_request_context,
+    make_response,
+    request,
+)
+from google.cloud import ndb
 from granary import as2, microformats2
 from httpsig.requests_auth import HTTPSignatureAuth
 import mf2util
@@ -18,10 +35,10 @@ from oauth_dropins.webutil import util, webmention
 from oauth_dropins.webutil.flask_util import error
 from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
-from werkzeug.exceptions import BadGateway
+from werkzeug.exceptions import BadGateway, HTTPException
 
 import common
-from models import Activity, User
+from models import Activity, Delivery, RemoteObject, User
 
 logger = logging.getLogger(__name__)
 
@@ -76,6 +93,67 @@ DOMAIN_BLOCKLIST = frozenset((
     'twitter.com',
 ) + DOMAINS)
 
+# max number of outbound HTTP requests to make at once while handling a single
+# incoming request, eg when delivering a post to all of a user's followers
+MAX_CONCURRENT_REQUESTS = 10
+
+# failed outbound deliveries are retried with jittered exponential backoff, up
+# to this many total attempts
+DELIVERY_MAX_ATTEMPTS = 10
+DELIVERY_RETRY_BASE = datetime.timedelta(minutes=1)
+DELIVERY_RETRY_MAX = datetime.timedelta(hours=6)
+# max number of Deliverys to queue in one transaction
+DELIVERY_ENQUEUE_BATCH_SIZE = 100
+
+# per-host circuit breaker for outbound requests. after this many consecutive
+# connection failures or timeouts, we stop sending requests to a host. after
+# HOST_RETRY_AFTER, we let a single probe request through, which either closes
+# the circuit again or re-opens it.
+HOST_FAILURE_THRESHOLD = 5
+HOST_RETRY_AFTER = datetime.timedelta(minutes=10)
+
+# maps host to dict with keys failures (int), opened (datetime or None),
+# probing (bool), skipped (int). guarded by _host_health_lock.
+_host_health = {}
+_host_health_lock = threading.Lock()
+
+# max number of ready-to-sign HTTP Signature auth objects to keep in memory
+SIGNATURE_AUTH_CACHE_SIZE = 1000
+
+# cache of remote AS2 objects fetched by get_as2. the in-memory tier maps URL
+# to RemoteObject and is guarded by _as2_cache_lock. stale entries are kept so
+# that we can revalidate them.
+AS2_CACHE_TTL = datetime.timedelta(hours=1)
+AS2_CACHE_SIZE = 5000
+AS2_CACHE_DATASTORE = True
+_as2_cache = cachetools.LRUCache(maxsize=AS2_CACHE_SIZE)
+_as2_cache_lock = threading.Lock()
+# counts of memory hit, datastore hit, miss, revalidated, changed, stale
+as2_cache_stats = collections.Counter()
+
+# remote actors' parsed public keys. maps HTTP Signature keyId to
+# (RsaKey, str owner actor id) tuple. guarded by _public_keys_lock.
+PUBLIC_KEY_CACHE_SIZE = 5000
+_public_keys = cachetools.LRUCache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+_public_keys_lock = threading.Lock()
+SIGNATURE_PARAM_RE = re.compile(r'(\w+)="([^"]*)"')
+# how far HTTP Signatures' Date headers may be in the future and the past
+SIGNATURE_CLOCK_SKEW = datetime.timedelta(hours=1)
+SIGNATURE_MAX_AGE = datetime.timedelta(hours=12)
+
+# webmention endpoint discovery cache. maps target URL to (endpoint, expires)
+# tuple, where endpoint is None if the target has none. also maps
+# 'domain DOMAIN' to the last endpoint discovered on that domain, which we use
+# for other URLs on the same domain. guarded by _endpoints_lock.
+ENDPOINT_CACHE_SIZE = 5000
+ENDPOINT_CACHE_TTL = datetime.timedelta(days=1)
+ENDPOINT_CACHE_NEGATIVE_TTL = datetime.timedelta(hours=1)
+_endpoints = cachetools.LRUCache(maxsize=ENDPOINT_CACHE_SIZE)
+_endpoints_lock = threading.Lock()
+# counts of url hit, fetch, domain fallback
+endpoint_cache_stats = collections.Counter()
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
 _DEFAULT_SIGNATURE_USER = None
 
 # alias allows unit tests to mock the function
@@ -131,16 +209,35 @@ def signed_request(fn, url, data=None, user=None, headers=None, **kwargs):
         'Digest': f'SHA-256={b64encode(sha256(data or b"").digest()).decode()}',
     })
 
-    domain = user.key.id()
-    logger.info(f"Signing with {domain}'s key")
-    key_id = request.host_url + domain
-    auth = HTTPSignatureAuth(secret=user.private_pem(), key_id=key_id,
-                             algorithm='rsa-sha256', sign_header='signature',
-                             headers=('Date', 'Host', 'Digest'))
+    host = util.domain_from_link(url, minimize=False)
+    if not host_available(host):
+        msg = f'Skipping {url} , {host} is unavailable'
+        if kwargs.get('gateway', True):
+            error(msg, status=504)
+        logger.warning(msg)
+        raise HostUnavailable(msg)
 
-    # make HTTP request
-    kwargs.setdefault('gateway', True)
-    resp = fn(url, auth=auth, headers=headers, **kwargs)
+    recorded = False
+    try:
+        domain = user.key.id()
+        logger.info(f"Signing with {domain}'s key")
+        auth = signature_auth(request.host_url + domain, user)
+
+        # make HTTP request
+        kwargs.setdefault('gateway', True)
+        try:
+            resp = fn(url, auth=auth, headers=headers, **kwargs)
+        except BaseException as e:
+            recorded = True
+            record_host_result(host, failed=is_connection_failure(e))
+            raise
+        recorded = True
+        record_host_result(host, failed=False)
+    finally:
+        if not recorded:
+            # we failed before sending. if this was the probe, let another
+            # request try.
+            end_probe(host)
 
     logger.info(f'Got {resp.status_code} headers: {resp.headers}')
     type = content_type(resp)
@@ -151,9 +248,425 @@ def signed_request(fn, url, data=None, user=None, headers=None, **kwargs):
     return resp
 
 
-def get_as2(url, user=None):
+class HostUnavailable(requests.ConnectionError):
+    """Raised instead of sending a request to a host whose circuit is open."""
+
+
+def host_available(host):
+    """Returns True if we should send a request to a host now, False otherwise.
+
+    If the host's circuit is open and HOST_RETRY_AFTER has passed, lets exactly
+    one caller through as a probe.
+
+    Args:
+      host: str domain
+    """
+    with _host_health_lock:
+        health = _host_health.get(host)
+        if not health or not health['opened']:
+            return True
+
+        if (not health['probing'] and
+                utcnow() >= health['opened'] + HOST_RETRY_AFTER):
+            logger.info(f'Probing unavailable host {host}')
+            health['probing'] = True
+            return True
+
+        health['skipped'] += 1
+        return False
+
+
+def end_probe(host):
+    """Lets another request probe a host, eg if the last probe wasn't sent.
+
+    Args:
+      host: str domain
+    """
+    with _host_health_lock:
+        health = _host_health.get(host)
+        if health:
+            health['probing'] = False
+
+
+def record_host_result(host, failed):
+    """Records the outcome of a request to a host for its circuit breaker.
+
+    Args:
+      host: str domain
+      failed: bool, whether the request failed to connect or timed out. Any
+        HTTP response, even an error, counts as success.
+    """
+    with _host_health_lock:
+        if not failed:
+            if _host_health.pop(host, None):
+                logger.info(f'{host} is available again')
+            return
+
+        health = _host_health.setdefault(host, {
+            'failures': 0,
+            'opened': None,
+            'probing': False,
+            'skipped': 0,
+        })
+        health['failures'] += 1
+        health['probing'] = False
+        if health['failures'] >= HOST_FAILURE_THRESHOLD:
+            if not health['opened']:
+                logger.warning(f'{host} failed {health["failures"]} times in a row, marking unavailable')
+            health['opened'] = utcnow()
+
+
+def host_health():
+    """Returns the hosts with recent connection failures, worst first.
+
+    Returns: list of dicts, each with a host key plus the keys described in
+      :data:`_host_health`
+    """
+    with _host_health_lock:
+        hosts = [{'host': host, **health} for host, health in _host_health.items()]
+    return sorted(hosts, key=lambda h: h['failures'], reverse=True)
+
+
+def is_connection_failure(e):
+    """Like :func:`util.is_connection_failure`, but also handles gateway errors.
+
+    :func:`util.requests_get` etc with ``gateway=True`` convert connection
+    failures to :class:`werkzeug.exceptions.HTTPException`, so we look at the
+    original exception.
+    """
+    return util.is_connection_failure(e) or (
+        e.__context__ is not None and util.is_connection_failure(e.__context__))
+
+
+def map_concurrently(fn, items, max_workers=None):
+    """Calls a function on each item, concurrently, in a bounded thread pool.
+
+    Each call gets its own copy of the current Flask request context, if any, so
+    fn can use :attr:`flask.request`. The ndb context is *not* shared, since it
+    isn't thread safe, so fn shouldn't touch the datastore.
+
+    Args:
+      fn: callable that takes a single item
+      items: sequence
+      max_workers: int, defaults to :const:`MAX_CONCURRENT_REQUESTS`
+
+    Returns: list of (result, exception) tuples, in the same order as items. One
+      element of each tuple is always None.
+    """
+    calls = [functools.partial(fn, item) for item in items]
+    if has_request_context():
+        calls = [copy_current_request_context(call) for call in calls]
+
+    def run(call):
+        try:
+            return call(), None
+        except BaseException as e:
+            return None, e
+
+    if len(calls) <= 1:
+        return [run(call) for call in calls]
+
+    with ThreadPoolExecutor(max_workers=max_workers or MAX_CONCURRENT_REQUESTS) as pool:
+        return list(pool.map(run, calls))
+
+
+def is_retryable(e):
+    """Returns True if a failed outbound HTTP request is worth retrying later.
+
+    Connection failures, timeouts, 5xx, 408, and 429 are retryable. Other 4xx
+    responses aren't.
+
+    Args:
+      e: :class:`BaseException`
+    """
+    if is_connection_failure(e):
+        return True
+
+    # util.requests_* with gateway=True wrap the original error as HTTP 502
+    if isinstance(e, HTTPException) and e.__context__ is not None:
+        e = e.__context__
+
+    code, _ = util.interpret_http_exception(e)
+    code = int(code) if code and str(code).isdigit() else None
+    return not (code and code // 100 == 4 and code not in (408, 429))
+
+
+def retry_delay(attempts):
+    """Returns how long to wait before the next attempt of a failed delivery.
+
+    Args:
+      attempts: int, number of attempts so far
+
+    Returns: :class:`datetime.timedelta`
+    """
+    delay = min(DELIVERY_RETRY_BASE * 2 ** (attempts - 1), DELIVERY_RETRY_MAX)
+    return delay * random.uniform(.5, 1)
+
+
+def enqueue_delivery(inbox, data, user, activities=(), error=None,
+                     content_hash=None):
+    """Queues a single ActivityPub delivery. See :func:`enqueue_deliveries`.
+
+    Args:
+      inbox: str URL
+      data: dict, AS2 activity
+      activities: sequence of :class:`Activity` to mark complete when delivery
+        succeeds, optional
+      user, error, content_hash: passed to :func:`enqueue_deliveries`
+
+    Returns: :class:`Delivery`
+    """
+    return enqueue_deliveries([(inbox, data, activities)], user, error=error,
+                              content_hash=content_hash)[0]
+
+
+def enqueue_deliveries(deliveries, user, error=None, content_hash=None):
+    """Queues ActivityPub deliveries to be sent by :func:`tasks.deliver`.
+
+    If ``error`` is provided, these are failed first attempts, and they're
+    retried after a delay. Otherwise they're sent the next time the task runs.
+
+    If the same activity is already pending for the same inbox, eg because the
+    sender retried its webmention, that :class:`Delivery` is updated instead of
+    queueing a duplicate. Deliveries are written in transactions of
+    :const:`DELIVERY_ENQUEUE_BATCH_SIZE`.
+
+    Args:
+      deliveries: sequence of (str inbox URL, dict AS2 activity, sequence of
+        :class:`Activity` to mark complete when delivery succeeds) tuples
+      user: :class:`User` to sign the requests with
+      error: :class:`BaseException` from the failed attempt, optional
+      content_hash: str, :meth:`Activity.mf2_content_hash` of the source being
+        delivered, optional
+
+    Returns: list of :class:`Delivery`, in the same order as deliveries
+    """
+    next_attempt = utcnow() + retry_delay(1) if error else utcnow()
+
+    @ndb.transactional()
+    def enqueue(batch):
+        ids = [Delivery._id(inbox, data) for inbox, data, _ in batch]
+        existing = iter(ndb.get_multi([ndb.Key(Delivery, id) for id in ids if id]))
+
+        queued = []
+        for id, (inbox, data, activities) in zip(ids, batch):
+            delivery = next(existing) if id else None
+            activity_keys = [a.key for a in activities]
+            if delivery and delivery.status == 'pending':
+                delivery.data = json_dumps(data)
+                delivery.domain = user.key.id()
+                delivery.activities += [key for key in activity_keys
+                                        if key not in delivery.activities]
+                if error:
+                    delivery.last_error = str(error)
+            else:
+                delivery = Delivery(id=id, inbox=inbox, domain=user.key.id(),
+                                    data=json_dumps(data),
+                                    host_url=request.host_url,
+                                    activities=activity_keys,
+                                    attempts=1 if error else 0,
+                                    next_attempt=next_attempt,
+                                    last_error=str(error) if error else None)
+            delivery.content_hash = content_hash
+            queued.append(delivery)
+
+        ndb.put_multi(queued)
+        return queued
+
+    queued = []
+    for i in range(0, len(deliveries), DELIVERY_ENQUEUE_BATCH_SIZE):
+        queued.extend(enqueue(deliveries[i:i + DELIVERY_ENQUEUE_BATCH_SIZE]))
+
+    logger.info(f'Queued {len(queued)} deliveries for {next_attempt}')
+    return queued
+
+
+@cachetools.cached(cachetools.LRUCache(maxsize=SIGNATURE_AUTH_CACHE_SIZE),
+                   key=lambda key_id, user: cachetools.keys.hashkey(key_id, user.mod),
+                   lock=threading.Lock())
+def signature_auth(key_id, user):
+    """Returns a reusable HTTP Signature auth object for a user's key.
+
+    Parsing the private key is expensive, so these are cached by key id and
+    the user's key modulus, which changes if the user's key changes.
+
+    Args:
+      key_id: str, HTTP Signature keyId
+      user: :class:`User`
+
+    Returns: :class:`HTTPSignatureAuth`
+    """
+    return HTTPSignatureAuth(secret=user.private_pem(), key_id=key_id,
+                             algorithm='rsa-sha256', sign_header='signature',
+                             headers=('Date', 'Host', 'Digest'))
+
+
+def verify_signature(user=None, fetch=True):
+    """Verifies the current request's HTTP Signature, if it has one.
+
+    Supports rsa-sha256 (and hs2019 with RSA keys). The Date header must be
+    signed and within :const:`SIGNATURE_CLOCK_SKEW` in the future and
+    :const:`SIGNATURE_MAX_AGE` in the past, and POSTs must sign a Digest header
+    that matches the body. Remote public keys are fetched from the keyId with
+    :func:`get_as2` and kept in memory, parsed. If a cached key doesn't verify,
+    we refetch it once in case it was rotated.
+
+    https://tools.ietf.org/html/draft-cavage-http-signatures-07
+
+    Args:
+      user: :class:`User` to sign key fetches with
+      fetch: boolean, whether to fetch the key if we don't already have it.
+        If False, only keys cached in memory or stored in the datastore are
+        used, eg for actor Deletes, since deleted actors' keys return 410.
+
+    Returns: str id of the actor who owns the signing key, or None if the
+      request isn't signed
+
+    Raises: :class:`werkzeug.exceptions.HTTPException` with status 401 if the
+      signature is invalid or we can't fetch its key
+    """
+    header = request.headers.get('Signature')
+    if not header:
+        logger.info('No HTTP Signature')
+        return None
+
+    params = dict(SIGNATURE_PARAM_RE.findall(header))
+    key_id = params.get('keyId')
+    signature = params.get('signature')
+    if not key_id or not signature:
+        error(f'Invalid Signature header: {header}', status=401)
+    if params.get('algorithm', 'rsa-sha256') not in ('rsa-sha256', 'hs2019'):
+        error(f'Unsupported HTTP Signature algorithm {params["algorithm"]}', status=401)
+
+    signed = params.get('headers', 'date').lower().split()
+    if 'date' not in signed:
+        error('HTTP Signature must include Date', status=401)
+    if request.method == 'POST' and 'digest' not in signed:
+        error('HTTP Signature must include Digest', status=401)
+
+    date = request.headers.get('Date')
+    try:
+        date = parsedate_to_datetime(date)
+    except (TypeError, ValueError):
+        error(f"Couldn't parse Date header {date}", status=401)
+    if date.tzinfo:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    now = utcnow()
+    if not now - SIGNATURE_MAX_AGE <= date <= now + SIGNATURE_CLOCK_SKEW:
+        error(f'Date header {date} is too far from now', status=401)
+
+    digest = request.headers.get('Digest')
+    if digest:
+        expected = f'SHA-256={b64encode(sha256(request.get_data()).digest()).decode()}'
+        if digest != expected:
+            error(f'Digest header {digest} does not match body', status=401)
+
+    lines = []
+    for name in signed:
+        if name == '(request-target)':
+            path = request.path
+            if request.query_string:
+                path += '?' + request.query_string.decode()
+            value = f'{request.method.lower()} {path}'
+        else:
+            value = request.headers.get(name)
+            if value is None:
+                error(f'Signed header {name} is missing', status=401)
+        lines.append(f'{name}: {value}')
+    hashed = SHA256.new('\n'.join(lines).encode())
+
+    try:
+        signature = b64decode(signature)
+    except ValueError:
+        error(f'Invalid signature {signature}', status=401)
+
+    def verify(key):
+        try:
+            pkcs1_15.new(key).verify(hashed, signature)
+            return True
+        except (TypeError, ValueError):
+            return False
+
+    for refresh in False, True:
+        try:
+            key, owner, fetched = public_key(key_id, user=user, refresh=refresh,
+                                             fetch=fetch)
+        except (requests.RequestException, HTTPException, ValueError) as e:
+            error(f"Couldn't fetch public key {key_id}: {e}", status=401)
+
+        if verify(key):
+            logger.info(f'Verified HTTP Signature from {key_id}, owned by {owner}')
+            return owner
+        elif fetched or not fetch:
+            break
+        logger.info(f'HTTP Signature failed with cached key for {key_id}, refetching')
+
+    error(f'Invalid HTTP Signature from {key_id}', status=401)
+
+
+def public_key(key_id, user=None, refresh=False, fetch=True):
+    """Returns a remote actor's parsed RSA public key and its owner.
+
+    The owner is the id of the actor document that keyId resolves to. It has
+    to be on the same host as keyId, so that one server can't claim another
+    server's actors.
+
+    Args:
+      key_id: str, HTTP Signature keyId, usually the actor id plus a fragment
+      user: :class:`User` to sign the fetch with
+      refresh: boolean, whether to bypass the cache
+      fetch: boolean, whether to fetch the key if it's not in memory. If False,
+        falls back to the stored copy of the keyId's actor, however old.
+
+    Returns: (:class:`Crypto.PublicKey.RSA.RsaKey`, str owner, boolean) tuple.
+      The boolean is True if the key was just fetched, False if it came from
+      the cache.
+
+    Raises: :class:`ValueError` if the actor doesn't have a usable key, or if
+      fetch is False and we don't have one
+    """
+    if not refresh or not fetch:
+        with _public_keys_lock:
+            cached = _public_keys.get(key_id)
+        if cached:
+            return (*cached, False)
+
+    if fetch:
+        actor = get_as2(key_id, user=user, refresh=refresh).json()
+    else:
+        with _as2_cache_lock:
+            stored = _as2_cache.get(key_id)
+        if not stored and AS2_CACHE_DATASTORE:
+            stored = RemoteObject.get_by_id(key_id)
+        if not stored:
+            raise ValueError(f"Don't have {key_id} stored and not fetching it")
+        actor = json_loads(stored.content)
+
+    keys = [k for k in util.get_list(actor, 'publicKey') if isinstance(k, dict)]
+    pem = ([k.get('publicKeyPem') for k in keys if k.get('id') == key_id] or
+           [k.get('publicKeyPem') for k in keys] or [None])[0]
+    if not pem:
+        raise ValueError(f'{key_id} has no publicKeyPem')
+
+    owner = actor.get('id')
+    if (not isinstance(owner, str) or
+            urllib.parse.urlparse(owner).netloc != urllib.parse.urlparse(key_id).netloc):
+        raise ValueError(f"{key_id}'s actor id {owner} isn't on the same host")
+
+    key = RSA.import_key(pem)
+    with _public_keys_lock:
+        _public_keys[key_id] = (key, owner)
+    return key, owner, fetch
+
+
+def get_as2(url, user=None, refresh=False):
     """Tries to fetch the given URL as ActivityStreams 2.
 
+    Successful responses are cached for :const:`AS2_CACHE_TTL`, in memory and
+    optionally in the datastore as :class:`RemoteObject` entities. After that,
+    they're revalidated with a conditional request if they had an ETag or
+    Last-Modified. refresh=True skips the cache and always fetches.
+
     Uses HTTP content negotiation via the Content-Type header. If the url is
     HTML and it has a rel-alternate link with an AS2 content type, fetches and
     returns that URL.
@@ -171,6 +684,7 @@ def get_as2(url, user=None):
     Args:
         url: string
         user: :class:`User` used to sign request
+        refresh: boolean, whether to bypass the cache
 
     Returns:
         :class:`requests.Response`
@@ -181,6 +695,34 @@ def get_as2(url, user=None):
         If we raise a werkzeug HTTPException, it will have an additional
         requests_response attribute with the last requests.Response we received.
     """
+    cached = None
+    if not refresh:
+        with _as2_cache_lock:
+            cached = _as2_cache.get(url)
+    if cached:
+        as2_cache_stats['memory hit'] += 1
+    elif AS2_CACHE_DATASTORE and not refresh:
+        cached = RemoteObject.get_by_id(url)
+        if cached:
+            as2_cache_stats['datastore hit'] += 1
+            with _as2_cache_lock:
+                _as2_cache[url] = cached
+
+    if cached:
+        if utcnow() - cached.fetched < AS2_CACHE_TTL:
+            return _as2_response(cached)
+        resp = _revalidate_as2(cached, user)
+        if resp:
+            return resp
+
+    as2_cache_stats['miss'] += 1
+    resp = _fetch_as2(url, user)
+    _cache_as2(url, resp)
+    return resp
+
+
+def _fetch_as2(url, user):
+    """Fetches a URL as AS2, uncached. See :func:`get_as2` for details."""
     def _error(resp):
         msg = "Couldn't fetch %s as ActivityStreams 2" % url
         logger.warning(msg)
@@ -206,6 +748,75 @@ def get_as2(url, user=None):
     _error(resp)
 
 
+def _revalidate_as2(cached, user):
+    """Revalidates a stale cached AS2 object with a conditional request.
+
+    Args:
+      cached: :class:`RemoteObject`
+      user: :class:`User` used to sign request
+
+    Returns: :class:`requests.Response`, or None if the object changed or we
+      can't revalidate it and it needs a full fetch
+    """
+    headers = copy.copy(CONNEG_HEADERS_AS2)
+    if cached.etag:
+        headers['If-None-Match'] = cached.etag
+    if cached.last_modified:
+        headers['If-Modified-Since'] = cached.last_modified
+    if len(headers) == len(CONNEG_HEADERS_AS2):
+        return None
+
+    try:
+        resp = signed_get(cached.url, user=user, headers=headers, gateway=False)
+    except requests.RequestException as e:
+        # serve stale rather than fail
+        logger.info(f"Couldn't revalidate {cached.url}, using stale copy: {e}")
+        as2_cache_stats['stale'] += 1
+        return _as2_response(cached)
+
+    if resp.status_code == 304:
+        as2_cache_stats['revalidated'] += 1
+        cached.fetched = utcnow()
+        if AS2_CACHE_DATASTORE:
+            cached.put()
+        return _as2_response(cached)
+
+    if (resp.status_code == 200 and
+            content_type(resp) in (CONTENT_TYPE_AS2, CONTENT_TYPE_AS2_LD)):
+        as2_cache_stats['changed'] += 1
+        _cache_as2(cached.key.id(), resp)
+        return resp
+
+
+def _cache_as2(url, resp):
+    """Stores a successful AS2 response in both tiers of the cache.
+
+    Args:
+      url: str, the URL originally requested
+      resp: :class:`requests.Response`
+    """
+    obj = RemoteObject(id=url, url=resp.url or url, content=resp.text,
+                       content_type=resp.headers.get('Content-Type'),
+                       etag=resp.headers.get('ETag'),
+                       last_modified=resp.headers.get('Last-Modified'),
+                       fetched=utcnow())
+    with _as2_cache_lock:
+        _as2_cache[url] = obj
+    if AS2_CACHE_DATASTORE:
+        obj.put()
+
+
+def _as2_response(cached):
+    """Returns a :class:`requests.Response` for a cached :class:`RemoteObject`."""
+    resp = requests.Response()
+    resp.status_code = 200
+    resp.url = cached.url
+    resp.encoding = 'utf-8'
+    resp._content = cached.content.encode()
+    resp.headers['Content-Type'] = cached.content_type
+    return resp
+
+
 def content_type(resp):
     """Returns a :class:`requests.Response`'s Content-Type, without charset suffix."""
     type = resp.headers.get('Content-Type')
@@ -274,34 +885,45 @@ def send_webmentions(activity_wrapped, proxy=None, **activity_props):
 
     logger.info(f'targets: {targets}')
 
-    # send webmentions and store Activitys
-    errors = []  # stores (code, body) tuples
+    # store Activitys, then discover endpoints and send webmentions concurrently
+    activities = []
     for target in targets:
         domain = util.domain_from_link(target, minimize=False)
         if (domain == util.domain_from_link(source, minimize=False)):
             logger.info(f'Skipping same-domain webmention from {source} to {target}')
             continue
-
-        activity = Activity(source=source, target=target, direction='in',
-                            domain=[domain], **activity_props)
-        activity.put()
-        wm_source = (activity.proxy_url()
-                     if verb in ('follow', 'like', 'share') or proxy
-                     else source)
+        activities.append((Activity(source=source, target=target, direction='in',
+                                    domain=[domain], **activity_props),
+                           target))
+    ndb.put_multi([activity for activity, _ in activities])
+
+    # proxy_url reads source_* properties, which may load Snapshots, so do it
+    # here instead of in the worker threads, which don't have an ndb context
+    use_proxy = verb in ('follow', 'like', 'share') or proxy
+    wm_sources = [activity.proxy_url() if use_proxy else source
+                  for activity, _ in activities]
+
+    def send(activity_target_source):
+        activity, target, wm_source = activity_target_source
         logger.info(f'Sending webmention from {wm_source} to {target}')
+        endpoint = discover_webmention_endpoint(target)
+        if endpoint:
+            webmention.send(endpoint, wm_source, target)
+            logger.info(f'Sent webmention to {target}')
+            return 'complete'
+        logger.info(f'No webmention endpoint for {target}, ignoring.')
+        return 'ignored'
 
-        try:
-            endpoint = webmention.discover(target).endpoint
-            if endpoint:
-                webmention.send(endpoint, wm_source, target)
-                activity.status = 'complete'
-                logger.info('Success!')
-            else:
-                activity.status = 'ignored'
-                logger.info('Ignoring.')
-        except BaseException as e:
+    errors = []  # stores (code, body) tuples
+    results = map_concurrently(send, [(activity, target, wm_source) for
+                                      (activity, target), wm_source
+                                      in zip(activities, wm_sources)])
+    for (activity, _), (status, e) in zip(activities, results):
+        if e:
             errors.append(util.interpret_http_exception(e))
-        activity.put()
+        else:
+            activity.status = status
+    ndb.put_multi([activity for activity, _ in activities])
 
     if errors:
         msg = 'Errors: ' + ', '.join(f'{code} {body}' for code, body in errors)
@@ -310,6 +932,68 @@ def send_webmentions(activity_wrapped, proxy=None, **activity_props):
     return True
 
 
+def discover_webmention_endpoint(url):
+    """Discovers a URL's webmention endpoint, with caching.
+
+    Successful results are cached per URL, including "no endpoint," for the
+    response's Cache-Control max-age if it has one, otherwise for
+    :const:`ENDPOINT_CACHE_TTL` or :const:`ENDPOINT_CACHE_NEGATIVE_TTL`. Non-2xx
+    responses and failures aren't cached.
+
+    Endpoints are also remembered per domain for :const:`ENDPOINT_CACHE_TTL`,
+    but only as a fallback for other URLs on that domain when fetching them
+    fails or returns 5xx, since sites almost always use a single endpoint.
+
+    Args:
+      url: str
+
+    Returns: str endpoint, or None if url doesn't have one
+
+    Raises: same as :func:`webmention.discover`, and :class:`requests.HTTPError`
+      if url returns 5xx without an endpoint
+    """
+    now = utcnow()
+    domain_key = f'domain {util.domain_from_link(url, minimize=False)}'
+    with _endpoints_lock:
+        cached = _endpoints.get(url)
+        if cached and cached[1] > now:
+            endpoint_cache_stats['url hit'] += 1
+            return cached[0]
+
+    endpoint_cache_stats['fetch'] += 1
+    try:
+        endpoint, resp = webmention.discover(url)
+        if not endpoint and resp.status_code // 100 == 5:
+            resp.raise_for_status()
+    except requests.RequestException:
+        with _endpoints_lock:
+            cached = _endpoints.get(domain_key)
+        if cached and cached[1] > now:
+            logger.info(f'Discovery failed for {url}, falling back to domain endpoint {cached[0]}')
+            endpoint_cache_stats['domain fallback'] += 1
+            return cached[0]
+        raise
+
+    if not resp.ok:
+        return endpoint
+
+    ttl = ENDPOINT_CACHE_TTL if endpoint else ENDPOINT_CACHE_NEGATIVE_TTL
+    cache_control = resp.headers.get('Cache-Control', '')
+    max_age = MAX_AGE_RE.search(cache_control)
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        ttl = None
+    elif max_age:
+        ttl = min(ttl, datetime.timedelta(seconds=int(max_age.group(1))))
+
+    with _endpoints_lock:
+        if ttl:
+            _endpoints[url] = (endpoint, now + ttl)
+        if endpoint:
+            _endpoints[domain_key] = (endpoint, now + ENDPOINT_CACHE_TTL)
+
+    return endpoint
+
+
 def postprocess_as2(activity, user=None, target=None):
     """Prepare an AS2 object to be served or sent via ActivityPub.
 
@@ -458,6 +1142,40 @@ def postprocess_as2_actor(actor, user=None):
     return actor
 
 
+def conditional(max_age):
+    """Decorator that supports conditional requests for a view function.
+
+    Adds a strong ETag generated from the response body, if the view didn't
+    set one, and ``Cache-Control: public, max-age=...``, if the view didn't
+    set Cache-Control. Answers matching ``If-None-Match`` and, if the view set
+    ``Last-Modified``, ``If-Modified-Since`` with 304 Not Modified. Only
+    affects 200 responses.
+
+    Use above :func:`flask_util.cached` so that cached responses are checked
+    too.
+
+    Args:
+      max_age: :class:`datetime.timedelta`
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            resp = make_response(fn(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+
+            if not resp.get_etag()[0]:
+                resp.add_etag()
+            if 'Cache-Control' not in resp.headers:
+                resp.cache_control.public = True
+                resp.cache_control.max_age = int(max_age.total_seconds())
+            return resp.make_conditional(request)
+
+        return wrapper
+
+    return decorator
+
+
 def redirect_wrap(url):
     """Returns a URL on our domain that redirects to this URL.
 
@@ -489,6 +1207,10 @@ def redirect_unwrap(val):
 
     Strings that aren't wrapped URLs are left unchanged.
 
+    /r/ URLs that wrap a fully qualified URL are unwrapped without any network
+    requests. Only bare domains, eg actor ids like https://fed.brid.gy/foo.com,
+    are resolved with :func:`util.follow_redirects`, which caches its results.
+
     Args:
       url: string
 
@@ -503,7 +1225,11 @@ def redirect_unwrap(val):
     elif isinstance(val, str):
         prefix = urllib.parse.urljoin(request.host_url, '/r/')
         if val.startswith(prefix):
-            return util.follow_redirects(val[len(prefix):]).url
+            # same normalization as redirect.redir
+            unwrapped = re.sub(r'^(https?:/)([^/])', r'\1/\2', val[len(prefix):])
+            if util.is_web(unwrapped):
+                return unwrapped
+            return util.follow_redirects(unwrapped).url
         elif val.startswith(request.host_url):
             domain = util.domain_from_link(urllib.parse.urlparse(val).path.strip('/'),
                                            minimize=False)
@@ -2,6 +2,8 @@
 
 https://flask.palletsprojects.com/en/latest/config/
 """
+import os
+
 from oauth_dropins.webutil import appengine_info, util
 
 # This is primarily for flashed messages, since we don't use session data
@@ -11,11 +13,36 @@ SESSION_COOKIE_HTTPONLY = True
 # Change to Lax if/when we add IndieAuth for anything.
 SESSION_COOKIE_SAMESITE = 'Strict'
 
+# max number of InboxItems the /cron/process-inbox task processes at once
+INBOX_CONCURRENCY = 10
+
 if appengine_info.DEBUG:
   ENV = 'development'
   CACHE_TYPE = 'NullCache'
   SECRET_KEY = 'sooper seekret'
+  # handle inbound ActivityPub activities during the inbox request
+  INBOX_QUEUE = 'inline'
+  # send Creates and Updates to followers' inboxes during the webmention request
+  DELIVERY_QUEUE = 'inline'
+  # accept inbox deliveries without an HTTP Signature. Deletes of known
+  # actors still need one.
+  INBOX_REQUIRE_SIGNATURES = False
 else:
   ENV = 'production'
-  CACHE_TYPE = 'SimpleCache'
+  # in-process L1 in front of memcached shared across instances, eg Memorystore.
+  # MEMCACHED_SERVERS is comma-separated host:port. see caching.py.
+  CACHE_TYPE = 'caching.TwoLevelCache'
+  CACHE_MEMCACHED_SERVERS = [
+    s for s in os.getenv('MEMCACHED_SERVERS', '').split(',') if s]
+  if not CACHE_MEMCACHED_SERVERS:
+    # otherwise each instance silently gets its own in-process L2
+    raise RuntimeError('MEMCACHED_SERVERS env var is required in production. see app.yaml.')
   SECRET_KEY = util.read('flask_secret_key')
+  # store inbound ActivityPub activities as InboxItems, return 202, and
+  # process them in the /cron/process-inbox task
+  INBOX_QUEUE = 'datastore'
+  # queue Creates and Updates to followers' inboxes as Deliverys, return 202,
+  # and send them in the /cron/deliver task
+  DELIVERY_QUEUE = 'datastore'
+  # reject inbox deliveries without an HTTP Signature
+  INBOX_REQUIRE_SIGNATURES = True
@@ -1,16 +1,22 @@
 """Datastore model classes."""
 import difflib
+import functools
+from hashlib import sha256
 import logging
+import random
+import threading
 import urllib.parse
 
+import cachetools
 import requests
 from werkzeug.exceptions import BadRequest, NotFound
 
 from Crypto.PublicKey import RSA
 from django_salmon import magicsigs
 from flask import request
+from markupsafe import Markup
 from google.cloud import ndb
-from granary import as2, microformats2
+from granary import as2, atom, microformats2
 from oauth_dropins.webutil.models import StringIdModel
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.util import json_dumps, json_loads
@@ -19,6 +25,44 @@ import common
 
 logger = logging.getLogger(__name__)
 
+# max number of users whose exported PEM keys we keep in memory
+PEM_CACHE_SIZE = 1000
+
+# how many pooled key pairs to consider when taking one, to reduce contention
+KEY_POOL_TAKE_CANDIDATES = 10
+
+# for Activity summaries, the phrase we show for each verb or object type
+SUMMARY_PHRASES = {
+    'article': 'posted',
+    'note': 'posted',
+    'post': 'posted',
+    'comment': 'replied',
+    'like': 'liked',
+    'follow': 'followed',
+    'repost': 'reposted',
+    'share': 'reposted',
+    'rsvp-yes': 'is attending',
+    'rsvp-no': 'is not attending',
+    'rsvp-maybe': 'might attend',
+    'rsvp-interested': 'is interested in',
+    'invite': 'is invited to',
+}
+SUMMARY_CONTENT_LENGTH = 200
+
+# content-addressed Snapshots. maps hash to text, for snapshots we've stored or
+# loaded. guarded by _snapshots_lock.
+SNAPSHOT_PREFIX = 'sha256:'
+SNAPSHOT_CACHE_SIZE = 1000
+_snapshots = cachetools.LRUCache(maxsize=SNAPSHOT_CACHE_SIZE)
+_snapshots_lock = threading.Lock()
+
+# Activity summaries we've generated, by source hash. the same source is often
+# stored in many Activitys, so this lets us convert it only once. guarded by
+# _summaries_lock.
+SUMMARY_CACHE_SIZE = 1000
+_summaries = cachetools.LRUCache(maxsize=SUMMARY_CACHE_SIZE)
+_summaries_lock = threading.Lock()
+
 
 class User(StringIdModel):
     """Stores a Bridgy Fed user.
@@ -47,20 +91,17 @@ class User(StringIdModel):
         return 'MagicKey'
 
     @staticmethod
-    @ndb.transactional()
     def get_or_create(domain):
         """Loads and returns a User. Creates it if necessary."""
         user = User.get_by_id(domain)
+        if user:
+            return user
 
-        if not user:
-            # this uses urandom(), and does nontrivial math, so it can take a
-            # while depending on the amount of randomness available.
-            pubexp, mod, privexp = magicsigs.generate()
-            user = User(id=domain, mod=mod, public_exponent=pubexp,
-                        private_exponent=privexp)
-            user.put()
-
-        return user
+        # get the key pair outside the transaction, since generating one can
+        # be slow
+        pubexp, mod, privexp = KeyPair.take()
+        return User.get_or_insert(domain, mod=mod, public_exponent=pubexp,
+                                  private_exponent=privexp)
 
     def href(self):
         return 'data:application/magic-public-key,RSA.%s.%s' % (
@@ -68,16 +109,12 @@ class User(StringIdModel):
 
     def public_pem(self):
         """Returns: bytes"""
-        rsa = RSA.construct((magicsigs.base64_to_long(str(self.mod)),
-                             magicsigs.base64_to_long(str(self.public_exponent))))
-        return rsa.exportKey(format='PEM')
+        return _export_pem(str(self.mod), str(self.public_exponent))
 
     def private_pem(self):
         """Returns: bytes"""
-        rsa = RSA.construct((magicsigs.base64_to_long(str(self.mod)),
-                             magicsigs.base64_to_long(str(self.public_exponent)),
-                             magicsigs.base64_to_long(str(self.private_exponent))))
-        return rsa.exportKey(format='PEM')
+        return _export_pem(str(self.mod), str(self.public_exponent),
+                           str(self.private_exponent))
 
     def username(self):
         """Returns the user's preferred username from an acct: url, if available.
@@ -157,12 +194,164 @@ class User(StringIdModel):
             self.has_hcard = False
 
 
+class KeyPair(ndb.Model):
+    """A pre-generated RSA key pair, waiting to be used by a new :class:`User`.
+
+    Key generation uses urandom(), and does nontrivial math, so it can take a
+    while depending on the amount of randomness available. We keep a pool of
+    these, refilled in the background by :func:`tasks.refill_key_pool`, to keep
+    it off the request path.
+
+    Properties are encoded the same way as :class:`User`'s.
+    """
+    mod = ndb.StringProperty(required=True)
+    public_exponent = ndb.StringProperty(required=True)
+    private_exponent = ndb.StringProperty(required=True)
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def generate(cls):
+        """Generates a new key pair. Doesn't store it.
+
+        Returns: :class:`KeyPair`
+        """
+        pubexp, mod, privexp = magicsigs.generate()
+        return cls(mod=mod, public_exponent=pubexp, private_exponent=privexp)
+
+    @classmethod
+    def take(cls):
+        """Removes a key pair from the pool and returns it.
+
+        Generates a new key pair if the pool is empty.
+
+        Returns: (public exponent, modulus, private exponent) tuple of str
+        """
+        keys = cls.query().fetch(KEY_POOL_TAKE_CANDIDATES, keys_only=True)
+        random.shuffle(keys)
+        for key in keys:
+            pair = cls._take(key)
+            if pair:
+                return pair
+
+        logger.info('Key pair pool is empty, generating a new key pair')
+        pair = cls.generate()
+        return pair.public_exponent, pair.mod, pair.private_exponent
+
+    @staticmethod
+    @ndb.transactional()
+    def _take(key):
+        """Deletes and returns a pooled key pair, or None if it's already gone."""
+        pair = key.get()
+        if pair:
+            key.delete()
+            return pair.public_exponent, pair.mod, pair.private_exponent
+
+
+@functools.lru_cache(maxsize=PEM_CACHE_SIZE)
+def _export_pem(*parts):
+    """Builds an RSA key from base64url magic signature parts and exports it.
+
+    Memoized since RSA construction and PEM export are relatively expensive and
+    we do them on every signed request and actor fetch.
+
+    Args:
+      parts: str modulus, public exponent, and optionally private exponent
+
+    Returns: bytes
+    """
+    rsa = RSA.construct([magicsigs.base64_to_long(part) for part in parts])
+    return rsa.exportKey(format='PEM')
+
+
+class Snapshot(StringIdModel):
+    """Immutable text, eg a source post's JSON, stored once and shared.
+
+    Key name is the SHA-256 hex digest of the text. Referenced by
+    :class:`SnapshotProperty`.
+    """
+    data = ndb.TextProperty(required=True)
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def hash(text):
+        return sha256(text.encode()).hexdigest()
+
+    @staticmethod
+    def store(text):
+        """Stores text as a Snapshot if it isn't already stored.
+
+        Args:
+          text: str
+
+        Returns: str hash
+        """
+        digest = Snapshot.hash(text)
+        with _snapshots_lock:
+            if digest in _snapshots:
+                return digest
+
+        if not Snapshot.get_by_id(digest):
+            Snapshot(id=digest, data=text).put()
+
+        # only cache once the put is durable. if we're in a transaction, eg
+        # Activity.get_or_insert's, and it's retried, the retry has to put again.
+        def cache():
+            with _snapshots_lock:
+                _snapshots[digest] = text
+
+        ndb.get_context().call_on_commit(cache)
+        return digest
+
+    @staticmethod
+    def load(digest):
+        """Returns a Snapshot's text, or None if it doesn't exist.
+
+        Args:
+          digest: str
+        """
+        with _snapshots_lock:
+            text = _snapshots.get(digest)
+        if text is None:
+            snapshot = Snapshot.get_by_id(digest)
+            if not snapshot:
+                return None
+            text = snapshot.data
+            with _snapshots_lock:
+                _snapshots[digest] = text
+        return text
+
+
+class SnapshotProperty(ndb.TextProperty):
+    """A text property whose value is stored in a shared :class:`Snapshot`.
+
+    The entity itself only stores a ``sha256:HASH`` reference, which is
+    resolved transparently when the property is read. Values stored inline
+    before this existed are returned as is. Models that use this must call
+    :meth:`Snapshot.store` on its values in their ``_pre_put_hook``.
+    """
+    def _to_base_type(self, value):
+        if value and not value.startswith(SNAPSHOT_PREFIX):
+            return SNAPSHOT_PREFIX + Snapshot.hash(value)
+
+    def _from_base_type(self, value):
+        if value.startswith(SNAPSHOT_PREFIX):
+            digest = value[len(SNAPSHOT_PREFIX):]
+            text = Snapshot.load(digest)
+            if text is None:
+                logger.warning(f'Snapshot {digest} not found')
+                return ''
+            return text
+
+
 class Activity(StringIdModel):
     """A reply, like, repost, or other interaction that we've relayed.
 
     Key name is 'SOURCE_URL TARGET_URL', e.g. 'http://a/reply http://orig/post'.
     """
-    STATUSES = ('new', 'complete', 'error', 'ignored')
+    # queued means it's waiting in a Delivery, see common.enqueue_deliveries
+    STATUSES = ('new', 'queued', 'complete', 'error', 'ignored')
     PROTOCOLS = ('activitypub', 'ostatus')
     DIRECTIONS = ('out', 'in')
 
@@ -172,19 +361,132 @@ class Activity(StringIdModel):
     protocol = ndb.StringProperty(choices=PROTOCOLS)
     direction = ndb.StringProperty(choices=DIRECTIONS)
 
-    # usually only one of these at most will be populated.
-    source_mf2 = ndb.TextProperty()  # JSON
-    source_as2 = ndb.TextProperty()  # JSON
-    source_atom = ndb.TextProperty()
+    # usually only one of these at most will be populated. the same source is
+    # often stored in many Activitys, eg one per follower inbox, so they're
+    # stored once in Snapshots.
+    source_mf2 = SnapshotProperty()  # JSON
+    source_as2 = SnapshotProperty()  # JSON
+    source_atom = SnapshotProperty()
     target_as2 = ndb.TextProperty()  # JSON
+    # digest of the content we last delivered, from mf2_content_hash
+    content_hash = ndb.StringProperty()
+    # display fields for the UI, precomputed from the source. see summarize()
+    summary = ndb.JsonProperty()
 
     created = ndb.DateTimeProperty(auto_now_add=True)
     updated = ndb.DateTimeProperty(auto_now=True)
 
+    # set to True to keep updated as is when storing, eg in migrations, since
+    # the user page sorts by it
+    keep_updated = False
+
     @classmethod
     def _get_kind(cls):
         return 'Response'
 
+    def _pre_put_hook(self):
+        for text in self.source_mf2, self.source_as2, self.source_atom:
+            if text:
+                Snapshot.store(text)
+
+        source_hash = self._source_hash()
+        if not self.summary or self.summary.get('source_hash') != source_hash:
+            with _summaries_lock:
+                summary = _summaries.get(source_hash)
+            if summary is None:
+                try:
+                    summary = {**self.summarize(), 'source_hash': source_hash}
+                except BaseException:
+                    # don't block storing the activity. the UI summarizes it
+                    # on the fly instead.
+                    logger.warning(f"Couldn't summarize {self.key}", exc_info=True)
+                    self.summary = None
+                    return
+                with _summaries_lock:
+                    _summaries[source_hash] = summary
+            self.summary = dict(summary)
+
+    def _source_hash(self):
+        """Returns a digest of this activity's source_* values."""
+        return Snapshot.hash('\n'.join(
+            text or '' for text in (self.source_mf2, self.source_as2,
+                                    self.source_atom)))
+
+    def summarize(self):
+        """Generates the fields we show for this activity in the UI.
+
+        Returns: dict with keys:
+          phrase: str HTML, eg 'liked', or None
+          content: str plain text snippet, or None
+          url: str, or None
+          actor: dict with url, name, and image keys, all str or None
+          ids: list of str ids and URLs, for de-duping
+        """
+        a = self.to_as1() or {}
+
+        verb = a.get('verb') or a.get('objectType')
+        obj = util.get_first(a, 'object') or {}
+        if isinstance(obj, str):
+            obj = {'id': obj}
+
+        phrase = SUMMARY_PHRASES.get(verb)
+
+        obj_content = obj.get('content') or obj.get('displayName')
+        obj_url = util.get_first(obj, 'url')
+        if obj_url:
+            obj_content = util.pretty_link(obj_url, text=obj_content)
+
+        content = a.get('content') or a.get('displayName')
+        url = util.get_first(a, 'url')
+
+        if verb in ('like', 'follow', 'repost', 'share') or not content:
+            if url:
+                phrase = util.pretty_link(url, text=phrase)
+            if obj_content:
+                content = obj_content
+                url = obj_url
+
+        actor = util.get_first(a, 'actor') or util.get_first(a, 'author') or {}
+        if isinstance(actor, str):
+            actor = {'url': actor}
+
+        return {
+            'phrase': phrase,
+            'content': (util.ellipsize(Markup(content).striptags(),
+                                       words=SUMMARY_CONTENT_LENGTH,
+                                       chars=SUMMARY_CONTENT_LENGTH)
+                        if content else None),
+            'url': url,
+            'actor': {
+                'url': util.get_first(actor, 'url'),
+                'name': actor.get('displayName'),
+                'image': util.get_url(actor, 'image'),
+            },
+            'ids': [a[field] for field in ('id', 'url') if a.get(field)],
+        }
+
+    def _prepare_for_put(self):
+        updated = self.updated
+        super()._prepare_for_put()
+        if self.keep_updated and updated:
+            self.updated = updated
+
+    @staticmethod
+    def mf2_content_hash(mf2):
+        """Returns a digest of the content of the first item in parsed mf2.
+
+        Args:
+          mf2: dict, parsed mf2
+
+        Returns: str SHA-256 hex digest, or None if there's no content
+        """
+        items = (mf2 or {}).get('items')
+        if items:
+            content = microformats2.first_props(
+                items[0].get('properties')).get('content')
+            if content:
+                return sha256(json_dumps(content, sort_keys=True).encode()).hexdigest()
+
     def __init__(self, source=None, target=None, **kwargs):
         if source and target:
             assert 'id' not in kwargs
@@ -224,21 +526,24 @@ class Activity(StringIdModel):
         if self.source_atom:
             return atom.atom_to_activity(self.source_atom)
 
-    def actor_link(self, as1=None):
-        """Returns a pretty actor link with their name and profile picture."""
-        if self.direction == 'out' and self.domain:
-            return User.get_by_id(self.domain[0]).user_page_link()
-
-        if not as1:
-           as1 = self.to_as1()
+    def actor_link(self, user=None, fetch=True):
+        """Returns a pretty actor link with their name and profile picture.
 
-        actor = util.get_first(as1, 'actor') or util.get_first(as1, 'author') or {}
-        if isinstance(actor, str):
-            return util.pretty_link(url)
-
-        url = util.get_first(actor, 'url')
-        name = actor.get('displayName')
-        image = util.get_url(actor, 'image')
+        Args:
+          user: :class:`User` for outbound activities, if already loaded.
+          fetch: bool, whether to fetch the user from the datastore if ``user``
+            isn't provided
+        """
+        if self.direction == 'out' and self.domain:
+            if not user and fetch:
+                user = User.get_by_id(self.domain[0])
+            if user:
+                return user.user_page_link()
+
+        actor = (self.summary or self.summarize())['actor']
+        url = actor['url']
+        name = actor['name']
+        image = actor['image']
         if not image:
             return util.pretty_link(url, text=name)
 
@@ -278,6 +583,10 @@ class Follower(StringIdModel):
     # most recent AP Follow activity (JSON). must have a composite actor object
     # with an inbox, publicInbox, or sharedInbox!
     last_follow = ndb.TextProperty()
+    # denormalized from last_follow's actor: its shared inbox if available,
+    # otherwise its public inbox or inbox. indexed so that fan-out can use a
+    # projection query instead of loading and parsing every last_follow.
+    inbox = ndb.StringProperty()
     status = ndb.StringProperty(choices=STATUSES, default='active')
 
     created = ndb.DateTimeProperty(auto_now_add=True)
@@ -292,10 +601,228 @@ class Follower(StringIdModel):
     @classmethod
     def get_or_create(cls, dest, src, **kwargs):
         logger.info(f'new Follower from {src} to {dest}')
+        if 'last_follow' in kwargs:
+            kwargs['inbox'] = cls.inbox_from_follow(kwargs['last_follow'])
+        existing = cls.get_by_id(cls._id(dest, src))
         follower = cls.get_or_insert(cls._id(dest, src), src=src, dest=dest, **kwargs)
         follower.dest = dest
         follower.src = src
         for prop, val in kwargs.items():
             setattr(follower, prop, val)
         follower.put()
+        follower.update_counts(was_active=existing and existing.status == 'active')
         return follower
+
+    def update_counts(self, was_active):
+        """Updates the follower/following counters after a status change.
+
+        Call after changing status and storing this entity.
+
+        Args:
+          was_active: bool, whether this follower was active before
+        """
+        delta = int(self.status == 'active') - int(bool(was_active))
+        if delta:
+            Counter.increment(f'followers {self.dest}', delta)
+            Counter.increment(f'following {self.src}', delta)
+
+    @staticmethod
+    def count_followers(domain):
+        """Returns the number of active followers of a domain or actor.
+
+        Args:
+          domain: str
+        """
+        return Counter.get_count(f'followers {domain}')
+
+    @staticmethod
+    def count_following(domain):
+        """Returns the number of active accounts a domain or actor follows.
+
+        Args:
+          domain: str
+        """
+        return Counter.get_count(f'following {domain}')
+
+    @staticmethod
+    def inbox_from_follow(follow):
+        """Returns the inbox to deliver to for a Follow activity's actor.
+
+        Args:
+          follow: str, JSON AS2 Follow activity
+
+        Returns: str URL, or None
+        """
+        actor = json_loads(follow).get('actor') if follow else None
+        if actor and isinstance(actor, dict):
+            return (actor.get('endpoints', {}).get('sharedInbox') or
+                    actor.get('publicInbox') or
+                    actor.get('inbox'))
+
+
+class Counter(StringIdModel):
+    """An incrementally updated count of :class:`Follower` entities.
+
+    Key name is 'followers DOMAIN' or 'following DOMAIN', where DOMAIN is a
+    domain or AP actor id. Created lazily from a full query the first time it's
+    read, then updated transactionally. Any drift is fixed by
+    :func:`tasks.reconcile_counters`.
+    """
+    count = ndb.IntegerProperty(default=0)
+
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    @ndb.transactional()
+    def increment(id, delta):
+        """Adds delta to a counter, if it exists.
+
+        If it doesn't exist yet, it will be computed from scratch when it's
+        first read, so we don't create it here.
+
+        Args:
+          id: str
+          delta: int
+        """
+        counter = Counter.get_by_id(id)
+        if counter:
+            counter.count = max(counter.count + delta, 0)
+            counter.put()
+
+    @staticmethod
+    def get_count(id):
+        """Returns a counter's value. Creates it if necessary.
+
+        Args:
+          id: str
+
+        Returns: int
+        """
+        counter = Counter.get_by_id(id)
+        if not counter:
+            counter = Counter(id=id)
+            counter.recompute()
+            counter.put()
+        return counter.count
+
+    def recompute(self):
+        """Recounts this counter from scratch. Doesn't store it."""
+        name, domain = self.key.id().split(' ', 1)
+        prop = {'followers': Follower.dest, 'following': Follower.src}[name]
+        self.count = Follower.query(Follower.status == 'active',
+                                    prop == domain).count()
+
+
+class Delivery(ndb.Model):
+    """An outbound ActivityPub delivery, queued to be sent or retried.
+
+    Key name is 'INBOX TYPE ID', from the AS2 activity, if it has an id.
+    Created by :func:`common.enqueue_delivery`, drained by :func:`tasks.deliver`.
+    Use ``expire`` with a datastore TTL policy to delete finished entities.
+    """
+    STATUSES = ('pending', 'complete', 'dead')
+
+    inbox = ndb.StringProperty(required=True)
+    data = ndb.TextProperty(required=True)  # JSON AS2 activity
+    # domain of the User whose key signs the request
+    domain = ndb.StringProperty(required=True)
+    # our own base URL when this was enqueued. used for the HTTP Signature keyId
+    host_url = ndb.StringProperty()
+    # the Activitys to mark complete when this succeeds, or error if it dies
+    activities = ndb.KeyProperty(kind='Response', repeated=True)
+    # mf2_content_hash of the source being delivered. copied to the Activitys
+    # when this succeeds.
+    content_hash = ndb.StringProperty()
+    # set when it's complete or dead
+    expire = ndb.DateTimeProperty()
+    status = ndb.StringProperty(choices=STATUSES, default='pending')
+    attempts = ndb.IntegerProperty(default=0)
+    next_attempt = ndb.DateTimeProperty()
+    last_error = ndb.TextProperty()
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def _id(inbox, activity):
+        """Returns the key name for delivering an activity to an inbox.
+
+        Includes the type because Creates and Updates of the same post have the
+        same id.
+
+        Args:
+          inbox: str URL
+          activity: dict, AS2 activity
+
+        Returns: str, or None if the activity has no id
+        """
+        if activity.get('id'):
+            return f"{inbox} {activity.get('type')} {activity['id']}"
+
+
+class InboxItem(ndb.Model):
+    """A raw inbound ActivityPub activity, queued for processing.
+
+    Created by :func:`activitypub.inbox`, drained by :func:`tasks.process_inbox`.
+    Use ``expire`` with a datastore TTL policy to delete finished entities.
+    """
+    STATUSES = ('pending', 'complete', 'error')
+
+    data = ndb.TextProperty(required=True)  # JSON AS2 activity
+    # domain of the user inbox it was delivered to, or None for the shared inbox
+    domain = ndb.StringProperty()
+    # our own base URL when this was received
+    host_url = ndb.StringProperty()
+    status = ndb.StringProperty(choices=STATUSES, default='pending')
+    attempts = ndb.IntegerProperty(default=0)
+    next_attempt = ndb.DateTimeProperty()
+    last_error = ndb.TextProperty()
+    # set when it's complete or errored out
+    expire = ndb.DateTimeProperty()
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class SeenActivity(StringIdModel):
+    """An inbound ActivityPub activity we've already received.
+
+    Key name is the activity id, or a digest if it doesn't have one. Datastore
+    backstop for :func:`activitypub.inbox`'s in-memory de-duplication.
+    Use ``expire`` with a datastore TTL policy to delete old entities.
+    """
+    created = ndb.DateTimeProperty()
+    expire = ndb.DateTimeProperty()
+
+
+class SourcePage(StringIdModel):
+    """The last version we saw of a webmention source page. Key name is the URL.
+
+    Lets :class:`webmention.Webmention` send conditional requests and skip
+    parsing pages that haven't changed.
+    """
+    # final URL, after redirects
+    url = ndb.StringProperty()
+    etag = ndb.StringProperty()
+    last_modified = ndb.StringProperty()
+    body_hash = ndb.StringProperty()  # SHA-256 hex digest
+    mf2 = ndb.TextProperty()  # JSON
+
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class RemoteObject(StringIdModel):
+    """A cached copy of a remote AS2 object, eg an actor. Key name is the URL.
+
+    Second tier of :func:`common.get_as2`'s cache.
+    """
+    # final URL, after redirects and rel-alternate links
+    url = ndb.StringProperty()
+    content = ndb.TextProperty()  # JSON
+    content_type = ndb.StringProperty()
+    etag = ndb.StringProperty()
+    last_modified = ndb.StringProperty()
+    # when we last fetched or revalidated this
+    fetched = ndb.DateTimeProperty()
+
+    updated = ndb.DateTimeProperty(auto_now=True)
@@ -1,12 +1,14 @@
 """UI pages."""
 import calendar
 import datetime
+from hashlib import sha256
 from itertools import islice
 import logging
 import re
 import urllib.parse
 
 from flask import redirect, render_template, request
+from google.cloud import ndb
 from google.cloud.ndb.stats import KindStat
 from granary import as2, atom, microformats2, rss
 from oauth_dropins.webutil import flask_util, logs, util
@@ -14,12 +16,19 @@ from oauth_dropins.webutil.flask_util import error, flash, redirect
 from oauth_dropins.webutil.util import json_dumps, json_loads
 
 from app import app, cache
+import caching
 import common
 from models import Follower, User, Activity
 
 PAGE_SIZE = 20
 ACTIVITIES_FETCH_LIMIT = 200
-FOLLOWERS_UI_LIMIT = 999
+
+# rendered feeds are also keyed on their newest activity, so this only bounds
+# how long edits to existing activities take to show up
+FEED_CACHE_TIME = datetime.timedelta(hours=1)
+
+# when this instance started, for the in-memory stats on admin pages
+STARTED = datetime.datetime.utcnow().replace(microsecond=0)
 
 logger = logging.getLogger(__name__)
 
@@ -76,18 +85,13 @@ def user(domain):
         return render_template('user_not_found.html', domain=domain), 404
 
     query = Activity.query(
-        Activity.status.IN(('new', 'complete', 'error')),
+        Activity.status.IN(('new', 'queued', 'complete', 'error')),
         Activity.domain == domain,
     )
     activities, before, after = fetch_activities(query)
 
-    followers = Follower.query(Follower.dest == domain)\
-                        .count(limit=FOLLOWERS_UI_LIMIT)
-    followers = f'{followers}{"+" if followers == FOLLOWERS_UI_LIMIT else ""}'
-
-    following = Follower.query(Follower.src == domain)\
-                        .count(limit=FOLLOWERS_UI_LIMIT)
-    following = f'{following}{"+" if following == FOLLOWERS_UI_LIMIT else ""}'
+    followers = Follower.count_followers(domain)
+    following = Follower.count_following(domain)
 
     return render_template(
         'user.html',
@@ -156,6 +160,41 @@ def feed(domain):
     if not (user := User.get_by_id(domain)):
       return render_template('user_not_found.html', domain=domain), 404
 
+    # the feed only changes when a new inbound activity arrives, so key the
+    # cache and ETag on the newest one's timestamp
+    latest = Activity.query(
+        Activity.domain == domain, Activity.direction == 'in'
+        ).order(-Activity.created
+        ).get(projection=[Activity.created])
+    cache_key = f'feed {domain} {format} {latest.created.isoformat() if latest else None}'
+    etag = sha256(cache_key.encode()).hexdigest()
+    headers = {'ETag': f'"{etag}"'}
+
+    if etag in request.if_none_match:
+        return '', 304, headers
+
+    rendered = cache.get(cache_key)
+    if not rendered:
+        rendered = render_feed(user, format)
+        cache.set(cache_key, rendered,
+                  timeout=int(FEED_CACHE_TIME.total_seconds()))
+
+    body, content_type = rendered
+    headers['Content-Type'] = content_type
+    return body, headers
+
+
+def render_feed(user, format):
+    """Renders a user's feed of inbound activities.
+
+    Args:
+      user: :class:`User`
+      format: str, 'html', 'atom', or 'rss'
+
+    Returns:
+      (str body, str content type) tuple
+    """
+    domain = user.key.id()
     as2_activities, _, _ = Activity.query(
         Activity.domain == domain, Activity.direction == 'in'
         ).order(-Activity.created
@@ -174,15 +213,16 @@ def feed(domain):
 
     if format == 'html':
         entries = [microformats2.object_to_html(a) for a in as1_activities]
-        return render_template('feed.html', util=util, **locals())
+        return (render_template('feed.html', util=util, **locals()),
+                'text/html; charset=utf-8')
     elif format == 'atom':
         body = atom.activities_to_atom(as1_activities, actor=actor, title=title,
                                        request_url=request.url)
-        return body, {'Content-Type': atom.CONTENT_TYPE}
+        return body, atom.CONTENT_TYPE
     elif format == 'rss':
         body = rss.from_activities(as1_activities, actor=actor, title=title,
                                    feed_url=request.url)
-        return body, {'Content-Type': rss.CONTENT_TYPE}
+        return body, rss.CONTENT_TYPE
 
 
 @app.get('/responses')  # deprecated
@@ -193,7 +233,7 @@ def recent_deprecated():
 @app.get('/recent')
 def recent():
     """Renders recent activities, with links to logs."""
-    query = Activity.query(Activity.status.IN(('new', 'complete', 'error')))
+    query = Activity.query(Activity.status.IN(('new', 'queued', 'complete', 'error')))
     activities, before, after = fetch_activities(query)
     return render_template(
         'recent.html',
@@ -286,53 +326,37 @@ def fetch_activities(query):
     activities = []
     seen = set()
 
-    # synthesize human-friendly content for activities
-    for i, activity in enumerate(orig_activities):
-        a = activity.to_as1()
+    # human-friendly content for activities, precomputed when they're stored
+    for activity in orig_activities:
+        summary = activity.summary or activity.summarize()
 
         # de-dupe
-        ids = set((a[field] for field in ('id', 'url') if a.get(field)))
+        ids = set(summary['ids'])
         if ids & seen:
             continue
         seen.update(ids)
         activities.append(activity)
 
-        # synthesize text snippet
-        verb = a.get('verb') or a.get('objectType')
-        obj = util.get_first(a, 'object') or {}
-
-        phrases = {
-            'article': 'posted',
-            'note': 'posted',
-            'post': 'posted',
-            'comment': 'replied',
-            'like': 'liked',
-            'follow': 'followed',
-            'repost': 'reposted',
-            'share': 'reposted',
-            'rsvp-yes': 'is attending',
-            'rsvp-no': 'is not attending',
-            'rsvp-maybe': 'might attend',
-            'rsvp-interested': 'is interested in',
-            'invite': 'is invited to',
-        }
-        activity.phrase = phrases.get(verb)
-
-        obj_content = obj.get('content') or obj.get('displayName')
-        obj_url = util.get_first(obj, 'url')
-        if obj_url:
-            obj_content = util.pretty_link(obj_url, text=obj_content)
-
-        activity.content = a.get('content') or a.get('displayName')
-        activity.url = util.get_first(a, 'url')
-
-        if (verb in ('like', 'follow', 'repost', 'share') or
-            not activity.content):
-            if activity.url:
-                activity.phrase = util.pretty_link(activity.url, text=activity.phrase)
-            if obj_content:
-                activity.content = obj_content
-                activity.url = obj_url
+        activity.phrase = summary['phrase']
+        activity.content = summary['content']
+        activity.url = summary['url']
+
+    # load users for outbound activities all at once, and only render each
+    # user's link once
+    domains = set(a.domain[0] for a in activities
+                  if a.direction == 'out' and a.domain)
+    users = dict(zip(domains, ndb.get_multi([ndb.Key(User, d) for d in domains])))
+    user_links = {}
+    for activity in activities:
+        if activity.direction == 'out' and activity.domain:
+            domain = activity.domain[0]
+            if domain not in user_links:
+                # a missing user falls back to the activity's own actor
+                user_links[domain] = activity.actor_link(user=users[domain],
+                                                         fetch=False)
+            activity.actor = user_links[domain]
+        else:
+            activity.actor = activity.actor_link()
 
     return activities, new_before, new_after
 
@@ -347,6 +371,21 @@ def stats():
    )
 
 
+@app.get('/admin/hosts')
+def admin_hosts():
+    """Shows this instance's remote host circuit breaker and cache state."""
+    return render_template(
+        'admin_hosts.html',
+        hosts=common.host_health(),
+        retry_after=common.HOST_RETRY_AFTER,
+        as2_cache_stats=sorted(common.as2_cache_stats.items()),
+        as2_cache_size=len(common._as2_cache),
+        endpoint_cache_stats=sorted(common.endpoint_cache_stats.items()),
+        response_cache_stats=caching.hit_ratios(),
+        started=STARTED,
+    )
+
+
 @app.get('/log')
 @flask_util.cached(cache, logs.CACHE_TIME)
 def log():
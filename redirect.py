@@ -31,6 +31,7 @@ CACHE_TIME = datetime.timedelta(seconds=15)
 
 
 @app.get(r'/r/<path:to>')
+@common.conditional(CACHE_TIME)
 @flask_util.cached(cache, CACHE_TIME)
 def redir(to):
     """301 redirect to the embedded fully qualified URL.
@@ -68,7 +69,9 @@ def redir(to):
 
     # redirect
     logger.info(f'redirecting to {to}')
-    return redirect(to, code=301)
+    resp = redirect(to, code=301)
+    resp.headers['Vary'] = 'Accept'
+    return resp
 
 
 def convert_to_as2(url, domain):
@@ -92,4 +95,7 @@ def convert_to_as2(url, domain):
     return obj, {
         'Content-Type': common.CONTENT_TYPE_AS2,
         'Access-Control-Allow-Origin': '*',
+        # this is content negotiated, so shared caches mustn't serve it to
+        # browsers that want the redirect
+        'Vary': 'Accept',
     }
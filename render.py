@@ -7,6 +7,7 @@ from granary import as2, atom, microformats2
 from oauth_dropins.webutil import flask_util
 from oauth_dropins.webutil.flask_util import error
 from oauth_dropins.webutil.util import json_loads
+from werkzeug.http import http_date
 
 from app import app, cache
 import common
@@ -16,6 +17,7 @@ CACHE_TIME = datetime.timedelta(minutes=15)
 
 
 @app.get('/render')
+@common.conditional(CACHE_TIME)
 @flask_util.cached(cache, CACHE_TIME)
 def render():
     """Fetches a stored Activity and renders it as HTML."""
@@ -41,4 +43,6 @@ def render():
     html = microformats2.activities_to_html([as1])
     utf8 = '<meta charset="utf-8">'
     refresh = f'<meta http-equiv="refresh" content="0;url={source}">'
-    return html.replace(utf8, utf8 + '\n' + refresh)
+    return html.replace(utf8, utf8 + '\n' + refresh), {
+        'Last-Modified': http_date(activity.updated),
+    }
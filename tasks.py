@@ -0,0 +1,372 @@
+"""Background task handlers, run periodically by App Engine cron.
+
+See cron.yaml.
+"""
+import contextlib
+import datetime
+import logging
+import time
+
+from flask import request
+from google.cloud.ndb.query import Cursor
+from google.cloud import ndb
+from oauth_dropins.webutil.appengine_config import ndb_client
+from oauth_dropins.webutil.util import json_loads
+
+import activitypub
+from app import app
+import common
+from models import Activity, Counter, Delivery, Follower, InboxItem, KeyPair, User
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_BATCH_SIZE = 100
+INBOX_BATCH_SIZE = 100
+# how long /cron/deliver and /cron/process-inbox keep fetching batches. they
+# run every minute.
+DELIVERY_TIME_BUDGET = 45  # s
+INBOX_TIME_BUDGET = 45  # s
+# how long a run has to finish processing a batch it claimed before another run
+# can claim it again
+QUEUE_LEASE = datetime.timedelta(minutes=5)
+# how long to keep finished queue entities. see expire in models.Delivery and
+# models.InboxItem
+QUEUE_EXPIRE = datetime.timedelta(days=7)
+
+# how many pre-generated key pairs to keep in the pool, and the max number to
+# generate in a single refill request
+KEY_POOL_SIZE = 50
+KEY_POOL_REFILL_BATCH = 10
+
+MIGRATION_BATCH_SIZE = 200
+MIGRATION_TIME_BUDGET = 45  # s
+COUNTER_BATCH_SIZE = 100
+
+
+def claim(query, batch_size):
+    """Claims a batch of due, pending queue entities, eg :class:`InboxItem`.
+
+    Moves each one's ``next_attempt`` out by :const:`QUEUE_LEASE` in a
+    transaction, so that overlapping runs don't process it too. If we die
+    before finishing, it's retried when the lease runs out.
+
+    Args:
+      query: :class:`ndb.Query` for pending entities whose next attempt is due
+      batch_size: int
+
+    Returns: list of :class:`ndb.Model`
+    """
+    keys = query.fetch(batch_size, keys_only=True)
+    if not keys:
+        return []
+
+    @ndb.transactional()
+    def claim_keys():
+        now = common.utcnow()
+        claimed = [e for e in ndb.get_multi(keys)
+                   if e and e.status == 'pending' and e.next_attempt <= now]
+        for entity in claimed:
+            entity.next_attempt = now + QUEUE_LEASE
+        ndb.put_multi(claimed)
+        return claimed
+
+    return claim_keys()
+
+
+def run_batches(fn, batch_size, time_budget):
+    """Calls fn repeatedly until a batch comes back short or time runs out.
+
+    Always runs at least one batch.
+
+    Args:
+      fn: callable that takes no arguments, handles one batch, and returns
+        (int number succeeded, int number attempted)
+      batch_size: int. a batch with fewer items than this means we're done.
+      time_budget: int, seconds
+
+    Returns: (int total succeeded, int total attempted) tuple
+    """
+    deadline = time.monotonic() + time_budget
+    done = total = 0
+    while True:
+        batch_done, batch_total = fn()
+        done += batch_done
+        total += batch_total
+        if batch_total < batch_size or time.monotonic() >= deadline:
+            return done, total
+
+
+@app.get('/cron/deliver')
+def deliver():
+    """Sends queued deliveries whose next attempt is due.
+
+    Keeps sending batches of ``DELIVERY_BATCH_SIZE`` until there are none left
+    or ``DELIVERY_TIME_BUDGET`` runs out.
+    """
+    delivered, total = run_batches(_deliver_batch, DELIVERY_BATCH_SIZE,
+                                   DELIVERY_TIME_BUDGET)
+    if not total:
+        return 'Nothing to deliver'
+
+    msg = f'Delivered {delivered} of {total}'
+    logger.info(msg)
+    return msg
+
+
+def _deliver_batch():
+    """Sends one batch of due deliveries.
+
+    Returns: (int number delivered, int number attempted) tuple
+    """
+    deliveries = claim(Delivery.query(Delivery.status == 'pending',
+                                      Delivery.next_attempt <= common.utcnow()),
+                       DELIVERY_BATCH_SIZE)
+    if not deliveries:
+        return 0, 0
+
+    domains = set(d.domain for d in deliveries)
+    users = dict(zip(domains, ndb.get_multi([ndb.Key(User, d) for d in domains])))
+
+    def send(delivery):
+        with app.test_request_context('/', base_url=delivery.host_url or request.host_url):
+            resp = common.signed_post(delivery.inbox, data=json_loads(delivery.data),
+                                      user=users[delivery.domain], gateway=False)
+            resp.raise_for_status()
+            return resp
+
+    results = common.map_concurrently(send, deliveries)
+
+    finished = []
+    for delivery, (_, e) in zip(deliveries, results):
+        delivery.attempts += 1
+        if not e:
+            delivery.status = 'complete'
+            delivery.expire = common.utcnow() + QUEUE_EXPIRE
+            finished.append(delivery)
+            continue
+
+        delivery.last_error = str(e)
+        if (common.is_retryable(e) and
+                delivery.attempts < common.DELIVERY_MAX_ATTEMPTS):
+            delivery.next_attempt = (common.utcnow() +
+                                     common.retry_delay(delivery.attempts))
+            logger.info(f'{delivery.key} to {delivery.inbox} failed, retrying at {delivery.next_attempt}: {e}')
+        else:
+            delivery.status = 'dead'
+            delivery.expire = common.utcnow() + QUEUE_EXPIRE
+            finished.append(delivery)
+            logger.warning(f'Giving up on {delivery.key} to {delivery.inbox} after {delivery.attempts} attempts: {e}')
+
+    # update the Activitys for finished deliveries
+    keys = [key for d in finished for key in d.activities]
+    activities = dict(zip(keys, ndb.get_multi(keys)))
+    for delivery in finished:
+        for key in delivery.activities:
+            activity = activities.get(key)
+            if not activity:
+                continue
+            if delivery.status == 'complete':
+                activity.status = 'complete'
+                if delivery.content_hash:
+                    activity.content_hash = delivery.content_hash
+            else:
+                activity.status = 'error'
+
+    ndb.put_multi(deliveries + [a for a in activities.values() if a])
+
+    return sum(1 for d in finished if d.status == 'complete'), len(deliveries)
+
+
+@app.get('/cron/process-inbox')
+def process_inbox():
+    """Processes queued inbound activities whose next attempt is due.
+
+    Keeps processing batches of ``INBOX_BATCH_SIZE`` until there are none left
+    or ``INBOX_TIME_BUDGET`` runs out. Runs at most ``INBOX_CONCURRENCY`` at a
+    time, each in its own ndb context.
+    """
+    done, total = run_batches(_process_inbox_batch, INBOX_BATCH_SIZE,
+                              INBOX_TIME_BUDGET)
+    if not total:
+        return 'Nothing to process'
+
+    msg = f'Processed {done} of {total}'
+    logger.info(msg)
+    return msg
+
+
+def _process_inbox_batch():
+    """Processes one batch of due inbound activities.
+
+    Returns: (int number processed successfully, int number attempted) tuple
+    """
+    items = claim(InboxItem.query(InboxItem.status == 'pending',
+                                  InboxItem.next_attempt <= common.utcnow()),
+                  INBOX_BATCH_SIZE)
+    if not items:
+        return 0, 0
+
+    def process(item):
+        # worker threads need their own ndb context
+        context = (contextlib.nullcontext() if ndb.get_context(False)
+                   else ndb_client.context())
+        with context, app.test_request_context(
+                '/', base_url=item.host_url or request.host_url):
+            activitypub.process_inbox(json_loads(item.data), domain=item.domain)
+
+    results = common.map_concurrently(process, items,
+                                      max_workers=app.config['INBOX_CONCURRENCY'])
+
+    done = 0
+    for item, (_, e) in zip(items, results):
+        item.attempts += 1
+        if not e:
+            item.status = 'complete'
+            item.expire = common.utcnow() + QUEUE_EXPIRE
+            done += 1
+            continue
+
+        item.last_error = str(e)
+        if common.is_retryable(e) and item.attempts < common.DELIVERY_MAX_ATTEMPTS:
+            item.next_attempt = common.utcnow() + common.retry_delay(item.attempts)
+            logger.info(f'{item.key} failed, retrying at {item.next_attempt}: {e}')
+        else:
+            item.status = 'error'
+            item.expire = common.utcnow() + QUEUE_EXPIRE
+            logger.warning(f'Giving up on {item.key} after {item.attempts} attempts: {e}')
+
+    ndb.put_multi(items)
+
+    return done, len(items)
+
+
+@app.get('/cron/refill-key-pool')
+def refill_key_pool():
+    """Tops up the pool of pre-generated key pairs for new users."""
+    have = KeyPair.query().count(limit=KEY_POOL_SIZE)
+    pairs = [KeyPair.generate()
+             for _ in range(min(KEY_POOL_SIZE - have, KEY_POOL_REFILL_BATCH))]
+    ndb.put_multi(pairs)
+
+    msg = f'Generated {len(pairs)} key pairs; pool had {have}'
+    logger.info(msg)
+    return msg
+
+
+@app.get('/cron/reconcile-counters')
+def reconcile_counters():
+    """Recomputes all :class:`Counter` entities from scratch to fix any drift."""
+    fixed = total = 0
+    cursor = None
+    more = True
+    while more:
+        counters, cursor, more = Counter.query().fetch_page(
+            COUNTER_BATCH_SIZE, start_cursor=cursor)
+        total += len(counters)
+
+        drifted = []
+        for counter in counters:
+            before = counter.count
+            counter.recompute()
+            if counter.count != before:
+                logger.warning(f'{counter.key} drifted: {before} => {counter.count}')
+                drifted.append(counter)
+        ndb.put_multi(drifted)
+        fixed += len(drifted)
+
+    msg = f'Fixed {fixed} of {total} Counters'
+    logger.info(msg)
+    return msg
+
+
+def migrate(query, fn, name):
+    """Runs a one-off migration on a query's entities, in batches.
+
+    Starts at the ``cursor`` query param, if any, and keeps fetching batches
+    until there are none left or :const:`MIGRATION_TIME_BUDGET` runs out.
+
+    Args:
+      query: :class:`ndb.Query`
+      fn: callable that takes a list of entities, updates them, and returns
+        the ones that need to be stored
+      name: str, plural kind name for the result message, eg 'Followers'
+
+    Returns: str message, with the URL to continue from if we ran out of time
+    """
+    cursor = request.args.get('cursor')
+    cursor = Cursor(urlsafe=cursor) if cursor else None
+    deadline = time.monotonic() + MIGRATION_TIME_BUDGET
+    updated = total = 0
+
+    while True:
+        entities, cursor, more = query.fetch_page(MIGRATION_BATCH_SIZE,
+                                                  start_cursor=cursor)
+        changed = fn(entities)
+        ndb.put_multi(changed)
+        updated += len(changed)
+        total += len(entities)
+        if not (more and cursor) or time.monotonic() >= deadline:
+            break
+
+    msg = f'Updated {updated} of {total} {name}'
+    if more and cursor:
+        msg += f'\nNext: {request.base_url}?cursor={cursor.urlsafe().decode()}'
+    logger.info(msg)
+    return msg
+
+
+@app.get('/cron/backfill-follower-inboxes')
+def backfill_follower_inboxes():
+    """One-off migration that populates :attr:`Follower.inbox`."""
+    def backfill(followers):
+        updated = []
+        for follower in followers:
+            inbox = Follower.inbox_from_follow(follower.last_follow)
+            if inbox != follower.inbox:
+                follower.inbox = inbox
+                updated.append(follower)
+        return updated
+
+    return migrate(Follower.query(), backfill, 'Followers')
+
+
+@app.get('/cron/backfill-activity-content-hashes')
+def backfill_activity_content_hashes():
+    """One-off migration that populates :attr:`Activity.content_hash`."""
+    def backfill(activities):
+        updated = []
+        for activity in activities:
+            if activity.source_mf2 and not activity.content_hash:
+                activity.content_hash = Activity.mf2_content_hash(
+                    json_loads(activity.source_mf2))
+                if activity.content_hash:
+                    updated.append(activity)
+        return updated
+
+    return migrate(Activity.query(), backfill, 'Activities')
+
+
+@app.get('/cron/migrate-activity-snapshots')
+def migrate_activity_snapshots():
+    """One-off migration that moves Activity sources into Snapshots.
+
+    Rewriting an Activity stores its source_* values as Snapshot references.
+    """
+    def rewrite(activities):
+        for activity in activities:
+            activity.keep_updated = True
+        return activities
+
+    return migrate(Activity.query(), rewrite, 'Activities')
+
+
+@app.get('/cron/backfill-activity-summaries')
+def backfill_activity_summaries():
+    """One-off migration that populates :attr:`Activity.summary`."""
+    def backfill(activities):
+        updated = [a for a in activities if not a.summary]
+        for activity in updated:
+            activity.keep_updated = True
+        return updated
+
+    return migrate(Activity.query(), backfill, 'Activities')
@@ -0,0 +1,119 @@
+"""Benchmark for concurrent ActivityPub fan-out delivery.
+
+Starts a local stub inbox server that waits before answering each POST, then
+delivers one signed activity to 10, 100, and 1000 inboxes on it with
+:func:`common.map_concurrently` and :func:`common.signed_post`. Prints the wall
+clock time for each, next to how long sending them one at a time would take.
+
+This is the sending step only. In production, follower fan-out is queued as
+Deliverys, and :func:`tasks.deliver` sends each batch of them this way. Inline
+delivery, ie ``DELIVERY_QUEUE = 'inline'``, and targeted deliveries send from
+:meth:`webmention.Webmention.try_activitypub` directly. Either way, it doesn't
+include the datastore reads and writes around each batch.
+
+Not run by the unit tests. Usage:
+
+  python -m tests.benchmark_delivery [--latency SECONDS] [--workers N] [COUNT ...]
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+
+from oauth_dropins.webutil.appengine_config import ndb_client
+
+from app import app
+import common
+from models import KeyPair, User
+
+COUNTS = (10, 100, 1000)
+LATENCY = .2  # s
+
+ACTIVITY = {
+    '@context': 'https://www.w3.org/ns/activitystreams',
+    'type': 'Create',
+    'id': 'http://localhost/r/https://benchmark.example/post',
+    'actor': 'http://localhost/benchmark.example',
+    'object': {
+        'type': 'Note',
+        'id': 'http://localhost/r/https://benchmark.example/post',
+        'content': 'Hello world',
+    },
+}
+
+
+class StubInbox(BaseHTTPRequestHandler):
+    """Accepts every POST after waiting :attr:`latency` seconds."""
+    latency = LATENCY
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(self.latency)
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # don't refuse connections when every worker connects at once
+    request_queue_size = 1024
+
+
+def benchmark(count, port, user, max_workers=None):
+    """Delivers :const:`ACTIVITY` to count inboxes on the stub server.
+
+    Returns: (float seconds elapsed, int number of failed deliveries) tuple
+    """
+    inboxes = [f'http://localhost:{port}/users/{i}/inbox' for i in range(count)]
+
+    def deliver(inbox):
+        return common.signed_post(inbox, data=ACTIVITY, user=user)
+
+    start = time.perf_counter()
+    results = common.map_concurrently(deliver, inboxes, max_workers=max_workers)
+    elapsed = time.perf_counter() - start
+
+    failed = [e for _, e in results if e]
+    if failed:
+        print(f'  {len(failed)} failed, eg {failed[0]!r}')
+    return elapsed, len(failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('counts', type=int, nargs='*', default=COUNTS,
+                        help='numbers of inboxes to deliver to')
+    parser.add_argument('--latency', type=float, default=LATENCY,
+                        help='seconds the stub inbox waits before responding')
+    parser.add_argument('--workers', type=int, default=common.MAX_CONCURRENT_REQUESTS,
+                        help='max concurrent deliveries')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    StubInbox.latency = args.latency
+    server = StubServer(('localhost', 0), StubInbox)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    with ndb_client.context(), app.test_request_context('/'):
+        pair = KeyPair.generate()
+        user = User(id='benchmark.example', mod=pair.mod,
+                    public_exponent=pair.public_exponent,
+                    private_exponent=pair.private_exponent)
+
+        print(f'{args.workers} workers, {args.latency}s inbox latency')
+        print(f'{"inboxes":>8} {"concurrent":>11} {"sequential":>11} {"failed":>7}')
+        for count in args.counts:
+            elapsed, failed = benchmark(count, port, user, max_workers=args.workers)
+            print(f'{count:>8} {elapsed:>10.2f}s {count * args.latency:>10.1f}s {failed:>7}')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
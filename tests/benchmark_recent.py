@@ -0,0 +1,102 @@
+"""Benchmark for rendering the /recent page from Activity summaries.
+
+Stores a page's worth of Activitys, then renders /recent repeatedly and prints
+the mean render time. The first run uses the summaries stored with each
+Activity. The second clears them after loading, so that every row is
+converted with :meth:`models.Activity.summarize` on the fly, like before
+summaries were stored. Deletes the Activitys when it's done.
+
+Needs a datastore, eg the emulator. Not run by the unit tests. Usage:
+
+  python -m tests.benchmark_recent [--count N]
+"""
+import argparse
+import logging
+import time
+from unittest import mock
+
+from google.cloud import ndb
+from oauth_dropins.webutil.appengine_config import ndb_client
+from oauth_dropins.webutil.util import json_dumps
+
+from app import app
+import pages
+from models import Activity
+
+COUNT = 20
+ROWS = 20
+
+
+def note(i):
+    """Returns an AS2 Create for a Mastodon-style reply."""
+    return {
+        '@context': 'https://www.w3.org/ns/activitystreams',
+        'type': 'Create',
+        'id': f'https://mastodon.example/users/alice/statuses/{i}/activity',
+        'actor': {
+            'type': 'Person',
+            'id': 'https://mastodon.example/users/alice',
+            'url': 'https://mastodon.example/@alice',
+            'name': 'Alice',
+            'icon': {'type': 'Image', 'url': 'https://mastodon.example/alice.png'},
+        },
+        'object': {
+            'type': 'Note',
+            'id': f'https://mastodon.example/users/alice/statuses/{i}',
+            'url': f'https://mastodon.example/@alice/{i}',
+            'inReplyTo': 'https://benchmark.example/post',
+            'content': f'<p>Reply number {i}, with <a href="https://benchmark.example/">a link</a>.</p>',
+        },
+    }
+
+
+def benchmark(count, client, summaries):
+    """Renders /recent count times.
+
+    Returns: float mean seconds per render
+    """
+    fetch_page = pages.fetch_page
+
+    def fetch_page_without_summaries(query, model_class):
+        results, before, after = fetch_page(query, model_class)
+        for activity in results:
+            activity.summary = None
+        return results, before, after
+
+    with mock.patch.object(pages, 'fetch_page', side_effect=(
+            fetch_page if summaries else fetch_page_without_summaries)):
+        start = time.perf_counter()
+        for _ in range(count):
+            assert client.get('/recent').status_code == 200
+        return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=COUNT,
+                        help='number of renders per run')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with ndb_client.context():
+        keys = ndb.put_multi([
+            Activity(id=f'https://mastodon.example/{i} https://benchmark.example/post',
+                     domain=['benchmark.example'], direction='in',
+                     protocol='activitypub', status='complete',
+                     source_as2=json_dumps(note(i)))
+            for i in range(ROWS)])
+
+        client = app.test_client()
+        client.get('/recent')  # warm up templates
+
+        print(f'{"":>12} {"render":>8}')
+        for name, summaries in ('summaries', True), ('to_as1', False):
+            elapsed = benchmark(args.count, client, summaries)
+            print(f'{name:>12} {elapsed * 1000:>6.1f}ms')
+
+        ndb.delete_multi(keys)
+
+
+if __name__ == '__main__':
+    main()
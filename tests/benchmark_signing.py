@@ -0,0 +1,74 @@
+"""Benchmark for signing outbound requests with cached keys.
+
+Signs the same POST many times with :func:`common.signature_auth`, the way
+:func:`common.signed_request` does, and prints signatures per second. Cold
+builds a new auth object from the user's key for every request, with the PEM
+cache cleared, like before keys were cached. Warm reuses the cached one.
+
+Not run by the unit tests. Usage:
+
+  python -m tests.benchmark_signing [--count N]
+"""
+import argparse
+from base64 import b64encode
+from hashlib import sha256
+import logging
+import time
+
+import requests
+
+import common
+import models
+from models import KeyPair, User
+
+COUNT = 200
+KEY_ID = 'http://localhost/benchmark.example'
+INBOX = 'https://inbox.example/inbox'
+BODY = b'{"type": "Create", "object": {"content": "Hello world"}}'
+
+
+def sign(auth):
+    """Signs a POST to :const:`INBOX` with an auth object."""
+    req = requests.Request('POST', INBOX, data=BODY, headers={
+        'Date': 'Wed, 23 Nov 2022 22:29:19 GMT',
+        'Host': 'inbox.example',
+        'Digest': f'SHA-256={b64encode(sha256(BODY).digest()).decode()}',
+    }).prepare()
+    auth(req)
+    return req
+
+
+def benchmark(count, user, warm):
+    """Signs count requests.
+
+    Returns: float signatures per second
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        if warm:
+            auth = common.signature_auth(KEY_ID, user)
+        else:
+            models._export_pem.cache_clear()
+            auth = common.signature_auth.__wrapped__(KEY_ID, user)
+        sign(auth)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=COUNT,
+                        help='number of requests to sign')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    pair = KeyPair.generate()
+    user = User(mod=pair.mod, public_exponent=pair.public_exponent,
+                private_exponent=pair.private_exponent)
+
+    print(f'{"":>5} {"signatures/s":>13}')
+    for name, warm in ('cold', False), ('warm', True):
+        print(f'{name:>5} {benchmark(args.count, user, warm):>13.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Benchmark for unwrapping /r/ URLs in inbound activities.
+
+Runs :func:`common.redirect_unwrap` on a Mastodon-style reply whose ids, URLs,
+recipients, and mentions are wrapped in our /r/ prefix, and prints payloads per
+second and how many of them needed a :func:`util.follow_redirects` call.
+Fully qualified /r/ URLs are unwrapped by parsing alone, so that should be
+zero.
+
+Not run by the unit tests. Usage:
+
+  python -m tests.benchmark_unwrap [--count N]
+"""
+import argparse
+import logging
+import time
+from unittest import mock
+
+from oauth_dropins.webutil import util
+
+from app import app
+import common
+
+COUNT = 10000
+R = 'http://localhost/r/'
+
+PAYLOAD = {
+    '@context': 'https://www.w3.org/ns/activitystreams',
+    'id': 'https://mastodon.example/users/alice/statuses/1/activity',
+    'type': 'Create',
+    'actor': 'https://mastodon.example/users/alice',
+    'to': ['https://www.w3.org/ns/activitystreams#Public'],
+    'cc': [
+        'https://mastodon.example/users/alice/followers',
+        f'{R}https://bob.example/',
+    ],
+    'object': {
+        'id': 'https://mastodon.example/users/alice/statuses/1',
+        'type': 'Note',
+        'url': 'https://mastodon.example/@alice/1',
+        'attributedTo': 'https://mastodon.example/users/alice',
+        'inReplyTo': f'{R}https://bob.example/2022/11/post',
+        'content': '<p><a href="https://bob.example/">@bob.example</a> nice post!</p>',
+        'to': ['https://www.w3.org/ns/activitystreams#Public'],
+        'cc': [
+            'https://mastodon.example/users/alice/followers',
+            f'{R}https://bob.example/',
+        ],
+        'tag': [{
+            'type': 'Mention',
+            'href': f'{R}https://bob.example/',
+            'name': '@bob.example@bob.example',
+        }, {
+            'type': 'Hashtag',
+            'href': 'https://mastodon.example/tags/indieweb',
+            'name': '#indieweb',
+        }],
+        'replies': {
+            'id': 'https://mastodon.example/users/alice/statuses/1/replies',
+            'type': 'Collection',
+            'first': {
+                'type': 'CollectionPage',
+                'next': 'https://mastodon.example/users/alice/statuses/1/replies?page=true',
+                'items': [],
+            },
+        },
+    },
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=COUNT,
+                        help='number of payloads to unwrap')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with app.test_request_context('/'), \
+         mock.patch.object(util, 'follow_redirects',
+                           wraps=util.follow_redirects) as mock_follow:
+        start = time.perf_counter()
+        for _ in range(args.count):
+            common.redirect_unwrap(PAYLOAD)
+        elapsed = time.perf_counter() - start
+
+    print(f'{args.count / elapsed:.0f} payloads/s, '
+          f'{mock_follow.call_count} follow_redirects calls')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark for creating new users, with and without the key pair pool.
+
+Creates users for new domains with :meth:`models.User.get_or_create`, first
+with an empty :class:`models.KeyPair` pool, so each one generates its own key,
+then with the pool filled ahead of time, the way :func:`tasks.refill_key_pool`
+does. Prints p50 and p99 latency for each. Deletes everything it creates.
+
+Empties the pool first, so it only runs against the datastore emulator. Not
+run by the unit tests. Usage:
+
+  python -m tests.benchmark_user_creation [--count N]
+"""
+import argparse
+import logging
+import os
+import statistics
+import time
+
+from google.cloud import ndb
+from oauth_dropins.webutil.appengine_config import ndb_client
+
+from models import KeyPair, User
+
+COUNT = 50
+
+
+def benchmark(count, prefix):
+    """Creates count new users.
+
+    Returns: (float p50, float p99) seconds tuple
+    """
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        User.get_or_create(f'{prefix}-{i}.benchmark.example')
+        latencies.append(time.perf_counter() - start)
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return quantiles[49], quantiles[98]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=COUNT,
+                        help='number of users to create per run')
+    args = parser.parse_args()
+    if not os.getenv('DATASTORE_EMULATOR_HOST'):
+        parser.error('only runs against the datastore emulator')
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with ndb_client.context():
+        ndb.delete_multi(KeyPair.query().fetch(keys_only=True))
+        print(f'{"pool":>6} {"p50":>8} {"p99":>8}')
+
+        p50, p99 = benchmark(args.count, 'empty')
+        print(f'{"empty":>6} {p50 * 1000:>6.0f}ms {p99 * 1000:>6.0f}ms')
+
+        ndb.put_multi([KeyPair.generate() for _ in range(args.count)])
+        p50, p99 = benchmark(args.count, 'full')
+        print(f'{"full":>6} {p50 * 1000:>6.0f}ms {p99 * 1000:>6.0f}ms')
+
+        ndb.delete_multi([ndb.Key(User, f'{prefix}-{i}.benchmark.example')
+                          for prefix in ('empty', 'full')
+                          for i in range(args.count)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark for verifying inbound HTTP Signatures.
+
+Signs an inbox POST the way :func:`common.signed_request` does, then verifies
+it repeatedly with :func:`common.verify_signature` and prints verifications
+per second. Cold clears the parsed public key cache before every
+verification, so each one parses the actor's PEM from its stored copy. Warm
+keeps the parsed key in memory, the steady state for actors who deliver to us
+regularly. Neither fetches the key over the network.
+
+Not run by the unit tests. Usage:
+
+  python -m tests.benchmark_verify [--count N]
+"""
+import argparse
+from base64 import b64encode
+from hashlib import sha256
+import logging
+import time
+
+from oauth_dropins.webutil.appengine_config import ndb_client
+from oauth_dropins.webutil.util import json_dumps
+import requests
+
+from app import app
+import common
+from models import KeyPair, RemoteObject, User
+
+COUNT = 1000
+ACTOR = 'https://mastodon.example/users/alice'
+KEY_ID = f'{ACTOR}#main-key'
+BODY = b'{"type": "Like", "actor": "https://mastodon.example/users/alice"}'
+
+
+def signed_headers(user):
+    """Returns headers for an inbox POST of :const:`BODY`, signed by user."""
+    req = requests.Request('POST', 'http://localhost/inbox', data=BODY, headers={
+        'Date': common.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT'),
+        'Host': 'localhost',
+        'Digest': f'SHA-256={b64encode(sha256(BODY).digest()).decode()}',
+    }).prepare()
+    common.signature_auth(KEY_ID, user)(req)
+    return dict(req.headers)
+
+
+def benchmark(count, headers, warm):
+    """Verifies the signed request count times.
+
+    Returns: float verifications per second
+    """
+    with app.test_request_context('/inbox', method='POST', data=BODY,
+                                  headers=headers):
+        start = time.perf_counter()
+        for _ in range(count):
+            if not warm:
+                common._public_keys.clear()
+            assert common.verify_signature(fetch=False) == ACTOR
+        return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=COUNT,
+                        help='number of verifications')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    common.AS2_CACHE_DATASTORE = False
+
+    with ndb_client.context():
+        pair = KeyPair.generate()
+        user = User(mod=pair.mod, public_exponent=pair.public_exponent,
+                    private_exponent=pair.private_exponent)
+        common._as2_cache[KEY_ID] = RemoteObject(id=KEY_ID, content=json_dumps({
+            'id': ACTOR,
+            'type': 'Person',
+            'publicKey': {
+                'id': KEY_ID,
+                'owner': ACTOR,
+                'publicKeyPem': user.public_pem().decode(),
+            },
+        }))
+        headers = signed_headers(user)
+
+        print(f'{"":>5} {"verifications/s":>16}')
+        for name, warm in ('cold', False), ('warm', True):
+            print(f'{name:>5} {benchmark(args.count, headers, warm):>16.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ TODO: test error handling
 import copy
 from unittest.mock import ANY, call, patch
 
+from Crypto.PublicKey import RSA
 from granary import as2
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.testutil import requests_response
@@ -14,8 +15,9 @@ import requests
 from urllib3.exceptions import ReadTimeoutError
 
 import activitypub
+from app import app
 import common
-from models import Follower, User, Activity
+from models import Activity, Follower, InboxItem, RemoteObject, User
 from . import testutil
 
 REPLY_OBJECT = {
@@ -188,6 +190,26 @@ class ActivityPubTest(testutil.TestCase):
             },
         }, got.json)
 
+    def test_actor_conditional(self, _, mock_get, __):
+        mock_get.return_value = requests_response("""
+<body>
+<a class="h-card u-url" rel="me" href="/about-me">Mrs. ☕ Foo</a>
+</body>
+""", url='https://foo.com/', content_type=common.CONTENT_TYPE_HTML)
+
+        got = self.client.get('/foo.com')
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('public, max-age=15', got.headers['Cache-Control'])
+        etag = got.headers['ETag']
+
+        got = self.client.get('/foo.com', headers={'If-None-Match': etag})
+        self.assertEqual(304, got.status_code)
+        self.assertEqual(b'', got.get_data())
+        self.assertEqual(etag, got.headers['ETag'])
+
+        got = self.client.get('/foo.com', headers={'If-None-Match': '"other"'})
+        self.assertEqual(200, got.status_code)
+
     def test_actor_no_hcard(self, _, mock_get, __):
         mock_get.return_value = requests_response("""
 <body>
@@ -384,6 +406,103 @@ class ActivityPubTest(testutil.TestCase):
         self.assertEqual('complete', activity.status)
         self.assertEqual(LIKE_WITH_ACTOR, json_loads(activity.source_as2))
 
+    def test_inbox_queued(self, mock_head, mock_get, mock_post):
+        with patch.dict(app.config, INBOX_QUEUE='datastore'):
+            got = self.client.post('/foo.com/inbox', json=LIKE)
+        self.assertEqual(202, got.status_code)
+        mock_get.assert_not_called()
+        mock_post.assert_not_called()
+
+        item = InboxItem.query().get()
+        self.assertEqual('pending', item.status)
+        self.assertEqual('foo.com', item.domain)
+        self.assertEqual(LIKE, json_loads(item.data))
+
+        mock_head.return_value = requests_response(url='http://orig/post')
+        mock_get.side_effect = [
+            requests_response(LIKE_WITH_ACTOR['actor'],
+                              headers={'Content-Type': common.CONTENT_TYPE_AS2}),
+            requests_response(
+                '<html><head><link rel="webmention" href="/webmention"></html>'),
+        ]
+        mock_post.return_value = requests_response()
+
+        got = self.client.get('/cron/process-inbox')
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('complete', item.key.get().status)
+        self.assertEqual(('http://orig/webmention',), mock_post.call_args[0])
+        self.assertEqual('complete', Activity.get_by_id(
+            'http://this/like__ok http://orig/post').status)
+
+    def test_inbox_queued_unsupported_type_rejected(self, *_):
+        with patch.dict(app.config, INBOX_QUEUE='datastore'):
+            got = self.client.post('/foo.com/inbox', json={'type': 'Block'})
+        self.assertEqual(501, got.status_code)
+        self.assertEqual(0, InboxItem.query().count())
+
+    def test_inbox_bad_signature(self, mock_head, mock_get, mock_post):
+        mock_get.return_value = requests_response(status=404)
+        got = self.client.post('/foo.com/inbox', json=LIKE, headers={
+            'Signature': 'keyId="http://orig/actor#main-key",signature="abc="',
+        })
+        self.assertEqual(401, got.status_code)
+        mock_post.assert_not_called()
+        self.assertEqual(0, Activity.query().count())
+
+    def test_inbox_signer_not_actor(self, mock_head, mock_get, mock_post):
+        # the key belongs to http://orig/actor, but the activity claims another
+        signer = User.get_or_create('signer.example')
+        common._public_keys['http://orig/actor#main-key'] = (
+            RSA.import_key(signer.public_pem()), 'http://orig/actor')
+
+        body = json_dumps({**LIKE, 'actor': 'http://other/actor'}).encode()
+        got = self.client.post('/foo.com/inbox', data=body, headers={
+            **self.signed_headers(signer, body),
+            'Content-Type': 'application/activity+json',
+        })
+        self.assertEqual(401, got.status_code)
+        mock_post.assert_not_called()
+
+    def test_inbox_unsigned_rejected_if_required(self, mock_head, mock_get, mock_post):
+        with patch.dict(app.config, INBOX_REQUIRE_SIGNATURES=True):
+            got = self.client.post('/foo.com/inbox', json=LIKE)
+        self.assertEqual(401, got.status_code)
+        mock_post.assert_not_called()
+
+    def test_inbox_duplicate(self, mock_head, mock_get, mock_post):
+        with patch.dict(app.config, INBOX_QUEUE='datastore'):
+            got = self.client.post('/foo.com/inbox', json=LIKE)
+            self.assertEqual(202, got.status_code)
+
+            # redelivered to the shared inbox
+            got = self.client.post('/inbox', json=LIKE)
+            self.assertEqual(200, got.status_code)
+            self.assertEqual(1, InboxItem.query().count())
+
+            # datastore backstop
+            activitypub._seen.clear()
+            got = self.client.post('/foo.com/inbox', json=LIKE)
+            self.assertEqual(200, got.status_code)
+            self.assertEqual(1, InboxItem.query().count())
+
+            # expired
+            activitypub._seen.clear()
+            with patch.object(common, 'utcnow',
+                              return_value=testutil.NOW + activitypub.SEEN_TTL):
+                got = self.client.post('/foo.com/inbox', json=LIKE)
+            self.assertEqual(202, got.status_code)
+            self.assertEqual(2, InboxItem.query().count())
+
+    def test_inbox_duplicate_without_id(self, *_):
+        like = copy.deepcopy(LIKE)
+        del like['id']
+        with patch.dict(app.config, INBOX_QUEUE='datastore'):
+            self.assertEqual(202, self.client.post('/foo.com/inbox', json=like).status_code)
+            self.assertEqual(200, self.client.post('/foo.com/inbox', json=like).status_code)
+
+            like['object'] = 'http://orig/other'
+            self.assertEqual(202, self.client.post('/foo.com/inbox', json=like).status_code)
+
     def test_inbox_follow_accept(self, mock_head, mock_get, mock_post):
         mock_head.return_value = requests_response(url='https://www.realize.be/')
         mock_get.side_effect = [
@@ -471,7 +590,7 @@ class ActivityPubTest(testutil.TestCase):
         other = Follower.get_or_create('realize.be', 'https://mas.to/users/other')
         self.assertEqual(3, Follower.query().count())
 
-        got = self.client.post('/realize.be/inbox', json=DELETE)
+        got = self.post_signed('/realize.be/inbox', DELETE)
         self.assertEqual(200, got.status_code)
         self.assertEqual('active', follower.key.get().status)
         self.assertEqual('active', followee.key.get().status)
@@ -485,12 +604,110 @@ class ActivityPubTest(testutil.TestCase):
         other = Follower.get_or_create('realize.be', 'https://mas.to/users/other')
         self.assertEqual(3, Follower.query().count())
 
-        got = self.client.post('/inbox', json=DELETE)
+        got = self.post_signed('/inbox', DELETE)
         self.assertEqual(200, got.status_code)
         self.assertEqual('inactive', follower.key.get().status)
         self.assertEqual('inactive', followee.key.get().status)
         self.assertEqual('active', other.key.get().status)
 
+    def test_shared_inbox_delete_actor_unsigned(self, mock_head, mock_get, mock_post):
+        follower = Follower.get_or_create('realize.be', DELETE['actor'])
+
+        got = self.client.post('/inbox', json=DELETE)
+        self.assertEqual(401, got.status_code)
+        self.assertEqual('active', follower.key.get().status)
+
+    def test_shared_inbox_delete_other_known_actor(self, mock_head, mock_get, mock_post):
+        """Actors can only delete themselves."""
+        other = Follower.get_or_create('realize.be', 'https://mas.to/users/other')
+
+        got = self.post_signed('/inbox', {
+            **DELETE,
+            'object': 'https://mas.to/users/other',
+        })
+        self.assertEqual(401, got.status_code)
+        self.assertEqual('active', other.key.get().status)
+
+    def test_shared_inbox_delete_actor_stored_key(self, mock_head, mock_get, mock_post):
+        """Deleted actors' keys are gone, so we use the copy we stored."""
+        follower = Follower.get_or_create('realize.be', DELETE['actor'])
+        signer = User.get_or_create('signer.example')
+        key_id = f'{DELETE["actor"]}#main-key'
+        RemoteObject(id=key_id, url=DELETE['actor'],
+                     content_type=common.CONTENT_TYPE_AS2,
+                     fetched=testutil.NOW - common.AS2_CACHE_TTL * 10,
+                     content=json_dumps({
+                         'id': DELETE['actor'],
+                         'publicKey': {
+                             'id': key_id,
+                             'publicKeyPem': signer.public_pem().decode(),
+                         },
+                     })).put()
+
+        got = self.post_signed('/inbox', DELETE, cache_key=False)
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('inactive', follower.key.get().status)
+        mock_get.assert_not_called()
+
+    def test_shared_inbox_delete_actor_no_key(self, mock_head, mock_get, mock_post):
+        follower = Follower.get_or_create('realize.be', DELETE['actor'])
+
+        got = self.post_signed('/inbox', DELETE, cache_key=False)
+        self.assertEqual(401, got.status_code)
+        self.assertEqual('active', follower.key.get().status)
+        mock_get.assert_not_called()
+
+    def test_shared_inbox_delete_unknown_actor_unsigned(self, mock_head, mock_get, mock_post):
+        """Deletes of actors we don't know are noops, so we don't verify them."""
+        other = Follower.get_or_create('realize.be', 'https://mas.to/users/other')
+
+        got = self.client.post('/inbox', json=DELETE)
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('active', other.key.get().status)
+        mock_get.assert_not_called()
+
+    def test_inbox_delete_note(self, mock_head, mock_get, mock_post):
+        follower = Follower.get_or_create('realize.be', DELETE['actor'])
+        delete = {**DELETE, 'object': 'https://mastodon.social/users/swentel/statuses/123'}
+
+        for path in '/inbox', '/realize.be/inbox':
+            with self.subTest(path=path):
+                got = self.post_signed(path, delete, cache_key=False)
+                self.assertEqual(200, got.status_code)
+
+        self.assertEqual('active', follower.key.get().status)
+        mock_get.assert_not_called()
+
+    @patch.object(activitypub, 'DELETE_BATCH_SIZE', 2)
+    def test_shared_inbox_delete_actor_batches(self, *_):
+        for domain in 'a.com', 'b.com', 'c.com':
+            Follower.get_or_create(domain, DELETE['actor'])
+        Follower.get_or_create('d.com', DELETE['actor'], status='inactive')
+        self.assertEqual(3, Follower.count_following(DELETE['actor']))
+
+        self.assertEqual(3, activitypub.deactivate_followers(DELETE['actor']))
+        self.assertEqual(0, Follower.query(Follower.status == 'active').count())
+        self.assertEqual(0, Follower.count_following(DELETE['actor']))
+        self.assertEqual(0, Follower.count_followers('a.com'))
+
+    def test_shared_inbox_delete_unknown_actor(self, *_):
+        other = Follower.get_or_create('realize.be', 'https://mas.to/users/other')
+        self.assertEqual(0, activitypub.deactivate_followers(DELETE['actor']))
+        self.assertEqual('active', other.key.get().status)
+
+    def test_user_inbox_delete_doesnt_shadow_shared_inbox(self, mock_head, mock_get, mock_post):
+        Follower.get_or_create('realize.be', DELETE['actor'])
+
+        got = self.post_signed('/realize.be/inbox', DELETE)
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('active', Follower.get_by_id(
+            f'realize.be {DELETE["actor"]}').status)
+
+        got = self.post_signed('/inbox', DELETE)
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('inactive', Follower.get_by_id(
+            f'realize.be {DELETE["actor"]}').status)
+
     def test_inbox_webmention_discovery_connection_fails(self, mock_head,
                                                          mock_get, mock_post):
         mock_get.side_effect = [
@@ -533,10 +750,15 @@ class ActivityPubTest(testutil.TestCase):
         self.assertEqual(200, resp.status_code)
         self.assertEqual({
             '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': 'http://localhost/foo.com/followers',
             'summary': "foo.com's followers",
-            'type': 'Collection',
+            'type': 'OrderedCollection',
             'totalItems': 0,
-            'items': [],
+            'first': {
+                'type': 'OrderedCollectionPage',
+                'partOf': 'http://localhost/foo.com/followers',
+                'orderedItems': [],
+            },
         }, resp.json)
 
         Follower.get_or_create('foo.com', 'bar.com')
@@ -546,25 +768,50 @@ class ActivityPubTest(testutil.TestCase):
 
         resp = self.client.get('/foo.com/followers')
         self.assertEqual(200, resp.status_code)
+        self.assertEqual(common.CONTENT_TYPE_AS2, resp.headers['Content-Type'])
+        self.assertEqual('public, max-age=15', resp.headers['Cache-Control'])
         self.assertEqual({
             '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': 'http://localhost/foo.com/followers',
             'summary': "foo.com's followers",
-            'type': 'Collection',
+            'type': 'OrderedCollection',
             'totalItems': 2,
-            'items': [],
-# TODO
-# {
-#                 'type': 'Create',
-#                 'actor': 'http://www.test.example/sally',
-#                 'object': 'http://example.org/foo',
-#             },
-#             {
-#                 'type': 'Like',
-#                 'actor': 'http://www.test.example/joe',
-#                 'object': 'http://example.org/foo',
-#             }],
+            'first': {
+                'type': 'OrderedCollectionPage',
+                'partOf': 'http://localhost/foo.com/followers',
+                'orderedItems': ['bar.com', 'baz.com'],
+            },
+        }, resp.json)
+
+    @patch.object(activitypub, 'COLLECTION_PAGE_SIZE', 2)
+    def test_followers_collection_paging(self, *args):
+        User.get_or_create('foo.com')
+        for src in 'a.com', 'b.com', 'c.com':
+            Follower.get_or_create('foo.com', src)
+
+        resp = self.client.get('/foo.com/followers')
+        self.assertEqual(200, resp.status_code)
+        first = resp.json['first']
+        self.assertEqual(['a.com', 'b.com'], first['orderedItems'])
+
+        next = first['next']
+        self.assertTrue(next.startswith('http://localhost/foo.com/followers?cursor='))
+        resp = self.client.get(next)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('public, max-age=600', resp.headers['Cache-Control'])
+        self.assertEqual({
+            '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': next,
+            'type': 'OrderedCollectionPage',
+            'partOf': 'http://localhost/foo.com/followers',
+            'orderedItems': ['c.com'],
         }, resp.json)
 
+    def test_followers_collection_bad_cursor(self, *args):
+        User.get_or_create('foo.com')
+        resp = self.client.get('/foo.com/followers?cursor=%%%')
+        self.assertEqual(400, resp.status_code)
+
     def test_following_collection_unknown_user(self, *args):
         resp = self.client.get('/foo.com/following')
         self.assertEqual(404, resp.status_code)
@@ -576,10 +823,15 @@ class ActivityPubTest(testutil.TestCase):
         self.assertEqual(200, resp.status_code)
         self.assertEqual({
             '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': 'http://localhost/foo.com/following',
             'summary': "foo.com's following",
-            'type': 'Collection',
+            'type': 'OrderedCollection',
             'totalItems': 0,
-            'items': [],
+            'first': {
+                'type': 'OrderedCollectionPage',
+                'partOf': 'http://localhost/foo.com/following',
+                'orderedItems': [],
+            },
         }, resp.json)
 
         Follower.get_or_create('bar.com', 'foo.com')
@@ -591,8 +843,13 @@ class ActivityPubTest(testutil.TestCase):
         self.assertEqual(200, resp.status_code)
         self.assertEqual({
             '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': 'http://localhost/foo.com/following',
             'summary': "foo.com's following",
-            'type': 'Collection',
+            'type': 'OrderedCollection',
             'totalItems': 2,
-            'items': [],
+            'first': {
+                'type': 'OrderedCollectionPage',
+                'partOf': 'http://localhost/foo.com/following',
+                'orderedItems': ['bar.com', 'baz.com'],
+            },
         }, resp.json)
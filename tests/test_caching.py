@@ -0,0 +1,128 @@
+"""Unit tests for caching.py."""
+import threading
+
+from flask_caching.backends.memcache import MemcachedCache
+from flask_caching.backends.simplecache import SimpleCache
+from pymemcache.exceptions import MemcacheIllegalInputError
+
+from app import app
+import caching
+from caching import TwoLevelCache
+from . import testutil
+
+
+class FakeMemcacheClient:
+    """In-memory memcached client that validates input like pymemcache."""
+    def __init__(self):
+        self.data = {}
+
+    @staticmethod
+    def _check(key, expire=0):
+        if len(key) > 250 or any(c.isspace() or ord(c) < 33 for c in key):
+            raise MemcacheIllegalInputError(f'Key has invalid characters or is too long: {key}')
+        if not isinstance(expire, int):
+            raise MemcacheIllegalInputError(f'expire must be integer, got {expire!r}')
+
+    def get(self, key):
+        self._check(key)
+        return self.data.get(key)
+
+    def set(self, key, value, expire=0, noreply=None):
+        self._check(key, expire)
+        self.data[key] = value
+        return True
+
+    def add(self, key, value, expire=0, noreply=None):
+        self._check(key, expire)
+        return self.data.setdefault(key, value) is value
+
+    def delete(self, key, noreply=None):
+        self._check(key)
+        return self.data.pop(key, None) is not None
+
+    def append(self, key, value, expire=0, noreply=None):
+        self._check(key, expire)
+        return key in self.data
+
+
+class TwoLevelCacheTest(testutil.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # stand-in for memcached, shared by both "instances"
+        self.l2 = SimpleCache()
+        self.a = TwoLevelCache(self.l2)
+        self.b = TwoLevelCache(self.l2)
+
+    def test_get_set(self):
+        with app.test_request_context('/foo.com'):
+            self.assertIsNone(self.a.get('x'))
+            self.a.set('x', 'y', timeout=60)
+            self.assertEqual('y', self.a.get('x'))
+
+            # other instance gets it from L2, then L1
+            self.assertEqual('y', self.b.get('x'))
+            self.assertEqual('y', self.b.get('x'))
+
+        self.assertEqual([('actor', {'miss': 1, 'l1 hit': 2, 'l2 hit': 1}, .75)],
+                         caching.hit_ratios())
+
+    def test_delete(self):
+        self.a.set('x', 'y')
+        self.assertTrue(self.a.has('x'))
+        self.a.delete('x')
+        self.assertFalse(self.a.has('x'))
+        self.assertIsNone(self.b.get('x'))
+
+    def test_memcached(self):
+        l2 = MemcachedCache(FakeMemcacheClient(), key_prefix='bridgy-fed')
+        a = TwoLevelCache(l2)
+        b = TwoLevelCache(l2)
+
+        # URL keys with spaces, longer than memcached's limit, float timeout
+        key = 'feed foo.com atom https://foo.com/' + 'x' * 300
+        a.set(key, 'y', timeout=3600.0)
+        self.assertEqual('y', b.get(key))
+        self.assertTrue(b.has(key))
+
+        self.assertTrue(a.add('z z', 'w'))
+        self.assertFalse(b.add('z z', 'v'))
+        self.assertEqual('w', b.get('z z'))
+
+        a.delete(key)
+        self.assertFalse(a.has(key))
+
+    def test_l1_timeout_bounded_by_l2_expiration(self):
+        self.a.set('x', 'y', timeout=5)
+        expires, value = self.l2.get(TwoLevelCache._l2_key('x'))
+        self.assertEqual('y', value)
+        self.assertLessEqual(TwoLevelCache._l1_timeout(expires), 5)
+        self.assertEqual(caching.L1_MAX_TIMEOUT, TwoLevelCache._l1_timeout(None))
+
+    def test_single_flight(self):
+        leading = threading.Event()
+        got = []
+
+        def wait():
+            leading.wait()
+            with app.test_request_context('/foo.com'):
+                got.append(self.a.get('x'))
+
+        with app.test_request_context('/foo.com'):
+            self.assertIsNone(self.a.get('x'))
+            waiter = threading.Thread(target=wait)
+            waiter.start()
+            leading.set()
+            self.a.set('x', 'y')
+
+        waiter.join()
+        self.assertEqual(['y'], got)
+
+    def test_single_flight_released_at_end_of_request(self):
+        with app.test_request_context('/foo.com'):
+            self.assertIsNone(self.a.get('x'))
+            TwoLevelCache._finish_request()
+
+        self.assertEqual({}, self.a._in_flight)
+        with app.test_request_context('/foo.com'):
+            self.assertIsNone(self.a.get('x'))
@@ -1,16 +1,19 @@
 # coding=utf-8
 """Unit tests for common.py."""
+import datetime
 from unittest import mock
+from unittest.mock import ANY
 
 from granary import as2
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.testutil import requests_response
+from oauth_dropins.webutil.util import json_loads
 import requests
-from werkzeug.exceptions import BadGateway
+from werkzeug.exceptions import BadGateway, GatewayTimeout, HTTPException, Unauthorized
 
 from app import app
 import common
-from models import User
+from models import Activity, Delivery, User
 from . import testutil
 
 HTML = requests_response('<html></html>', headers={
@@ -57,6 +60,53 @@ class CommonTest(testutil.TestCase):
             self.as2_req('http://as2', headers=common.CONNEG_HEADERS_AS2),
         ))
 
+    @mock.patch('requests.get', return_value=AS2)
+    def test_get_as2_cached(self, mock_get):
+        self.assertEqual(AS2_OBJ, common.get_as2('http://orig').json())
+        self.assertEqual(AS2_OBJ, common.get_as2('http://orig').json())
+        mock_get.assert_called_once()
+
+        # datastore tier
+        common._as2_cache.clear()
+        got = common.get_as2('http://orig')
+        self.assertEqual(AS2_OBJ, got.json())
+        self.assertEqual(common.CONTENT_TYPE_AS2, common.content_type(got))
+        mock_get.assert_called_once()
+
+        self.assertEqual({'miss': 1, 'memory hit': 1, 'datastore hit': 1},
+                         common.as2_cache_stats)
+
+    @mock.patch('requests.get')
+    def test_get_as2_cache_revalidate(self, mock_get):
+        mock_get.return_value = requests_response(AS2_OBJ, headers={
+            'Content-Type': common.CONTENT_TYPE_AS2,
+            'ETag': '"abc"',
+        })
+        common.get_as2('http://orig')
+
+        common.utcnow = lambda: testutil.NOW + common.AS2_CACHE_TTL
+        mock_get.return_value = requests_response(status=304)
+        self.assertEqual(AS2_OBJ, common.get_as2('http://orig').json())
+        self.assertEqual('"abc"', mock_get.call_args[1]['headers']['If-None-Match'])
+        self.assertEqual(1, common.as2_cache_stats['revalidated'])
+
+        # fresh again
+        common.get_as2('http://orig')
+        self.assertEqual(2, mock_get.call_count)
+
+    @mock.patch('requests.get')
+    def test_get_as2_cache_stale_on_error(self, mock_get):
+        mock_get.return_value = requests_response(AS2_OBJ, headers={
+            'Content-Type': common.CONTENT_TYPE_AS2,
+            'Last-Modified': 'Wed, 23 Nov 2022 22:29:19 GMT',
+        })
+        common.get_as2('http://orig')
+
+        common.utcnow = lambda: testutil.NOW + common.AS2_CACHE_TTL
+        mock_get.side_effect = requests.exceptions.ConnectionError('foo')
+        self.assertEqual(AS2_OBJ, common.get_as2('http://orig').json())
+        self.assertEqual(1, common.as2_cache_stats['stale'])
+
     @mock.patch('requests.get', return_value=HTML)
     def test_get_as2_only_html(self, mock_get):
         with self.assertRaises(BadGateway):
@@ -72,6 +122,178 @@ class CommonTest(testutil.TestCase):
         with self.assertRaises(BadGateway):
             resp = common.get_as2('http://orig')
 
+    @mock.patch('requests.head')
+    def test_redirect_unwrap(self, mock_head):
+        self.assertEqual({
+            'id': 'https://foo.com/post',
+            'inReplyTo': ['http://bar.com/reply', 'http://baz.com/'],
+            'object': {'url': 'not a url'},
+        }, common.redirect_unwrap({
+            'id': 'http://localhost/r/https://foo.com/post',
+            'inReplyTo': ['http://localhost/r/http:/bar.com/reply',
+                          'http://baz.com/'],
+            'object': {'url': 'not a url'},
+        }))
+        mock_head.assert_not_called()
+
+    @mock.patch('requests.head')
+    def test_redirect_unwrap_domain(self, mock_head):
+        mock_head.return_value = requests_response(url='https://www.unwrap.com/')
+        self.assertEqual('https://www.unwrap.com/',
+                         common.redirect_unwrap('http://localhost/unwrap.com'))
+        self.assert_req(mock_head, 'http://unwrap.com', allow_redirects=True)
+
+    @mock.patch('requests.post', return_value=requests_response())
+    @mock.patch('requests.get')
+    def test_send_webmentions_multiple_targets(self, mock_get, mock_post):
+        def get(url, **kwargs):
+            if url.startswith('http://a.com/'):
+                return requests_response(
+                    '<html><head><link rel="webmention" href="/wm"></html>', url=url)
+            elif url.startswith('http://b.com/'):
+                return requests_response('<html></html>', url=url)
+            return requests_response('', status=500, url=url)
+        mock_get.side_effect = get
+
+        with self.assertRaises(HTTPException):
+            common.send_webmentions({
+                'verb': 'post',
+                'id': 'http://this/reply',
+                'object': {
+                    'id': 'http://this/reply',
+                    'inReplyTo': [{'url': 'http://a.com/post'},
+                                  {'url': 'http://b.com/post'},
+                                  {'url': 'http://c.com/post'}],
+                },
+            }, protocol='activitypub')
+
+        self.assert_req(mock_post, 'http://a.com/wm', headers={'Accept': '*/*'},
+                        allow_redirects=False, data={
+                            'source': 'http://this/reply',
+                            'target': 'http://a.com/post',
+                        })
+        self.assertEqual({
+            'http://a.com/post': 'complete',
+            'http://b.com/post': 'ignored',
+            'http://c.com/post': 'new',
+        }, {a.target(): a.status for a in Activity.query()})
+
+    @mock.patch('requests.get')
+    def test_discover_webmention_endpoint_cache(self, mock_get):
+        mock_get.return_value = requests_response(
+            '<html><head><link rel="webmention" href="/wm"></html>')
+
+        for _ in range(2):
+            self.assertEqual('http://a.com/wm',
+                             common.discover_webmention_endpoint('http://a.com/post'))
+        mock_get.assert_called_once()
+        self.assertEqual({'fetch': 1, 'url hit': 1}, common.endpoint_cache_stats)
+
+        # expired
+        common.utcnow = lambda: testutil.NOW + common.ENDPOINT_CACHE_TTL
+        common.discover_webmention_endpoint('http://a.com/post')
+        self.assertEqual(2, mock_get.call_count)
+
+    @mock.patch('requests.get')
+    def test_discover_webmention_endpoint_same_domain(self, mock_get):
+        mock_get.side_effect = [
+            requests_response('<html><head><link rel="webmention" href="/wm"></html>'),
+            # other URLs on the same domain are still discovered
+            requests_response('<html><head><link rel="webmention" href="/wm2"></html>'),
+            requests_response('<html></html>'),
+            # but if fetching fails, fall back to the domain's endpoint
+            requests_response('', status=503),
+            requests.ConnectionError('foo'),
+        ]
+
+        for url, expected in (('http://a.com/post', 'http://a.com/wm'),
+                              ('http://a.com/other', 'http://a.com/wm2'),
+                              ('http://a.com/none', None),
+                              ('http://a.com/5xx', 'http://a.com/wm2'),
+                              ('http://a.com/down', 'http://a.com/wm2')):
+            with self.subTest(url=url):
+                self.assertEqual(expected, common.discover_webmention_endpoint(url))
+
+        self.assertEqual({'fetch': 5, 'domain fallback': 2},
+                         common.endpoint_cache_stats)
+
+    @mock.patch('requests.get')
+    def test_discover_webmention_endpoint_error_not_cached(self, mock_get):
+        mock_get.side_effect = [
+            requests_response('<html></html>', status=404),
+            requests_response('', status=500),
+            requests_response('<html><head><link rel="webmention" href="/wm"></html>'),
+        ]
+
+        self.assertIsNone(common.discover_webmention_endpoint('http://a.com/post'))
+        with self.assertRaises(requests.HTTPError):
+            common.discover_webmention_endpoint('http://a.com/post')
+        self.assertEqual('http://a.com/wm',
+                         common.discover_webmention_endpoint('http://a.com/post'))
+        self.assertEqual(3, mock_get.call_count)
+
+    @mock.patch('requests.get')
+    def test_discover_webmention_endpoint_cache_negative(self, mock_get):
+        mock_get.return_value = requests_response('<html></html>', headers={
+            'Cache-Control': 'max-age=60',
+        })
+        self.assertIsNone(common.discover_webmention_endpoint('http://a.com/post'))
+        self.assertIsNone(common.discover_webmention_endpoint('http://a.com/post'))
+        mock_get.assert_called_once()
+
+        # max-age
+        common.utcnow = lambda: testutil.NOW + datetime.timedelta(seconds=60)
+        self.assertIsNone(common.discover_webmention_endpoint('http://a.com/post'))
+        self.assertEqual(2, mock_get.call_count)
+
+    @mock.patch('requests.get')
+    def test_discover_webmention_endpoint_no_store(self, mock_get):
+        mock_get.return_value = requests_response('<html></html>', headers={
+            'Cache-Control': 'private, no-store',
+        })
+        common.discover_webmention_endpoint('http://a.com/post')
+        common.discover_webmention_endpoint('http://a.com/post')
+        self.assertEqual(2, mock_get.call_count)
+
+    def test_enqueue_delivery_dedupes(self):
+        user = User.get_or_create('foo.com')
+        a1 = Activity(id='http://foo.com/post http://inbox/1')
+        a2 = Activity(id='http://foo.com/post http://inbox/2')
+        create = {'type': 'Create', 'id': 'http://foo.com/post', 'content': 'x'}
+
+        first = common.enqueue_delivery('http://inbox', create, user, activities=[a1],
+                                        error=requests.ConnectionError('foo'))
+        self.assertEqual(1, first.attempts)
+        self.assertGreater(first.next_attempt, testutil.NOW)
+
+        create['content'] = 'y'
+        second = common.enqueue_delivery('http://inbox', create, user,
+                                         activities=[a1, a2])
+        self.assertEqual(first.key, second.key)
+        self.assertEqual(1, second.attempts)
+        self.assertEqual('y', json_loads(second.data)['content'])
+        self.assertEqual([a1.key, a2.key], second.activities)
+        self.assertEqual(1, Delivery.query().count())
+
+        # an Update of the same post is a separate delivery
+        update = common.enqueue_delivery('http://inbox', {**create, 'type': 'Update'},
+                                         user)
+        self.assertNotEqual(first.key, update.key)
+        self.assertEqual(0, update.attempts)
+        self.assertEqual(testutil.NOW, update.next_attempt)
+
+    @mock.patch.object(common, 'DELIVERY_ENQUEUE_BATCH_SIZE', 2)
+    def test_enqueue_deliveries_batches(self):
+        user = User.get_or_create('foo.com')
+        create = {'type': 'Create', 'id': 'http://foo.com/post'}
+        deliveries = common.enqueue_deliveries(
+            [(f'http://inbox/{i}', create, ()) for i in range(3)], user,
+            content_hash='abc')
+
+        self.assertEqual([f'http://inbox/{i}' for i in range(3)],
+                         [d.inbox for d in deliveries])
+        self.assertEqual(3, Delivery.query(Delivery.content_hash == 'abc').count())
+
     def test_redirect_wrap_empty(self):
         self.assertIsNone(common.redirect_wrap(None))
         self.assertEqual('', common.redirect_wrap(''))
@@ -131,3 +353,168 @@ class CommonTest(testutil.TestCase):
                 'type': 'Note',
             }, user=User(id='foo.com')))
 
+
+    def test_map_concurrently(self):
+        def fn(x):
+            if x == 2:
+                raise ValueError('two')
+            return x * 10, common.request.host_url
+
+        results = common.map_concurrently(fn, [1, 2, 3])
+        self.assertEqual([((10, 'http://localhost/'), None), (None, ANY),
+                          ((30, 'http://localhost/'), None)], results)
+        self.assertIsInstance(results[1][1], ValueError)
+
+        self.assertEqual([], common.map_concurrently(fn, []))
+
+    @mock.patch('requests.get', side_effect=requests.exceptions.ConnectionError('foo'))
+    def test_host_circuit_breaker(self, mock_get):
+        for _ in range(common.HOST_FAILURE_THRESHOLD):
+            with self.assertRaises(BadGateway):
+                common.signed_get('http://dead/a')
+        self.assertEqual(common.HOST_FAILURE_THRESHOLD, mock_get.call_count)
+
+        # open, skipped without sending a request
+        mock_get.reset_mock()
+        with self.assertRaises(GatewayTimeout):
+            common.signed_get('http://dead/b')
+        with self.assertRaises(common.HostUnavailable):
+            common.signed_get('http://dead/b', gateway=False)
+        mock_get.assert_not_called()
+
+        [health] = common.host_health()
+        self.assertEqual('dead', health['host'])
+        self.assertEqual(2, health['skipped'])
+
+        # half open, one probe succeeds and closes the circuit
+        mock_get.side_effect = None
+        mock_get.return_value = AS2
+        common.utcnow = lambda: testutil.NOW + common.HOST_RETRY_AFTER
+        self.assertTrue(common.host_available('dead'))
+        self.assertFalse(common.host_available('dead'))
+        common.record_host_result('dead', failed=False)
+
+        self.assertEqual(AS2, common.signed_get('http://dead/c'))
+        self.assertEqual([], common.host_health())
+
+    def test_host_circuit_breaker_probe_not_sent(self):
+        for _ in range(common.HOST_FAILURE_THRESHOLD):
+            common.record_host_result('dead', failed=True)
+        common.utcnow = lambda: testutil.NOW + common.HOST_RETRY_AFTER
+
+        # the probe fails before it's sent, so the next request can probe
+        with mock.patch.object(common, 'signature_auth', side_effect=ValueError('foo')), \
+             self.assertRaises(ValueError):
+            common.signed_get('http://dead/a')
+
+        self.assertTrue(common.host_available('dead'))
+
+    def test_host_circuit_breaker_ignores_http_errors(self):
+        with mock.patch('requests.get', return_value=NOT_ACCEPTABLE):
+            for _ in range(common.HOST_FAILURE_THRESHOLD + 1):
+                with self.assertRaises(BadGateway):
+                    common.signed_get('http://alive/')
+
+        self.assertTrue(common.host_available('alive'))
+
+    def actor_response(self, user):
+        return requests_response({
+            'id': 'http://orig/actor',
+            'publicKey': {
+                'id': 'http://orig/actor#main-key',
+                'publicKeyPem': user.public_pem().decode(),
+            },
+        }, headers={'Content-Type': common.CONTENT_TYPE_AS2})
+
+    def verify(self, body, headers, **kwargs):
+        with app.test_request_context('/foo.com/inbox', method='POST', data=body,
+                                      headers=headers):
+            return common.verify_signature(**kwargs)
+
+    def test_verify_signature_unsigned(self):
+        self.assertIsNone(self.verify(b'{}', {}))
+
+    @mock.patch('requests.get')
+    def test_verify_signature(self, mock_get):
+        user = User.get_or_create('foo.com')
+        mock_get.return_value = self.actor_response(user)
+        headers = self.signed_headers(user, b'{"x": 1}')
+
+        self.assertEqual('http://orig/actor', self.verify(b'{"x": 1}', headers))
+        self.assertEqual('http://orig/actor', self.verify(b'{"x": 1}', headers))
+        mock_get.assert_called_once()
+
+    @mock.patch('requests.get')
+    def test_verify_signature_invalid(self, mock_get):
+        user = User.get_or_create('foo.com')
+        mock_get.return_value = self.actor_response(user)
+        headers = self.signed_headers(user, b'{"x": 1}')
+
+        # body doesn't match digest
+        with self.assertRaises(Unauthorized):
+            self.verify(b'{"x": 2}', headers)
+
+        # signed header changed
+        with self.assertRaises(Unauthorized):
+            self.verify(b'{"x": 1}', {**headers, 'Date': 'Wed, 23 Nov 2022 22:00:00 GMT'})
+
+    @mock.patch('requests.get')
+    def test_verify_signature_date_out_of_range(self, mock_get):
+        user = User.get_or_create('foo.com')
+        mock_get.return_value = self.actor_response(user)
+
+        for date in (testutil.NOW - common.SIGNATURE_MAX_AGE - datetime.timedelta(minutes=1),
+                     testutil.NOW + common.SIGNATURE_CLOCK_SKEW + datetime.timedelta(minutes=1)):
+            with self.assertRaises(Unauthorized):
+                self.verify(b'{}', self.signed_headers(user, b'{}', date=date))
+
+        date = testutil.NOW - datetime.timedelta(hours=1)
+        self.assertEqual('http://orig/actor',
+                         self.verify(b'{}', self.signed_headers(user, b'{}', date=date)))
+
+    @mock.patch('requests.get')
+    def test_verify_signature_digest_not_signed(self, mock_get):
+        user = User.get_or_create('foo.com')
+        mock_get.return_value = self.actor_response(user)
+        headers = self.signed_headers(user, b'{}')
+        self.assertIn('headers="date host digest"', headers['Signature'])
+        headers['Signature'] = headers['Signature'].replace(
+            'headers="date host digest"', 'headers="date host"')
+
+        with self.assertRaises(Unauthorized):
+            self.verify(b'{}', headers)
+
+    @mock.patch('requests.get')
+    def test_verify_signature_key_on_other_host(self, mock_get):
+        user = User.get_or_create('foo.com')
+        mock_get.return_value = self.actor_response(user)
+        headers = self.signed_headers(user, b'{}', key_id='http://evil/key')
+
+        with self.assertRaises(Unauthorized):
+            self.verify(b'{}', headers)
+
+    @mock.patch('requests.get')
+    def test_verify_signature_key_rotated(self, mock_get):
+        old = User.get_or_create('old.com')
+        new = User.get_or_create('new.com')
+        mock_get.side_effect = [self.actor_response(old), self.actor_response(new)]
+
+        self.verify(b'{}', self.signed_headers(old, b'{}'))
+        self.assertEqual('http://orig/actor',
+                         self.verify(b'{}', self.signed_headers(new, b'{}')))
+        self.assertEqual(2, mock_get.call_count)
+
+    @mock.patch('requests.get', return_value=requests_response(status=410))
+    def test_verify_signature_key_fetch_fails(self, mock_get):
+        headers = self.signed_headers(User.get_or_create('foo.com'), b'{}')
+        with self.assertRaises(Unauthorized):
+            self.verify(b'{}', headers)
+
+    def test_signature_auth_cached(self):
+        user = User.get_or_create('foo.com')
+        auth = common.signature_auth('http://localhost/foo.com', user)
+        self.assertIs(auth, common.signature_auth('http://localhost/foo.com', user))
+        self.assertIsNot(auth, common.signature_auth('http://other/foo.com', user))
+
+        other = User.get_or_create('bar.com')
+        self.assertIsNot(auth, common.signature_auth('http://localhost/foo.com', other))
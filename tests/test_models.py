@@ -2,11 +2,13 @@
 """Unit tests for models.py."""
 from unittest import mock
 
+from google.cloud import ndb
 from oauth_dropins.webutil.testutil import requests_response
 from oauth_dropins.webutil.util import json_dumps, json_loads
 
 from app import app
-from models import User, Activity
+import models
+from models import Activity, Counter, Follower, KeyPair, Snapshot, User
 from . import testutil
 
 
@@ -24,6 +26,21 @@ class UserTest(testutil.TestCase):
         same = User.get_or_create('y.z')
         self.assertEqual(same, self.user)
 
+    def test_get_or_create_uses_key_pool(self):
+        pair = KeyPair.generate()
+        pair.put()
+
+        user = User.get_or_create('pooled.com')
+        self.assertEqual(pair.mod, user.mod)
+        self.assertEqual(pair.public_exponent, user.public_exponent)
+        self.assertEqual(pair.private_exponent, user.private_exponent)
+        self.assertEqual(0, KeyPair.query().count())
+
+        # pool is empty, generates a new key pair
+        other = User.get_or_create('other.com')
+        assert other.mod
+        self.assertNotEqual(pair.mod, other.mod)
+
     def test_href(self):
         href = self.user.href()
         self.assertTrue(href.startswith('data:application/magic-public-key,RSA.'), href)
@@ -135,6 +152,106 @@ class ActivityTest(testutil.TestCase):
         activity = Activity.get_or_create('abc#1', 'xyz#Z')
         self.assertEqual('abc__1 xyz__Z', activity.key.id())
 
+    def test_mf2_content_hash(self):
+        def mf2(content):
+            return {'items': [{'type': ['h-entry'], 'properties': {
+                'content': [content],
+                'url': ['http://a/post'],
+            }}]}
+
+        self.assertIsNone(Activity.mf2_content_hash({}))
+        self.assertIsNone(Activity.mf2_content_hash({'items': [{'properties': {}}]}))
+        self.assertEqual(Activity.mf2_content_hash(mf2('foo')),
+                         Activity.mf2_content_hash(mf2('foo')))
+        self.assertNotEqual(Activity.mf2_content_hash(mf2('foo')),
+                            Activity.mf2_content_hash(mf2('bar')))
+
+    def test_source_snapshots_shared(self):
+        mf2 = json_dumps({'items': [{'properties': {'content': ['foo']}}]})
+        Activity(id='http://a/post http://b/inbox', source_mf2=mf2).put()
+        Activity(id='http://a/post http://c/inbox', source_mf2=mf2).put()
+        self.assertEqual(1, Snapshot.query().count())
+
+        models._snapshots.clear()
+        self.assertEqual(mf2, Activity.get_by_id('http://a/post http://c/inbox').source_mf2)
+
+    def test_snapshot_cached_only_after_commit(self):
+        digest = Snapshot.hash('foo')
+
+        @ndb.transactional()
+        def store_then_fail():
+            Snapshot.store('foo')
+            raise RuntimeError('rolled back')
+
+        with self.assertRaises(RuntimeError):
+            store_then_fail()
+        self.assertNotIn(digest, models._snapshots)
+        self.assertIsNone(Snapshot.get_by_id(digest))
+
+        Snapshot.store('foo')
+        self.assertIn(digest, models._snapshots)
+        self.assertEqual('foo', Snapshot.get_by_id(digest).data)
+
+    def test_source_snapshot_missing(self):
+        Activity(id='http://a/post http://b/inbox', source_as2='{}').put()
+        Snapshot.query().get().key.delete()
+        models._snapshots.clear()
+        self.assertEqual('', Activity.get_by_id('http://a/post http://b/inbox').source_as2)
+
+    def test_summary(self):
+        mf2 = {'items': [{'type': ['h-entry'], 'properties': {
+            'content': ['Hello world'],
+            'url': ['http://a/post'],
+            'author': [{'type': ['h-card'], 'properties': {
+                'name': ['Alice'],
+                'url': ['http://a/'],
+                'photo': ['http://a/pic'],
+            }}],
+        }}]}
+        key = Activity(id='http://a/post http://b/inbox',
+                       source_mf2=json_dumps(mf2)).put()
+
+        summary = key.get().summary
+        self.assertEqual('posted', summary['phrase'])
+        self.assertEqual('Hello world', summary['content'])
+        self.assertEqual('http://a/post', summary['url'])
+        self.assertEqual({
+            'url': 'http://a/',
+            'name': 'Alice',
+            'image': 'http://a/pic',
+        }, summary['actor'])
+        self.assertEqual(['http://a/post'], summary['ids'])
+
+        # only recomputed when the source changes
+        activity = key.get()
+        with mock.patch.object(Activity, 'summarize') as mock_summarize:
+            activity.status = 'complete'
+            activity.put()
+            mock_summarize.assert_not_called()
+
+        mf2['items'][0]['properties']['content'] = ['Goodbye']
+        activity.source_mf2 = json_dumps(mf2)
+        activity.put()
+        self.assertEqual('Goodbye', key.get().summary['content'])
+
+    def test_summary_cached_by_source(self):
+        source = json_dumps({'items': [{'type': ['h-entry'], 'properties': {
+            'content': ['Hello world'],
+        }}]})
+        Activity(id='http://a/post http://b/inbox', source_mf2=source).put()
+
+        with mock.patch.object(Activity, 'summarize') as mock_summarize:
+            key = Activity(id='http://a/post http://c/inbox', source_mf2=source).put()
+            mock_summarize.assert_not_called()
+
+        self.assertEqual('Hello world', key.get().summary['content'])
+
+    def test_summary_fails(self):
+        with mock.patch.object(Activity, 'summarize', side_effect=ValueError('foo')):
+            key = Activity(id='http://a/post http://b/inbox', source_as2='{}').put()
+
+        self.assertIsNone(key.get().summary)
+
     def test_proxy_url(self):
         with app.test_request_context('/'):
             activity = Activity.get_or_create('abc', 'xyz')
@@ -143,3 +260,34 @@ class ActivityTest(testutil.TestCase):
             activity.source_as2 = 'as2'
             self.assertEqual('http://localhost/render?source=abc&target=xyz',
                              activity.proxy_url())
+
+
+class FollowerTest(testutil.TestCase):
+
+    def test_counts(self):
+        self.assertEqual(0, Follower.count_followers('foo.com'))
+        self.assertEqual(0, Follower.count_following('http://bar/actor'))
+
+        Follower.get_or_create('foo.com', 'http://bar/actor')
+        Follower.get_or_create('foo.com', 'http://baz/actor')
+        Follower.get_or_create('foo.com', 'http://baj/actor', status='inactive')
+        self.assertEqual(2, Follower.count_followers('foo.com'))
+        self.assertEqual(1, Follower.count_following('http://bar/actor'))
+
+        # refollowing shouldn't double count
+        Follower.get_or_create('foo.com', 'http://bar/actor')
+        self.assertEqual(2, Follower.count_followers('foo.com'))
+
+        follower = Follower.get_by_id('foo.com http://bar/actor')
+        follower.status = 'inactive'
+        follower.put()
+        follower.update_counts(was_active=True)
+        self.assertEqual(1, Follower.count_followers('foo.com'))
+        self.assertEqual(0, Follower.count_following('http://bar/actor'))
+
+    def test_counter_created_lazily(self):
+        Follower.get_or_create('foo.com', 'http://bar/actor')
+        self.assertIsNone(Counter.get_by_id('followers foo.com'))
+
+        self.assertEqual(1, Follower.count_followers('foo.com'))
+        self.assertEqual(1, Counter.get_by_id('followers foo.com').count)
@@ -1,8 +1,12 @@
 """Unit tests for pages.py."""
+from unittest.mock import patch
+
+from google.cloud import ndb
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.util import json_dumps, json_loads
 from granary import as2, atom, microformats2, rss
 
+import common
 from models import Activity, Follower, User
 from . import testutil
 from .test_activitypub import LIKE, MENTION, NOTE, REPLY
@@ -86,3 +90,73 @@ class PagesTest(testutil.TestCase):
         got = self.client.get('/user/foo.com/feed?format=rss')
         self.assert_equals(200, got.status_code)
         self.assert_equals(self.EXPECTED, contents(rss.to_activities(got.text)))
+
+    def test_feed_etag(self):
+        self.add_activities()
+        got = self.client.get('/user/foo.com/feed?format=atom')
+        self.assert_equals(200, got.status_code)
+        etag = got.headers['ETag']
+
+        got = self.client.get('/user/foo.com/feed?format=atom',
+                              headers={'If-None-Match': etag})
+        self.assert_equals(304, got.status_code)
+        self.assert_equals('', got.text)
+
+        # other formats have their own ETags
+        got = self.client.get('/user/foo.com/feed?format=rss',
+                              headers={'If-None-Match': etag})
+        self.assert_equals(200, got.status_code)
+
+        # a new inbound activity changes the feed
+        Activity(id='g', domain=['foo.com'], direction='in',
+                 source_as2=json_dumps(NOTE)).put()
+        got = self.client.get('/user/foo.com/feed?format=atom',
+                              headers={'If-None-Match': etag})
+        self.assert_equals(200, got.status_code)
+        self.assertNotEqual(etag, got.headers['ETag'])
+
+    def test_recent_uses_summaries(self):
+        self.add_activities()
+
+        with patch.object(Activity, 'to_as1') as mock_to_as1:
+            got = self.client.get('/recent')
+            self.assert_equals(200, got.status_code)
+            mock_to_as1.assert_not_called()
+
+        self.assertIn('A ☕ reply', got.text)
+
+    def test_recent_batches_user_lookups(self):
+        User.get_or_create('bar.org')
+        for i in range(5):
+            for domain in 'foo.com', 'bar.org':
+                source = f'http://{domain}/{i}'
+                Activity(id=f'{source} http://inbox', domain=[domain],
+                         direction='out',
+                         source_as2=json_dumps({**NOTE, 'id': source})).put()
+
+        # no User, falls back to the activity's actor
+        Activity(id='http://gone.com/0 http://inbox', domain=['gone.com'],
+                 direction='out',
+                 source_as2=json_dumps({**NOTE, 'id': 'http://gone.com/0', 'actor': {
+                     'type': 'Person',
+                     'url': 'http://gone.com/',
+                     'name': 'Gone Person',
+                 }})).put()
+
+        with patch.object(User, 'get_by_id') as mock_get_by_id, \
+             patch.object(ndb, 'get_multi', wraps=ndb.get_multi) as mock_get_multi, \
+             patch.object(User, 'user_page_link', autospec=True,
+                          side_effect=lambda user: user.key.id()) as mock_link:
+            got = self.client.get('/recent')
+            self.assert_equals(200, got.status_code)
+
+        mock_get_by_id.assert_not_called()
+        mock_get_multi.assert_called_once()
+        self.assertEqual(2, mock_link.call_count)
+        self.assertIn('Gone Person', got.text)
+
+    def test_admin_hosts(self):
+        common.record_host_result('dead.example', failed=True)
+        got = self.client.get('/admin/hosts')
+        self.assert_equals(200, got.status_code)
+        self.assertIn('dead.example', got.text)
@@ -22,6 +22,7 @@ class RedirectTest(testutil.TestCase):
         got = self.client.get('/r/https://foo.com/bar?baz=baj&biff')
         self.assertEqual(301, got.status_code)
         self.assertEqual('https://foo.com/bar?baz=baj&biff=', got.headers['Location'])
+        self.assertEqual('Accept', got.headers['Vary'])
 
     def test_redirect_scheme_missing(self):
         got = self.client.get('/r/foo.com')
@@ -73,3 +74,5 @@ class RedirectTest(testutil.TestCase):
 
         self.assertEqual(200, got.status_code)
         self.assertEqual(repost, got.json)
+        self.assertEqual('Accept', got.headers['Vary'])
+        self.assertIn('public', got.headers['Cache-Control'])
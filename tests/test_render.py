@@ -77,6 +77,16 @@ class RenderTest(testutil.TestCase):
         self.assert_multiline_equals(self.html, resp.get_data(as_text=True),
                                      ignore_blanks=True)
 
+    def test_render_if_modified_since(self):
+        Activity(id='abc xyz', source_as2=json_dumps(self.as2)).put()
+        resp = self.client.get('/render?source=abc&target=xyz')
+        self.assertEqual(200, resp.status_code)
+        last_modified = resp.headers['Last-Modified']
+
+        resp = self.client.get('/render?source=abc&target=xyz',
+                               headers={'If-Modified-Since': last_modified})
+        self.assertEqual(304, resp.status_code)
+
     def test_render_mf2(self):
         Activity(id='abc xyz', source_mf2=json_dumps(self.mf2)).put()
         resp = self.client.get('/render?source=abc&target=xyz')
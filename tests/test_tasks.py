@@ -0,0 +1,309 @@
+"""Unit tests for tasks.py."""
+import datetime
+from unittest.mock import Mock, patch
+
+from oauth_dropins.webutil.testutil import requests_response
+from oauth_dropins.webutil.util import json_dumps, json_loads
+import requests
+
+import common
+import models
+import tasks
+from models import (Activity, Counter, Delivery, Follower, InboxItem, KeyPair,
+                    Snapshot, SnapshotProperty, User)
+from . import testutil
+
+NOTE = {
+    '@context': 'https://www.w3.org/ns/activitystreams',
+    'type': 'Create',
+    'id': 'http://localhost/r/http://foo.com/post',
+}
+
+
+@patch('requests.post')
+class TasksTest(testutil.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.get_or_create('foo.com')
+        self.activity = Activity(id='http://foo.com/post https://inbox',
+                                 status='error')
+        self.activity.put()
+
+    def add_delivery(self, **kwargs):
+        kwargs.setdefault('inbox', 'https://inbox')
+        delivery = Delivery(data=json_dumps(NOTE), domain='foo.com',
+                            host_url='http://localhost/',
+                            activities=[self.activity.key], attempts=1,
+                            next_attempt=testutil.NOW, **kwargs)
+        delivery.put()
+        return delivery
+
+    def test_deliver_only_due(self, mock_post):
+        mock_post.return_value = requests_response('OK')
+        self.add_delivery()
+        Delivery(inbox='https://other', data='{}', domain='foo.com',
+                 next_attempt=testutil.NOW + datetime.timedelta(minutes=1)).put()
+
+        got = self.client.get('/cron/deliver')
+        self.assertEqual(200, got.status_code)
+        mock_post.assert_called_once()
+
+    def test_deliver_success(self, mock_post):
+        mock_post.return_value = requests_response('OK')
+        key = self.add_delivery(content_hash='abc').key
+
+        got = self.client.get('/cron/deliver')
+        self.assertEqual(200, got.status_code)
+
+        args, kwargs = mock_post.call_args
+        self.assertEqual(('https://inbox',), args)
+        self.assertEqual(NOTE, json_loads(kwargs['data']))
+
+        delivery = key.get()
+        self.assertEqual('complete', delivery.status)
+        self.assertEqual(2, delivery.attempts)
+        self.assertEqual(testutil.NOW + tasks.QUEUE_EXPIRE, delivery.expire)
+        activity = self.activity.key.get()
+        self.assertEqual('complete', activity.status)
+        self.assertEqual('abc', activity.content_hash)
+
+    def test_deliver_skips_claimed(self, mock_post):
+        delivery = self.add_delivery()
+        # another run claimed it
+        delivery.next_attempt = testutil.NOW + tasks.QUEUE_LEASE
+        delivery.put()
+
+        got = self.client.get('/cron/deliver')
+        self.assertEqual('Nothing to deliver', got.get_data(as_text=True))
+        mock_post.assert_not_called()
+
+    @patch.object(tasks, 'DELIVERY_BATCH_SIZE', 2)
+    def test_deliver_multiple_batches(self, mock_post):
+        mock_post.return_value = requests_response('OK')
+        keys = [Delivery(inbox=f'https://inbox/{i}', data=json_dumps(NOTE),
+                         domain='foo.com', host_url='http://localhost/',
+                         next_attempt=testutil.NOW).put()
+                for i in range(5)]
+
+        got = self.client.get('/cron/deliver')
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('Delivered 5 of 5', got.get_data(as_text=True))
+        self.assertEqual(5, mock_post.call_count)
+        self.assertEqual(['complete'] * 5, [key.get().status for key in keys])
+
+    @patch.object(tasks, 'DELIVERY_BATCH_SIZE', 2)
+    @patch.object(tasks, 'DELIVERY_TIME_BUDGET', 0)
+    def test_deliver_time_budget(self, mock_post):
+        mock_post.return_value = requests_response('OK')
+        for i in range(3):
+            self.add_delivery(inbox=f'https://inbox/{i}')
+
+        got = self.client.get('/cron/deliver')
+        self.assertEqual('Delivered 2 of 2', got.get_data(as_text=True))
+        self.assertEqual(1, Delivery.query(Delivery.status == 'pending').count())
+
+    def test_deliver_retry(self, mock_post):
+        mock_post.return_value = requests_response('', status=503)
+        key = self.add_delivery().key
+
+        got = self.client.get('/cron/deliver')
+        self.assertEqual(200, got.status_code)
+
+        delivery = key.get()
+        self.assertEqual('pending', delivery.status)
+        self.assertEqual(2, delivery.attempts)
+        self.assertGreater(delivery.next_attempt, testutil.NOW)
+        self.assertLessEqual(delivery.next_attempt,
+                             testutil.NOW + common.DELIVERY_RETRY_BASE * 2)
+        self.assertEqual('error', self.activity.key.get().status)
+
+    def test_deliver_connection_failure_retries(self, mock_post):
+        mock_post.side_effect = requests.exceptions.ConnectionError('foo')
+        key = self.add_delivery().key
+
+        self.client.get('/cron/deliver')
+        self.assertEqual('pending', key.get().status)
+
+    def test_deliver_client_error_is_dead(self, mock_post):
+        mock_post.return_value = requests_response('', status=410)
+        self.activity.status = 'queued'
+        self.activity.put()
+        key = self.add_delivery(content_hash='abc').key
+
+        self.client.get('/cron/deliver')
+        self.assertEqual('dead', key.get().status)
+        activity = self.activity.key.get()
+        self.assertEqual('error', activity.status)
+        self.assertIsNone(activity.content_hash)
+
+    def test_deliver_max_attempts_is_dead(self, mock_post):
+        mock_post.return_value = requests_response('', status=500)
+        key = self.add_delivery().key
+        delivery = key.get()
+        delivery.attempts = common.DELIVERY_MAX_ATTEMPTS - 1
+        delivery.put()
+
+        self.client.get('/cron/deliver')
+        self.assertEqual('dead', key.get().status)
+
+    @patch.object(tasks, 'KEY_POOL_SIZE', 3)
+    @patch.object(tasks, 'KEY_POOL_REFILL_BATCH', 2)
+    def test_refill_key_pool(self, _):
+        got = self.client.get('/cron/refill-key-pool')
+        self.assertEqual(200, got.status_code)
+        self.assertEqual(2, KeyPair.query().count())
+
+        self.client.get('/cron/refill-key-pool')
+        self.assertEqual(3, KeyPair.query().count())
+
+        self.client.get('/cron/refill-key-pool')
+        self.assertEqual(3, KeyPair.query().count())
+
+    def test_backfill_follower_inboxes(self, _):
+        follow = json_dumps({'actor': {'inbox': 'https://inbox'}})
+        Follower(id='foo.com https://a', last_follow=follow).put()
+        Follower(id='foo.com https://b').put()
+        done = Follower.get_or_create('foo.com', 'https://c', last_follow=follow)
+        self.assertEqual('https://inbox', done.inbox)
+
+        with patch.object(tasks, 'MIGRATION_BATCH_SIZE', 2):
+            got = self.client.get('/cron/backfill-follower-inboxes')
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('Updated 1 of 3 Followers', got.get_data(as_text=True))
+
+        self.assertEqual('https://inbox', Follower.get_by_id('foo.com https://a').inbox)
+        self.assertIsNone(Follower.get_by_id('foo.com https://b').inbox)
+
+    @patch.object(tasks, 'MIGRATION_BATCH_SIZE', 2)
+    @patch.object(tasks, 'MIGRATION_TIME_BUDGET', 0)
+    def test_backfill_follower_inboxes_time_budget(self, _):
+        follow = json_dumps({'actor': {'inbox': 'https://inbox'}})
+        for id in 'a', 'b', 'c':
+            Follower(id=f'foo.com https://{id}', last_follow=follow).put()
+
+        got = self.client.get('/cron/backfill-follower-inboxes')
+        self.assertEqual(200, got.status_code)
+        msg, next_url = got.get_data(as_text=True).split('\nNext: ')
+        self.assertEqual('Updated 2 of 2 Followers', msg)
+
+        got = self.client.get(next_url)
+        self.assertEqual('Updated 1 of 1 Followers', got.get_data(as_text=True))
+        self.assertEqual(['https://inbox'] * 3,
+                         [f.inbox for f in Follower.query()])
+
+    def test_reconcile_counters(self, _):
+        Follower.get_or_create('foo.com', 'http://bar/actor')
+        self.assertEqual(1, Follower.count_followers('foo.com'))
+        self.assertEqual(1, Follower.count_following('http://bar/actor'))
+
+        Counter(id='followers foo.com', count=5).put()
+        Follower(id='foo.com http://baz/actor', src='http://baz/actor',
+                 dest='foo.com', status='active').put()
+
+        got = self.client.get('/cron/reconcile-counters')
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('Fixed 1 of 2 Counters', got.get_data(as_text=True))
+        self.assertEqual(2, Follower.count_followers('foo.com'))
+
+    def test_process_inbox_retry(self, _):
+        key = InboxItem(data=json_dumps({
+            'type': 'Like',
+            'actor': 'http://orig/actor',
+            'object': 'http://orig/post',
+        }), domain='foo.com', host_url='http://localhost/',
+            next_attempt=testutil.NOW).put()
+
+        with patch('requests.get', side_effect=requests.exceptions.ConnectionError('foo')):
+            got = self.client.get('/cron/process-inbox')
+        self.assertEqual(200, got.status_code)
+
+        item = key.get()
+        self.assertEqual('pending', item.status)
+        self.assertEqual(1, item.attempts)
+        self.assertGreater(item.next_attempt, testutil.NOW)
+
+    def make_inbox_items(self, count):
+        return [InboxItem(data=json_dumps({'type': 'Like', 'id': f'http://orig/{i}'}),
+                          domain='foo.com', host_url='http://localhost/',
+                          next_attempt=testutil.NOW).put()
+                for i in range(count)]
+
+    @patch.object(tasks, 'INBOX_BATCH_SIZE', 2)
+    @patch('activitypub.process_inbox')
+    def test_process_inbox_multiple_batches(self, mock_process, _):
+        keys = self.make_inbox_items(5)
+
+        got = self.client.get('/cron/process-inbox')
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('Processed 5 of 5', got.get_data(as_text=True))
+        self.assertEqual(5, mock_process.call_count)
+        self.assertEqual(['complete'] * 5, [key.get().status for key in keys])
+        self.assertEqual(testutil.NOW + tasks.QUEUE_EXPIRE, keys[0].get().expire)
+
+    def test_claim(self, _):
+        key = self.make_inbox_items(1)[0]
+        query = InboxItem.query(InboxItem.status == 'pending',
+                                InboxItem.next_attempt <= testutil.NOW)
+        self.assertEqual([key], [item.key for item in tasks.claim(query, 10)])
+        self.assertEqual(testutil.NOW + tasks.QUEUE_LEASE, key.get().next_attempt)
+
+        # an overlapping run whose query saw the item before it was claimed
+        stale_query = Mock()
+        stale_query.fetch.return_value = [key]
+        self.assertEqual([], tasks.claim(stale_query, 10))
+
+    @patch.object(tasks, 'INBOX_BATCH_SIZE', 2)
+    @patch.object(tasks, 'INBOX_TIME_BUDGET', 0)
+    @patch('activitypub.process_inbox')
+    def test_process_inbox_time_budget(self, mock_process, _):
+        self.make_inbox_items(3)
+
+        got = self.client.get('/cron/process-inbox')
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('Processed 2 of 2', got.get_data(as_text=True))
+        self.assertEqual(1, InboxItem.query(InboxItem.status == 'pending').count())
+
+    def test_backfill_activity_content_hashes(self, _):
+        mf2 = {'items': [{'type': ['h-entry'], 'properties': {'content': ['foo']}}]}
+        Activity(id='http://a/post http://b/inbox',
+                 source_mf2=json_dumps(mf2)).put()
+        Activity(id='http://a/other http://b/inbox', source_mf2=json_dumps({})).put()
+
+        got = self.client.get('/cron/backfill-activity-content-hashes')
+        self.assertEqual(200, got.status_code)
+        self.assertEqual(Activity.mf2_content_hash(mf2),
+                         Activity.get_by_id('http://a/post http://b/inbox').content_hash)
+        self.assertIsNone(Activity.get_by_id('http://a/other http://b/inbox').content_hash)
+
+    def test_migrate_activity_snapshots(self, _):
+        # store inline, the way Activities were before Snapshots
+        with patch.object(SnapshotProperty, '_to_base_type', return_value=None), \
+             patch.object(Activity, '_pre_put_hook'):
+            key = Activity(id='http://a/post http://b/inbox',
+                           source_mf2='{"foo": "bar"}').put()
+        self.assertEqual(0, Snapshot.query().count())
+        updated = key.get().updated
+
+        got = self.client.get('/cron/migrate-activity-snapshots')
+        self.assertEqual(200, got.status_code)
+        self.assertEqual(1, Snapshot.query().count())
+
+        models._snapshots.clear()
+        activity = key.get()
+        self.assertEqual('{"foo": "bar"}', activity.source_mf2)
+        self.assertEqual(updated, activity.updated)
+
+    def test_backfill_activity_summaries(self, _):
+        with patch.object(Activity, '_pre_put_hook'):
+            key = Activity(id='http://a/post http://b/inbox',
+                           source_as2=json_dumps(NOTE)).put()
+        self.assertIsNone(key.get().summary)
+        updated = key.get().updated
+
+        got = self.client.get('/cron/backfill-activity-summaries')
+        self.assertEqual(200, got.status_code)
+
+        activity = key.get()
+        self.assertIn('ids', activity.summary)
+        self.assertEqual(updated, activity.updated)
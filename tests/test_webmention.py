@@ -17,6 +17,7 @@ from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
 
 import activitypub
+from app import app
 from common import (
     CONNEG_HEADERS_AS2,
     CONNEG_HEADERS_AS2_HTML,
@@ -26,7 +27,7 @@ from common import (
     CONTENT_TYPE_MAGIC_ENVELOPE,
     default_signature_user,
 )
-from models import Follower, User, Activity
+from models import Delivery, Follower, SourcePage, User, Activity
 import webmention
 from . import testutil
 
@@ -502,6 +503,125 @@ class WebmentionTest(testutil.TestCase):
         self.assertEqual(200, got.status_code)
         mock_post.assert_not_called()
 
+    def test_activitypub_skip_update_if_content_hash_unchanged(self, mock_get, mock_post):
+        Activity(id='http://a/reply http://orig/as2', status='complete',
+                 content_hash=Activity.mf2_content_hash(self.reply_mf2)).put()
+
+        mock_get.side_effect = self.activitypub_gets
+
+        got = self.client.post('/webmention', data={
+            'source': 'http://a/reply',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(200, got.status_code)
+        mock_post.assert_not_called()
+
+    def test_activitypub_skip_if_source_not_modified(self, mock_get, mock_post):
+        self.reply.headers['ETag'] = '"abc"'
+        mock_get.side_effect = self.activitypub_gets
+        mock_post.return_value = requests_response('abc xyz')
+
+        got = self.client.post('/webmention', data={
+            'source': 'http://a/reply',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(200, got.status_code)
+        self.assertEqual(1, mock_post.call_count)
+
+        mock_get.reset_mock()
+        mock_get.side_effect = [requests_response(status=304), self.not_fediverse,
+                                self.orig_as2, self.actor]
+        got = self.client.post('/webmention', data={
+            'source': 'http://a/reply',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(200, got.status_code)
+        self.assertEqual(1, mock_post.call_count)
+
+        args, kwargs = mock_get.call_args_list[0]
+        self.assertEqual(('http://a/reply',), args)
+        self.assertEqual('"abc"', kwargs['headers']['If-None-Match'])
+
+    def test_activitypub_skip_if_source_body_unchanged(self, mock_get, mock_post):
+        mock_get.side_effect = self.activitypub_gets
+        mock_post.return_value = requests_response('abc xyz')
+        self.client.post('/webmention', data={
+            'source': 'http://a/reply',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(1, mock_post.call_count)
+
+        mock_get.side_effect = [requests_response(self.reply_html, content_type=CONTENT_TYPE_HTML),
+                                self.not_fediverse, self.orig_as2, self.actor]
+        with mock.patch.object(util, 'parse_mf2') as mock_parse:
+            got = self.client.post('/webmention', data={
+                'source': 'http://a/reply',
+                'target': 'https://fed.brid.gy/',
+            })
+        self.assertEqual(200, got.status_code)
+        mock_parse.assert_not_called()
+        self.assertEqual(1, mock_post.call_count)
+
+    def test_activitypub_update_if_source_not_modified_but_not_delivered(
+            self, mock_get, mock_post):
+        # an earlier attempt fetched and stored this version of the source, but
+        # failed before delivering it
+        SourcePage(id='http://a/reply', url='http://a/reply', etag='"abc"',
+                   mf2=json_dumps(self.reply_mf2)).put()
+        Activity(id='http://a/reply http://orig/as2', status='complete',
+                 content_hash='old').put()
+
+        mock_get.side_effect = [requests_response(status=304), self.not_fediverse,
+                                self.orig_as2, self.actor]
+        mock_post.return_value = requests_response('abc xyz')
+        got = self.client.post('/webmention', data={
+            'source': 'http://a/reply',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(200, got.status_code)
+
+        args, kwargs = mock_post.call_args
+        self.assertEqual(self.as2_update, json_loads(kwargs['data']))
+        self.assertEqual(Activity.mf2_content_hash(self.reply_mf2), Activity.get_by_id(
+            'http://a/reply http://orig/as2').content_hash)
+
+    def test_activitypub_reply_to_multiple_posts_same_inbox(
+            self, mock_get, mock_post):
+        reply_html = self.reply_html.replace('http://not/fediverse', 'http://orig/other')
+        other_as2 = copy.deepcopy(self.orig_as2_data)
+        other_as2.update({
+            'id': 'tag:orig,2017:other',
+            'cc': ['http://orig/other-recipient'],
+        })
+        mock_get.side_effect = [
+            requests_response(reply_html, content_type=CONTENT_TYPE_HTML),
+            requests_response(other_as2, url='http://orig/other',
+                              content_type=CONTENT_TYPE_AS2),
+            self.actor,
+            self.orig_as2,
+            self.actor,
+        ]
+        mock_post.return_value = requests_response('abc xyz')
+
+        got = self.client.post('/webmention', data={
+            'source': 'http://a/reply',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(200, got.status_code)
+
+        # each reply has a different inReplyTo, so they're sent separately
+        self.assertEqual(2, mock_post.call_count)
+        in_reply_tos = []
+        for args, kwargs in mock_post.call_args_list:
+            self.assertEqual(('https://foo.com/inbox',), args)
+            in_reply_tos.append(json_loads(kwargs['data'])['object']['inReplyTo'])
+        self.assertCountEqual(['tag:orig,2017:other', 'tag:orig,2017:as2'],
+                              in_reply_tos)
+
+        for target in 'http://orig/other', 'http://orig/as2':
+            activity = Activity.get_by_id(f'http://a/reply {target}')
+            self.assertEqual('complete', activity.status, target)
+
     def test_activitypub_create_reply_attributed_to_id_only(self, mock_get, mock_post):
         """Based on PeerTube's AS2.
 
@@ -725,7 +845,9 @@ class WebmentionTest(testutil.TestCase):
                    'https://shared/inbox', 'https://updated/inbox')
         self.assertEqual(len(inboxes), len(mock_post.call_args_list))
 
-        for call, inbox in zip(mock_post.call_args_list, inboxes):
+        # deliveries are concurrent, so they may happen in any order
+        calls = sorted(mock_post.call_args_list, key=lambda call: call[0])
+        for call, inbox in zip(calls, inboxes):
             with self.subTest(call=call, inbox=inbox):
                 self.assertEqual((inbox,), call[0])
                 self.assertEqual(
@@ -741,6 +863,62 @@ class WebmentionTest(testutil.TestCase):
                                   else self.create_mf2),
                                  json_loads(activity.source_mf2), inbox)
 
+    def test_activitypub_create_post_follower_inbox_not_backfilled(self, mock_get, mock_post):
+        mock_get.side_effect = [self.create, self.actor]
+        mock_post.return_value = requests_response('abc xyz')
+
+        # stored before Follower.inbox existed
+        Follower(id=Follower._id('orig', 'https://mastodon/aaa'),
+                 dest='orig', src='https://mastodon/aaa', status='active',
+                 last_follow=json_dumps({'actor': {'inbox': 'https://inbox'}}),
+                 ).put()
+
+        got = self.client.post('/webmention', data={
+            'source': 'http://orig/post',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(200, got.status_code)
+
+        self.assertEqual(1, len(mock_post.call_args_list))
+        args, kwargs = mock_post.call_args
+        self.assertEqual(('https://inbox',), args)
+        self.assertEqual(self.create_as2, json_loads(kwargs['data']))
+
+    def test_activitypub_create_post_queued(self, mock_get, mock_post):
+        mock_get.side_effect = [self.create, self.actor] * 2
+        Follower.get_or_create('orig', 'https://mastodon/aaa',
+                               last_follow=json_dumps({'actor': {
+                                   'inbox': 'https://inbox',
+                               }}))
+
+        # second one is the sender retrying, which shouldn't queue a duplicate
+        for _ in range(2):
+            with mock.patch.dict(app.config, DELIVERY_QUEUE='datastore'):
+                got = self.client.post('/webmention', data={
+                    'source': 'http://orig/post',
+                    'target': 'https://fed.brid.gy/',
+                })
+            self.assertEqual(202, got.status_code)
+
+        mock_post.assert_not_called()
+
+        deliveries = Delivery.query().fetch()
+        self.assertEqual(1, len(deliveries))
+        delivery = deliveries[0]
+        self.assertEqual('https://inbox', delivery.inbox)
+        self.assertEqual('pending', delivery.status)
+        self.assertEqual(0, delivery.attempts)
+        self.assertEqual(self.create_as2, json_loads(delivery.data))
+
+        self.assertEqual(Activity.mf2_content_hash(self.create_mf2),
+                         delivery.content_hash)
+
+        # not delivered yet, so still a Create, and no content_hash
+        activity = Activity.get_by_id('http://orig/post https://inbox')
+        self.assertEqual([activity.key], delivery.activities)
+        self.assertEqual('queued', activity.status)
+        self.assertIsNone(activity.content_hash)
+
     def test_activitypub_create_with_image(self, mock_get, mock_post):
         create_html = self.create_html.replace(
             '</body>', '<img class="u-photo" src="http://im/age" />\n</body>')
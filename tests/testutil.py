@@ -1,16 +1,24 @@
 """Common test utility code.
 """
+from base64 import b64encode
 import copy
 import datetime
+from hashlib import sha256
 import unittest
 from unittest.mock import ANY, call
 
+from Crypto.PublicKey import RSA
 from app import app, cache
 from oauth_dropins.webutil import testutil, util
+from oauth_dropins.webutil.util import json_dumps
 from oauth_dropins.webutil.appengine_config import ndb_client
 import requests
 
+import activitypub
+import caching
 import common
+import models
+from models import User
 
 NOW = datetime.datetime(2022, 11, 23, 22, 29, 19)
 
@@ -24,6 +32,16 @@ class TestCase(unittest.TestCase, testutil.Asserts):
         cache.clear()
         self.client = app.test_client()
         common.utcnow = lambda: NOW
+        common._host_health.clear()
+        common._as2_cache.clear()
+        common.as2_cache_stats.clear()
+        activitypub._seen.clear()
+        common._public_keys.clear()
+        common._endpoints.clear()
+        common.endpoint_cache_stats.clear()
+        models._snapshots.clear()
+        models._summaries.clear()
+        caching.stats.clear()
 
         # clear datastore
         requests.post('http://%s/reset' % ndb_client.host)
@@ -34,6 +52,37 @@ class TestCase(unittest.TestCase, testutil.Asserts):
         self.ndb_context.__exit__(None, None, None)
         super().tearDown()
 
+    @staticmethod
+    def signed_headers(user, body, key_id='http://orig/actor#main-key', date=NOW):
+        """Returns HTTP Signature headers for an inbox POST, signed by user's key."""
+        req = requests.Request('POST', 'http://localhost/inbox', data=body, headers={
+            'Date': date.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+            'Host': 'localhost',
+            'Digest': f'SHA-256={b64encode(sha256(body).digest()).decode()}',
+        }).prepare()
+        common.signature_auth(key_id, user)(req)
+        return dict(req.headers)
+
+    def post_signed(self, path, activity, cache_key=True):
+        """POSTs an activity with a valid HTTP Signature from its actor.
+
+        If cache_key is True, caches the actor's public key so that it isn't
+        fetched.
+        """
+        actor = activity['actor']
+        actor_id = actor['id'] if isinstance(actor, dict) else actor
+        key_id = f'{actor_id}#main-key'
+        signer = User.get_or_create('signer.example')
+        if cache_key:
+            common._public_keys[key_id] = (RSA.import_key(signer.public_pem()),
+                                           actor_id)
+
+        body = json_dumps(activity).encode()
+        return self.client.post(path, data=body, headers={
+            **self.signed_headers(signer, body, key_id=key_id),
+            'Content-Type': 'application/activity+json',
+        })
+
     def req(self, url, **kwargs):
         """Returns a mock requests call."""
         kwargs.setdefault('headers', {}).update({
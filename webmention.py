@@ -4,6 +4,7 @@ TODO tests:
 * actor/attributedTo could be string URL
 * salmon rel via webfinger via author.name + domain
 """
+import hashlib
 import logging
 import urllib.parse
 from urllib.parse import urlencode
@@ -13,7 +14,7 @@ from django_salmon import magicsigs
 import feedparser
 from flask import request
 from flask.views import View
-from google.cloud.ndb import Key
+from google.cloud import ndb
 from granary import as1, as2, atom, microformats2
 import mf2util
 from oauth_dropins.webutil import flask_util, util
@@ -25,7 +26,7 @@ from werkzeug.exceptions import BadGateway
 import activitypub
 from app import app
 import common
-from models import Activity, Follower, User
+from models import Activity, Follower, SourcePage, User
 
 logger = logging.getLogger(__name__)
 
@@ -40,33 +41,75 @@ class Webmention(View):
     source_obj = None     # parsed AS1 dict
     target_resp = None    # requests.Response
     user = None           # User
+    source_unchanged = False  # whether source matches its stored SourcePage
+    source_content_hash = None  # string, from Activity.mf2_content_hash
 
     def dispatch_request(self):
         logger.info(f'Params: {list(request.form.items())}')
 
-        # fetch source page
+        # fetch source page. send validators from the last time we saw it, if
+        # any, and reuse its parsed mf2 if it hasn't changed.
         source = flask_util.get_required_param('source')
+        page = SourcePage.get_by_id(source)
+        headers = {}
+        if page and page.etag:
+            headers['If-None-Match'] = page.etag
+        if page and page.last_modified:
+            headers['If-Modified-Since'] = page.last_modified
+
         try:
-            source_resp = util.requests_get(source)
+            source_resp = util.requests_get(source, headers=headers)
         except ValueError as e:
             error(f'Bad source URL: {source}: {e}')
-        self.source_url = source_resp.url or source
-        self.source_domain = urllib.parse.urlparse(self.source_url).netloc.split(':')[0]
-        fragment = urllib.parse.urlparse(self.source_url).fragment
-        self.source_mf2 = util.parse_mf2(source_resp, id=fragment)
 
-        if id and self.source_mf2 is None:
-            error(f'id {fragment} not found in {self.source_url}')
+        body_hash = None
+        if page and source_resp.status_code == 304:
+            logger.info(f'{source} not modified since {page.updated}')
+            self.source_unchanged = True
+        elif source_resp.ok:
+            body_hash = hashlib.sha256(source_resp.content).hexdigest()
+            if page and page.body_hash == body_hash:
+                logger.info(f'{source} content unchanged since {page.updated}')
+                self.source_unchanged = True
+                etag = source_resp.headers.get('ETag')
+                last_modified = source_resp.headers.get('Last-Modified')
+                if (etag, last_modified) != (page.etag, page.last_modified):
+                    page.etag = etag
+                    page.last_modified = last_modified
+                    page.put()
+
+        if self.source_unchanged:
+            self.source_url = page.url
+            self.source_domain = urllib.parse.urlparse(self.source_url).netloc.split(':')[0]
+            fragment = urllib.parse.urlparse(self.source_url).fragment
+            self.source_mf2 = json_loads(page.mf2)
+        else:
+            self.source_url = source_resp.url or source
+            self.source_domain = urllib.parse.urlparse(self.source_url).netloc.split(':')[0]
+            fragment = urllib.parse.urlparse(self.source_url).fragment
+            self.source_mf2 = util.parse_mf2(source_resp, id=fragment)
 
-        # logger.debug(f'Parsed mf2 for {source_resp.url} : {json_dumps(self.source_mf2 indent=2)}')
+            if id and self.source_mf2 is None:
+                error(f'id {fragment} not found in {self.source_url}')
 
-        # check for backlink to bridgy fed (for webmention spec and to confirm
-        # source's intent to federate to mastodon)
-        for domain in common.DOMAINS:
-            if domain in source_resp.text:
-                break
-        else:
-            error(f"Couldn't find link to {request.host_url.rstrip('/')}")
+            # logger.debug(f'Parsed mf2 for {source_resp.url} : {json_dumps(self.source_mf2 indent=2)}')
+
+            # check for backlink to bridgy fed (for webmention spec and to confirm
+            # source's intent to federate to mastodon)
+            for domain in common.DOMAINS:
+                if domain in source_resp.text:
+                    break
+            else:
+                error(f"Couldn't find link to {request.host_url.rstrip('/')}")
+
+            if source_resp.ok:
+                SourcePage(id=source, url=self.source_url,
+                           etag=source_resp.headers.get('ETag'),
+                           last_modified=source_resp.headers.get('Last-Modified'),
+                           body_hash=body_hash,
+                           mf2=json_dumps(self.source_mf2)).put()
+
+        self.source_content_hash = Activity.mf2_content_hash(self.source_mf2)
 
         # convert source page to ActivityStreams
         entry = mf2util.find_first_entry(self.source_mf2, ['h-entry'])
@@ -104,8 +147,7 @@ class Webmention(View):
         error = None
         last_success = None
 
-        # TODO: collect by inbox, add 'to' fields, de-dupe inboxes and recipients
-
+        deliveries = []  # (Activity, inbox URL, AS2 activity) tuples
         for activity, inbox in targets:
             target_obj = json_loads(activity.target_as2) if activity.target_as2 else None
 
@@ -115,22 +157,21 @@ class Webmention(View):
                 source_activity['actor'] =  f'{request.host_url}{self.source_domain}'
 
             if activity.status == 'complete':
-                if activity.source_mf2:
-                    def content(mf2):
-                        items = mf2.get('items')
-                        if items:
-                            return microformats2.first_props(
-                                items[0].get('properties')
-                            ).get('content')
-
-                    orig_content = content(json_loads(activity.source_mf2))
-                    new_content = content(self.source_mf2)
-                    if orig_content and new_content and orig_content == new_content:
-                        logger.info(f'Skipping; new content is same as content published before at {activity.updated}')
-                        continue
+                # don't skip just because source_unchanged. an earlier attempt
+                # may have stored this version of the source but failed before
+                # delivering it.
+                orig_hash = activity.content_hash
+                if not orig_hash and activity.source_mf2:
+                    # hasn't been backfilled yet
+                    orig_hash = Activity.mf2_content_hash(json_loads(activity.source_mf2))
+                if orig_hash and orig_hash == self.source_content_hash:
+                    logger.info(f'Skipping; new content is same as content published before at {activity.updated}')
+                    continue
 
                 if source_activity.get('type') == 'Create':
                     source_activity['type'] = 'Update'
+            # if it's queued, the Create hasn't been sent yet, so keep it a
+            # Create. enqueue_deliveries updates the pending one in place.
 
             if self.source_obj.get('verb') == 'follow':
                 # prefer AS2 id or url, if available
@@ -140,15 +181,45 @@ class Webmention(View):
                 Follower.get_or_create(dest=dest, src=self.source_domain,
                                        last_follow=json_dumps(self.source_obj))
 
-            try:
-                last = common.signed_post(inbox, data=source_activity, user=self.user)
-                activity.status = 'complete'
-                last_success = last
-            except BaseException as e:
+            deliveries.append((activity, inbox, source_activity))
+
+        if app.config['DELIVERY_QUEUE'] == 'datastore' and not self._targets():
+            # follower fan-out. don't make the sender wait on every inbox.
+            # tasks.deliver marks the Activitys complete or error, and sets
+            # their content_hash, when it's done.
+            common.enqueue_deliveries(
+                [(inbox, source_activity, [activity])
+                 for activity, inbox, source_activity in deliveries],
+                self.user, content_hash=self.source_content_hash)
+            for activity, _, _ in deliveries:
+                activity.status = 'queued'
+            ndb.put_multi([activity for activity, _, _ in deliveries])
+            return f'Queued delivery to {len(deliveries)} inboxes', 202
+
+        # deliver to all inboxes concurrently
+        def deliver(delivery):
+            _, inbox, source_activity = delivery
+            return common.signed_post(inbox, data=source_activity, user=self.user)
+
+        results = common.map_concurrently(deliver, deliveries)
+        for (activity, inbox, source_activity), (resp, e) in zip(deliveries, results):
+            status = 'complete'
+            if e:
+                logger.info(f'Delivery to {inbox} failed: {e}')
                 error = e
-                activity.status = 'error'
-
-            activity.put()
+                status = 'error'
+                if common.is_retryable(e):
+                    common.enqueue_delivery(inbox, source_activity, self.user,
+                                            activities=[activity], error=e,
+                                            content_hash=self.source_content_hash)
+                    status = 'queued'
+            else:
+                last_success = resp
+                activity.content_hash = self.source_content_hash
+            activity.status = status
+
+        ndb.put_multi([activity for activity, _, _ in deliveries])
+        logger.info(f'Delivered to {sum(1 for _, e in results if not e)} of {len(deliveries)} inboxes')
 
         # Pass the AP response status code and body through as our response
         if last_success:
@@ -185,21 +256,30 @@ class Webmention(View):
 
         if not targets:
             # interpret this as a Create or Update, deliver it to followers
-            inboxes = set()
-            for follower in Follower.query().filter(
-                Follower.key > Key('Follower', self.source_domain + ' '),
-                Follower.key < Key('Follower', self.source_domain + chr(ord(' ') + 1))):
-                if follower.status != 'inactive' and follower.last_follow:
-                    actor = json_loads(follower.last_follow).get('actor')
-                    if actor and isinstance(actor, dict):
-                        inboxes.add(actor.get('endpoints', {}).get('sharedInbox') or
-                                    actor.get('publicInbox')or
-                                    actor.get('inbox'))
+            query = Follower.query(Follower.dest == self.source_domain,
+                                   Follower.status == 'active')
+            indexed = {f.key: f.inbox for f in query.iter(projection=[Follower.inbox])}
+            inboxes = set(inbox for inbox in indexed.values() if inbox)
+
+            # followers stored before Follower.inbox existed aren't in the
+            # projection index, and others may not have it populated yet, so
+            # load those and get their inbox from last_follow instead.
+            unindexed = [key for key in query.iter(keys_only=True)
+                         if not indexed.get(key)]
+            for follower in ndb.get_multi(unindexed):
+                if follower:
+                    inbox = (follower.inbox or
+                             Follower.inbox_from_follow(follower.last_follow))
+                    if inbox:
+                        inboxes.add(inbox)
+
+            source_mf2 = json_dumps(self.source_mf2)
             inboxes = [(Activity.get_or_create(
                           source=self.source_url, target=inbox,
                           domain=[self.source_domain], direction='out',
-                          protocol='activitypub', source_mf2=json_dumps(self.source_mf2)),
-                        inbox) for inbox in sorted(inboxes) if inbox]
+                          protocol='activitypub', source_mf2=source_mf2,
+                          content_hash=self.source_content_hash),
+                        inbox) for inbox in sorted(inboxes)]
             logger.info(f"Delivering to followers' inboxes: {[i for _, i in inboxes]}")
             return inboxes
 
@@ -225,7 +305,8 @@ class Webmention(View):
             activity = Activity.get_or_create(
                 source=self.source_url, target=target_url, domain=[self.source_domain],
                 direction='out', protocol='activitypub',
-                source_mf2=json_dumps(self.source_mf2))
+                source_mf2=json_dumps(self.source_mf2),
+                content_hash=self.source_content_hash)
 
             # find target's inbox
             target_obj = self.target_resp.json()